@@ -3,6 +3,7 @@ import json
 from urllib import request, parse
 import requests
 import time
+import io
 import pandas as pd
 
 
@@ -12,6 +13,17 @@ def check_status(url):
 	status = r.json()['task_status']
 
 	return status == 'SUCCESS'
+
+
+# waits for the tasks to finish and returns their statuses and results
+# the server holds each request until all of them finished (or 30 seconds passed), so there is no sleep between checks
+def wait_for_tasks(task_ids):
+	while True:
+		r = requests.post("http://localhost:8080/api/status", json = {"task_ids": task_ids, "wait": 30})
+		r.raise_for_status()
+		status = r.json()
+		if status['done']:
+			return status['tasks']
 	
 
 def submit_to_tiramisu(task, kwargs):
@@ -31,12 +43,14 @@ def submit_to_tiramisu(task, kwargs):
 	result = json.loads(out_data)
 
 
-def return_from_neo4j(query):
+# artifact = True streams the result into a parquet file on the server instead of the task result,
+# for queries returning too many rows to travel through the result backend
+def return_from_neo4j(query, artifact = False):
 	digest_list = [
 	{
 
 		"action": "query_neo4j",
-		 'kwargs': {'query': query}
+		 'kwargs': {'query': query, 'artifact': artifact}
 	}]
 	
 	data = json.dumps({ 
@@ -48,17 +62,58 @@ def return_from_neo4j(query):
 	res = request.urlopen(req)
 	out_data = res.read()
 	result = json.loads(out_data)
-	
-	time.sleep(1)
-	
-	response = request.urlopen("http://localhost:8080/api/status/" + result['task_id'][0])
 
-	finished = False
-	while not finished:
-		time.sleep(1)
+	data = wait_for_tasks(result['task_id'])[0]
 
-		finished = check_status("http://localhost:8080/api/status/" + result['task_id'][0])
-	response = request.urlopen("http://localhost:8080/api/status/" + result['task_id'][0])
-	data = json.loads(response.read())
+	if artifact:
+		response = request.urlopen("http://localhost:8080/api/artifact/" + data['task_result']['artifact'])
+		return pd.read_parquet(io.BytesIO(response.read()))
 	
-	return pd.DataFrame(data['task_result'])
\ No newline at end of file
+	return pd.DataFrame(data['task_result'])
+
+# reads a snapshot written by the snapshot_neo4j task, so analyses need no running graph
+# path is one snapshot folder, or the snapshots folder (.tiramisu/snapshots) whose LATEST snapshot is read
+# the parquet files are memory-mapped; returns the nodes (with a label column) and the edges (with a type column),
+# where edges refer to nodes by their integer surrogate id
+def read_snapshot(path, labels = None, types = None, columns = None):
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+	from pathlib import Path
+
+	path = Path(path)
+	if (path / 'LATEST').exists():
+		path = path / (path / 'LATEST').read_text().strip()
+
+	def read(folder, partition, values, columns):
+		tables = []
+		for part in sorted((path / folder).glob(f"{partition}=*/*.parquet")):
+			value = part.parent.name.split("=", 1)[1]
+			if values is not None and value not in values:
+				continue
+			table = pq.read_table(part, columns = columns, memory_map = True)
+			tables.append(table.append_column(partition, pa.array([value] * table.num_rows, pa.string())))
+		if not tables:
+			return pd.DataFrame(columns = (columns or []) + [partition])
+		return pa.concat_tables(tables).to_pandas()
+
+	nodes = read('nodes', 'label', labels, None if columns is None else ['id'] + [i for i in columns if i not in ('id', 'label')])
+	edges = read('edges', 'type', types, None)
+
+	return nodes, edges
+
+
+# page nodeID -> document nodeID of every split pdf page, as map_nodeID_to_docID in the figure notebooks, from a snapshot
+def map_pages_to_documents(nodes, edges):
+	pdfs = nodes[(nodes['label'] == 'File') & (nodes['fileExtension'] == 'pdf')]
+	pdfs = pdfs[pdfs['id'].isin(edges.loc[edges['type'] == 'CONTAINS', 'target'])]
+
+	pages = edges[edges['type'] == 'SPLIT_INTO'].merge(pdfs[['id', 'originalPath']], left_on = 'source', right_on = 'id')[['target', 'originalPath']]
+	pages = pages.merge(edges[edges['type'] == 'PART_OF'][['source', 'target']], left_on = 'target', right_on = 'source', suffixes = ('', '_document'))
+
+	ids = nodes.set_index('id')
+	return pd.DataFrame({
+		'nodeID': ids.loc[pages['target'], 'nodeID'].values,
+		'page': ids.loc[pages['target'], 'page'].values,
+		'documentID': ids.loc[pages['target_document'], 'nodeID'].values,
+		'path': pages['originalPath'].values
+	})
@@ -0,0 +1,267 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+import zipfile
+from pathlib import Path
+
+
+# end-to-end throughput of the digest pipeline on a synthetic archive built from example_data:
+# start_digest (file pass and graph load), doc/docx conversion, split, classify and render, one stage after the other
+# reports files/s, pages/s, peak memory and graph-write latency per stage to a JSON file to diff between commits
+#
+# celery runs in memory in this process (every task is applied eagerly, a fan-out runs its messages one by one)
+# and redis is left out (the fan-out sizing and the task metrics fall back to process-local state)
+# neo4j has to be a throwaway server: its graph is wiped, and LOAD CSV reads <root>/.tiramisu/neo4j/import as /import
+# usage, inside the digest_worker container, with the archive under the blacklisted .tiramisu folder of the real one:
+#   docker run -d --rm --name neo4j_benchmark --network <compose network> -e NEO4J_AUTH=neo4j/$NEO4J_PASSWORD \
+#     -e NEO4J_ACCEPT_LICENSE_AGREEMENT=yes -e NEO4JLABS_PLUGINS='["apoc"]' -e NEO4J_apoc_import_file_enabled=true \
+#     -e NEO4J_dbms_security_procedures_unrestricted=apoc.* -v $TIRAMISU_ROOT/.tiramisu/benchmark/.tiramisu/neo4j/import:/import \
+#     neo4j:4.2.3-enterprise
+#   python -m digest.benchmark --neo4j-url bolt://neo4j_benchmark:7687 --example-data /tiramisu/example_data \
+#     --root /tiramisu/.tiramisu/benchmark --pdfs 100 --pages 10 --output /tiramisu/.tiramisu/benchmark_digest.json
+
+# tasks whose time is reported as graph-write latency
+GRAPH_WRITES = ["create_schema_neo4j", "write_neo4j", "add_node_neo4j", "add_nodes_batch_neo4j", "update_metadata_neo4j", "update_metadata_batch_neo4j"]
+
+# pages the split stage made, the ones classify and render work on
+PAGES = "MATCH (:File)-[:SPLIT_INTO]->(m:File) RETURN count(m) AS count"
+
+# seconds between two samples of the resident memory of this process
+SAMPLE_SECONDS = 0.05
+
+
+# writes pdfs PDFs of pages pages each, cycling through the pages of the example PDFs, into nested folders
+# (depth levels of width subfolders) with duplicates exact copies in other folders, and documents .docx files
+# every PDF and .docx gets its own title so that the digest does not collapse them as duplicates
+def build_archive(root, example_data, pdfs, pages, documents, duplicates, depth, width):
+	from pypdf import PdfReader, PdfWriter
+
+	sources = [PdfReader(str(path), strict = False) for path in sorted(Path(example_data).rglob("*.pdf"))]
+	source_pages = [page for reader in sources for page in reader.pages]
+	if len(source_pages) == 0:
+		raise SystemExit(f"{example_data} has no PDFs to build the archive from.")
+
+	def folder(i):
+		parts = [f"box_{(i // width ** level) % width}" for level in range(depth)]
+		path = Path(root).joinpath(*parts)
+		path.mkdir(parents = True, exist_ok = True)
+		return path
+
+	files = []
+	for i in range(pdfs):
+		writer = PdfWriter()
+		for j in range(pages):
+			writer.add_page(source_pages[(i * pages + j) % len(source_pages)])
+		writer.add_metadata({"/Title": f"benchmark {i}"})
+
+		path = folder(i) / f"document_{i}.pdf"
+		with open(path, "wb") as f:
+			writer.write(f)
+		files.append(path)
+
+	docx = next(Path(example_data).rglob("*.docx"), None)
+	if documents > 0 and docx is None:
+		raise SystemExit(f"{example_data} has no .docx to build the Word documents from.")
+	for i in range(documents):
+		path = folder(pdfs + i) / f"letter_{i}.docx"
+		with zipfile.ZipFile(docx) as source, zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as target:
+			for item in source.infolist():
+				target.writestr(item, source.read(item.filename))
+			target.comment = f"benchmark {i}".encode()
+		files.append(path)
+
+	for i in range(duplicates):
+		original = files[i % len(files)]
+		copy = folder(i + 1) / f"copy_{i}_{original.name}"
+		shutil.copyfile(original, copy)
+
+	return {"files": pdfs + documents + duplicates, "pdfs": pdfs, "pages": pdfs * pages, "documents": documents, "duplicates": duplicates}
+
+
+# highest resident memory of this process while the block runs, sampled from /proc
+class PeakMemory:
+
+	def __enter__(self):
+		self.peak = self.sample()
+		self.running = True
+		self.thread = threading.Thread(target = self.watch, daemon = True)
+		self.thread.start()
+		return self
+
+	def __exit__(self, *exc):
+		self.running = False
+		self.thread.join()
+		self.peak = max(self.peak, self.sample())
+
+	def watch(self):
+		while self.running:
+			self.peak = max(self.peak, self.sample())
+			time.sleep(SAMPLE_SECONDS)
+
+	@staticmethod
+	def sample():
+		try:
+			with open("/proc/self/statm") as f:
+				return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+		except OSError:
+			return 0
+
+
+# durations of the graph-write tasks run in this process, by the stage that was running
+class GraphWrites:
+
+	def __init__(self):
+		self.stage = None
+		self.started = {}
+		self.durations = {}
+
+	def connect(self):
+		from celery.signals import task_prerun, task_postrun
+		task_prerun.connect(self.prerun, weak = False)
+		task_postrun.connect(self.postrun, weak = False)
+
+	def prerun(self, task_id = None, task = None, **kwargs):
+		if task.name in GRAPH_WRITES:
+			self.started[task_id] = time.perf_counter()
+
+	def postrun(self, task_id = None, **kwargs):
+		start = self.started.pop(task_id, None)
+		if start is not None:
+			self.durations.setdefault(self.stage, []).append(time.perf_counter() - start)
+
+	def summary(self, stage):
+		durations = sorted(self.durations.get(stage, []))
+		if len(durations) == 0:
+			return {"count": 0, "seconds": 0.0, "mean_ms": None, "p50_ms": None, "max_ms": None}
+		return {
+			"count": len(durations),
+			"seconds": round(sum(durations), 3),
+			"mean_ms": round(1000 * sum(durations) / len(durations), 3),
+			"p50_ms": round(1000 * durations[len(durations) // 2], 3),
+			"max_ms": round(1000 * durations[-1], 3),
+		}
+
+
+def count(query):
+	from neo4j_tasks.main import app as neo4j_worker
+
+	rows = neo4j_worker.tasks['query_neo4j'].apply(kwargs = {"query": query, "cache": False}).get()
+	return rows[0]['count'] if rows else 0
+
+
+def commit():
+	try:
+		return subprocess.run(["git", "rev-parse", "HEAD"], cwd = Path(__file__).parent, capture_output = True, text = True, check = True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def main():
+	parser = argparse.ArgumentParser(description = "files/s, pages/s, peak memory and graph-write latency of every digest stage on a synthetic archive")
+	parser.add_argument('--neo4j-url', required = True, help = "bolt URL of a throwaway neo4j; its graph is wiped")
+	parser.add_argument('--root', default = '/tiramisu/.tiramisu/benchmark', help = "folder the archive is built in; emptied first")
+	parser.add_argument('--example-data', default = str(Path(__file__).resolve().parents[3] / 'example_data'))
+	parser.add_argument('--pdfs', type = int, default = 20)
+	parser.add_argument('--pages', type = int, default = 5)
+	parser.add_argument('--documents', type = int, default = 0, help = "Word documents, converted with LibreOffice")
+	parser.add_argument('--duplicates', type = int, default = 5)
+	parser.add_argument('--depth', type = int, default = 2)
+	parser.add_argument('--width', type = int, default = 4)
+	parser.add_argument('--threads', type = int, default = 0)
+	parser.add_argument('--virtual', action = 'store_true', help = "split into virtual pages")
+	parser.add_argument('--output', default = None)
+	args = parser.parse_args()
+
+	# read when the celery apps, the workspace and the neo4j tasks are imported below
+	os.environ["CELERY_BROKER_URL"] = "memory://"
+	os.environ["CELERY_RESULT_BACKEND"] = "cache+memory://"
+	os.environ["TIRAMISU_CONFIG_FILENAME"] = args.root
+	os.environ["NEO4J_URL"] = args.neo4j_url
+
+	import tiramisu_digest
+	from celery import current_app
+	from digest.main import app as digest_worker
+	from neo4j_tasks.main import app as neo4j_worker
+	from digest.tasks.initial import load_actions
+	from digest.tasks.convert import doc_to_pdf_supervisor, docx_to_pdf_supervisor, split_pdfs_supervisor, find_pdf_type_supervisor, pdf_to_image_supervisor
+	from digest.tasks.office import open_pool, close_pool
+
+	for app in [current_app, digest_worker, neo4j_worker]:
+		app.conf.task_always_eager = True
+		app.conf.task_eager_propagates = True
+
+	if Path(args.root).exists():
+		shutil.rmtree(args.root)
+	Path(args.root).mkdir(parents = True)
+	archive = build_archive(args.root, args.example_data, args.pdfs, args.pages, args.documents, args.duplicates, args.depth, args.width)
+
+	neo4j_worker.tasks['write_neo4j'].apply(kwargs = {"query": "CALL apoc.periodic.iterate('MATCH (n) RETURN n', 'DETACH DELETE n', {batchSize: 10000})"}).get()
+
+	writes = GraphWrites()
+	writes.connect()
+
+	# the digest writes the CSVs for the load chain as start_digest does, which then runs here instead of through flask
+	def start_digest():
+		(Path(args.root) / '.tiramisu' / 'neo4j' / 'import').mkdir(parents = True, exist_ok = True)
+		tiramisu_digest.digest(args.root, ['.tiramisu'], True, args.threads, False, False, False)
+		for action in load_actions():
+			neo4j_worker.tasks[action['action']].apply(kwargs = action['kwargs']).get()
+
+	def convert_documents():
+		open_pool()
+		try:
+			doc_to_pdf_supervisor.apply().get()
+			docx_to_pdf_supervisor.apply().get()
+		finally:
+			close_pool()
+
+	# name, stage, files it works on and the query counting the pages it works on, if any
+	stages = [
+		("start_digest", start_digest, archive["files"], None),
+		("split", lambda: split_pdfs_supervisor.apply(kwargs = {"virtual": args.virtual}).get(), archive["pdfs"] + archive["documents"], PAGES),
+		("classify", lambda: find_pdf_type_supervisor.apply().get(), archive["pdfs"] + archive["documents"], PAGES),
+		("render", lambda: pdf_to_image_supervisor.apply().get(), archive["pdfs"] + archive["documents"], PAGES),
+	]
+	if args.documents > 0:
+		stages.insert(1, ("convert_documents", convert_documents, archive["documents"], None))
+
+	results = {}
+	for name, stage, files, pages in stages:
+		writes.stage = name
+		with PeakMemory() as memory:
+			start = time.perf_counter()
+			stage()
+			seconds = time.perf_counter() - start
+		writes.stage = None
+
+		pages = count(pages) if pages is not None else None
+		results[name] = {
+			"seconds": round(seconds, 3),
+			"files": files,
+			"files_per_second": round(files / seconds, 3) if seconds else None,
+			"pages": pages,
+			"pages_per_second": round(pages / seconds, 3) if pages and seconds else None,
+			"peak_rss_bytes": memory.peak,
+			"graph_writes": writes.summary(name),
+		}
+
+	report = {
+		"commit": commit(),
+		"archive": {**archive, "depth": args.depth, "width": args.width, "virtual": args.virtual},
+		"nodes": count("MATCH (n) RETURN count(n) AS count"),
+		"total_seconds": round(sum(stage["seconds"] for stage in results.values()), 3),
+		"stages": results,
+	}
+	print(json.dumps(report, indent = 2, sort_keys = True))
+
+	if args.output is not None:
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent = 2, sort_keys = True)
+
+
+if __name__ == '__main__':
+	main()
@@ -1,10 +1,15 @@
 from tiramisu.internal import ClassHolder
+import tiramisu.queues
+import tiramisu.metrics
 
 import celery
+from celery.signals import worker_process_init, worker_process_shutdown
 
 
 from digest.tasks.initial import digest
 from digest.tasks.convert import pdf_to_image_supervisor, doc_to_pdf_supervisor, docx_to_pdf_supervisor, split_pdfs_supervisor
+from digest.tasks.fanout import configure_fanout, fanout_stats
+from digest.tasks.office import open_pool, close_pool
 
 # create celery app
 app = celery.Celery()
@@ -17,5 +22,15 @@ app.conf.task_routes = {
 } # update worker queue
 
 
+# one pool of persistent LibreOffice listeners per worker process
+@worker_process_init.connect
+def init_office_pool(**kwargs):
+    open_pool()
+
+@worker_process_shutdown.connect
+def shutdown_office_pool(**kwargs):
+    close_pool()
+
+
 if __name__ == '__main__':
     app.worker_main()
\ No newline at end of file
@@ -1,17 +1,18 @@
-from celery import signature, shared_task, states
-from celery.result import allow_join_result
+from celery import signature, shared_task, group, chain
 
 from pathlib import Path
-from tiramisu.utils import tiramisu_update, TiramisuException, check_status
-from tiramisu.internal import group_elements
+from tiramisu.utils import tiramisu_update, generate_page_id, TiramisuException
+from digest.tasks.office import convert_to_pdf
+from digest.tasks.fanout import fan_out
+from tiramisu.claims import claim, resolve
 import importlib
+import logging
 import sys
-import time 
 sys.path.append('')
 import traceback
 
+logger = logging.getLogger(__name__)
 
-import subprocess
 
 
 ## split PDF, find scanned/electronic PDFs, convert PDFS to images (all), do selective OCR
@@ -41,137 +42,215 @@ def page_type(page):
 		page_type = "Digitally created"
 	return page_type
 
-@shared_task(name = "pdf_to_image_supervisor_digest")
-def pdf_to_image_supervisor():
+# number of nodes written per add_nodes_batch_neo4j transaction
+NODE_BATCH_SIZE = 1000
+
+# index of a page inside the file at tiramisuPath
+# split pages are single-page files, virtual pages point into their parent PDF
+def page_index(page):
+	return page['page'] if page['virtual'] else 0
+
+# row format understood by add_nodes_batch_neo4j
+def node_row(nodeID, label, parentID, relationship, attributes = None):
+	return [nodeID, label, parentID, relationship, attributes]
+
+# property set to true on the input nodes of a stage once their output is in the graph
+# the supervisors select only nodes without it (and without the output edges written before markers existed),
+# so rerunning a stage after a crash only processes what is left; find_pdf_type is marked by its scanned property
+STAGE_MARKERS = {
+	"split_pdfs": "splitPdfsDone",
+	"pdf_to_image": "pdfToImageDone",
+	"process_pdf": "processPdfDone",
+	"doc_to_pdf": "docToPdfDone",
+	"docx_to_pdf": "docxToPdfDone",
+}
+
+# the {"done", "rows"} units of the run_batch messages of a fan-out
+# failed messages return a traceback string instead of a list of units and are skipped
+def completed_units(results):
+	for result in results:
+		result = resolve(result)
+		if isinstance(result, list):
+			yield from (unit for unit in result if isinstance(unit, dict))
+
+# chord callback that flushes the node rows returned by a fan-out in batches
+# the rows of one input never span two batches, and its stage marker is set in the transaction that writes them,
+# so a node is either marked with all of its output written or picked up again by the next run
+@shared_task(bind = True, name = "write_nodes_digest")
+def write_nodes(self, results, stage = None):
+	from neo4j_tasks.main import app as neo4j_worker
+
+	marker = STAGE_MARKERS.get(stage)
+	batches = []
+	rows, done = [], []
+	for unit in completed_units(results):
+		if len(rows) > 0 and len(rows) + len(unit['rows']) > NODE_BATCH_SIZE:
+			batches.append((rows, done))
+			rows, done = [], []
+		rows.extend(unit['rows'])
+		done.extend(unit['done'])
+	if len(rows) > 0 or (marker is not None and len(done) > 0):
+		batches.append((rows, done))
+
+	if len(batches) == 0:
+		return
+	# batches are written in order because a row may point at a parent created by an earlier row
+	return self.replace(chain(
+		neo4j_worker.tasks['add_nodes_batch_neo4j'].si(claim(rows), markers = None if marker is None else claim([[nodeID, {marker: True}] for nodeID in done]))
+		for rows, done in batches))
+
+# chord callback that writes the [nodeID, attributes] updates returned by a fan-out in batches
+@shared_task(bind = True, name = "write_metadata_digest")
+def write_metadata(self, results):
+	from neo4j_tasks.main import app as neo4j_worker
+
+	rows = []
+	for unit in completed_units(results):
+		rows.extend(unit['rows'])
+
+	if len(rows) == 0:
+		return
+	batches = [rows[i:i + NODE_BATCH_SIZE] for i in range(0, len(rows), NODE_BATCH_SIZE)]
+	return self.replace(group(neo4j_worker.tasks['update_metadata_batch_neo4j'].si(claim(batch)) for batch in batches))
+
+# saves the rendered page into its own tiramisu version folder and returns its CONVERT_TO node row
+def save_page_image(context, filename, entry, pix):
+	with context.one_to_one(filename) as p:
+		if entry['virtual']:
+			# virtual pages share their parent path, so the page node keeps the image IDs apart
+			p = tiramisu_update(context, p, data = (entry['nodeID'], pix.samples_mv))
+			image_name = f"{Path(p.parent).stem}_page_{entry['page']}.png"
+		else:
+			p = tiramisu_update(context, p, data = pix.samples_mv)
+			image_name = f"{Path(p.parent).stem}.png"
+		nodeID = p.child.name
+		p.child = (Path(p.child) / image_name)
+
+		pix.save(p.child)
+		return node_row(str(nodeID), "File", entry['nodeID'], 'CONVERT_TO', {"name": image_name, "tiramisuPath": (p.child).as_posix(), "fileExtension":'png',  'page': str(entry['page'])})
+
+# saves the embedded text layer of a virtual page and returns its CONVERT_TO node row
+def save_page_text(context, filename, entry, text):
+	with context.one_to_one(filename) as p:
+		p = tiramisu_update(context, p, data = (entry['nodeID'], text))
+		text_name = f"{Path(p.parent).stem}_page_{entry['page']}.txt"
+		nodeID = p.child.name
+		p.child = (Path(p.child) / text_name)
+
+		with open(p.child, "w", encoding = "utf-8") as f:
+			f.write(text)
+		return node_row(str(nodeID), "File", entry['nodeID'], 'CONVERT_TO', {"name": text_name, "tiramisuPath": (p.child).as_posix(), "fileExtension":'txt',  'page': str(entry['page'])})
+
+# chunk_size and target_seconds size the fan-out of this run (see fanout.py)
+@shared_task(bind = True, name = "pdf_to_image_supervisor_digest")
+def pdf_to_image_supervisor(self, chunk_size = None, target_seconds = None):
+	# pages are grouped by the file that holds them so that a PDF with virtual pages is opened once
+	# pages that already have their image are skipped
 	query = """
 	MATCH (n:File) - [:SPLIT_INTO] -> (m: File)
-	WHERE m.fileExtension = "pdf"
-	WITH collect(distinct m) as nodes
-	UNWIND nodes as node
-	return node.nodeID as nodeID, node.tiramisuPath as path, node.page as page
+	WHERE m.fileExtension = "pdf" AND m.pdfToImageDone IS NULL AND NOT (m) - [:CONVERT_TO] -> (:File {fileExtension: "png"})
+	WITH m.tiramisuPath as path, collect(distinct {nodeID: m.nodeID, page: m.page, virtual: coalesce(m.virtual, false)}) as pages
+	return path, pages
 	"""
 
 	from neo4j_tasks.main import app as neo4j_worker
 
 
-	ret = (neo4j_worker.tasks["query_neo4j"].s(query) | ( pdf_to_image_chunk.s())).apply_async()
-
-	while not ret.ready():
-		time.sleep(1)
-	with allow_join_result():
-		return ret.get(disable_sync_subtasks = True)
+	# the supervisor is replaced by the query -> fan-out chain and keeps its task ID,
+	# so it finishes when the last page is written without holding a worker slot
+	return self.replace(neo4j_worker.tasks["query_neo4j"].s(query, claim_result = True) | pdf_to_image_chunk.s(chunk_size = chunk_size, target_seconds = target_seconds))
 
-@shared_task(name = "pdf_to_image_chunk_digest")
-def pdf_to_image_chunk(queryrows):
+@shared_task(bind = True, name = "pdf_to_image_chunk_digest")
+def pdf_to_image_chunk(self, queryrows, chunk_size = None, target_seconds = None):
+	queryrows = resolve(queryrows)
 	if len(queryrows) == 0:
 		return 
-	ret = pdf_to_image.chunks(zip(queryrows),  1).apply_async(queue = "digest_worker")
-
-	while not ret.ready():
-		time.sleep(1)
-	with allow_join_result():
-		return ret.get(disable_sync_subtasks = True)
+	return self.replace(fan_out(pdf_to_image, queryrows, chunk_size, target_seconds) | write_nodes.s(stage = "pdf_to_image"))
 
-@shared_task(name = "pdf_to_image_digest")
-def pdf_to_image(queryrows):
+# renders every page listed for one file
+# returns the node rows to be written by write_nodes
+@shared_task(bind = True, name = "pdf_to_image_digest")
+def pdf_to_image(self, queryrows):
 
 	import fitz
-	from neo4j_tasks.main import app as neo4j_worker
 
 	actions_module = importlib.import_module('tiramisu.worker') 
 	workspace = actions_module.workspace
 
+	rows = []
 	try:
 		filename = queryrows['path']
 		with workspace.createContext() as context:
 			if not Path(filename).is_file():
-				print(f"{filename} was not a file.")
+				logger.warning(f"{filename} was not a file.")
 			else:
-				with context.one_to_one(filename) as p:
-					mat = fitz.Matrix(300 / 72, 300 / 72) #300 DPI
-					doc = fitz.open(p.parent)
-					page = doc.load_page(0)  # number of page
+				mat = fitz.Matrix(300 / 72, 300 / 72) #300 DPI
+				doc = fitz.open(filename)
+				for entry in queryrows['pages']:
+					page = doc.load_page(page_index(entry))  # number of page
 					pix = page.get_pixmap(matrix = mat)
 
-					p = tiramisu_update(context, p, data = pix)
-					nodeID = p.child.name
-					p.child = (Path(p.child) / f"{Path(p.parent).stem}.png")
-
-
-					page = queryrows['page']
-
-					pix.save(p.child)
-					ret = neo4j_worker.tasks['add_node_neo4j'].s(nodeID = str(nodeID), label = "File", parentID = queryrows['nodeID'], relationship =  'CONVERT_TO', attributes = {"name":Path(filename).stem + ".png", "tiramisuPath": (p.child).as_posix(), "fileExtension":'png',  'page': str(page)}).apply_async()
+					rows.append(save_page_image(context, filename, entry, pix))
+				doc.close()
 
-					while not ret.ready():
-						time.sleep(1)
-		with allow_join_result():
-			return ret.get(disable_sync_subtasks = True)
-
-	except Exception as ex:
-		# raise Ignore()
-		pdf_to_image.update_state(
-		state=states.FAILURE,
-		meta={
-			'exc_type': type(ex).__name__,
-			'exc_message': traceback.format_exc().split('\n')
-		})
-		# raise ex
+	# the traceback is the result of this row: run_batch leaves it out of the units and the input is picked up again next run
+	except Exception:
+		logger.exception(f"{self.name} failed on {queryrows.get('nodeID')}")
 		return traceback.format_exc()
 
-@shared_task(name ="split_pdfs_supervisor_digest")
-def split_pdfs_supervisor():
+	return rows
+
+# virtual = True creates page nodes that point into their PDF instead of writing one file per page
+@shared_task(bind = True, name ="split_pdfs_supervisor_digest")
+def split_pdfs_supervisor(self, virtual = False, chunk_size = None, target_seconds = None):
 
+	# PDFs that are already split are skipped
 	query = """
 MATCH (n:Folder) - [:CONTAINS] -> (m:File)  
-	WHERE m.fileExtension = "pdf" 
+	WHERE m.fileExtension = "pdf" AND m.splitPdfsDone IS NULL AND NOT (m) - [:SPLIT_INTO] -> ()
 	return m.nodeID as nodeID, m.tiramisuPath as path
 	UNION 
 	match (c:Folder) - [:CONTAINS] -> (d:File) - [:CONVERT_TO] -> (e:File)  
-	where e.fileExtension = "pdf"  
+	where e.fileExtension = "pdf" AND e.splitPdfsDone IS NULL AND NOT (e) - [:SPLIT_INTO] -> ()
 	return e.nodeID as nodeID, e.tiramisuPath as path  
 	"""
 
 	from neo4j_tasks.main import app as neo4j_worker
 
-	ret = (neo4j_worker.tasks['query_neo4j'].s(query) | ( split_pdfs_chunk.s())).apply_async()
-
-	while not ret.ready():
-		time.sleep(1)
-	
-
-	with allow_join_result():
-		return ret.get(disable_sync_subtasks = True)
+	return self.replace(neo4j_worker.tasks['query_neo4j'].s(query, claim_result = True) | split_pdfs_chunk.s(virtual = virtual, chunk_size = chunk_size, target_seconds = target_seconds))
 
 
-@shared_task(name = 'split_pdfs_chunk_digest')
-def split_pdfs_chunk(queryrows):
+@shared_task(bind = True, name = 'split_pdfs_chunk_digest')
+def split_pdfs_chunk(self, queryrows, virtual = False, chunk_size = None, target_seconds = None):
+	queryrows = resolve(queryrows)
 
 	if len(queryrows) == 0:
 		return 
-	ret = split_pdfs.chunks(zip(queryrows), 1).apply_async(queue = 'digest_worker')
-
-	while not ret.ready():
-		time.sleep(1)
-
-	with allow_join_result():
-		return ret.get(disable_sync_subtasks = True)
+	return self.replace(fan_out(split_pdfs, queryrows, chunk_size, target_seconds, virtual = virtual) | write_nodes.s(stage = "split_pdfs"))
 	
-@shared_task(name = "split_pdfs_digest")
-def split_pdfs(queryrows):
+# returns the node rows to be written by write_nodes
+@shared_task(bind = True, name = "split_pdfs_digest")
+def split_pdfs(self, queryrows, virtual = False):
 
 	from pypdf import PdfReader, PdfWriter
-	from neo4j_tasks.main import app as neo4j_worker
 	import io
 	actions_module = importlib.import_module('tiramisu.worker') 
 	workspace = actions_module.workspace
 
+	rows = []
 	try:
 		filename = queryrows['path']
 
 		with workspace.createContext() as context:
 			if not Path(filename).is_file():
-				print(f"{filename} was not a file.")
+				logger.warning(f"{filename} was not a file.")
+			elif virtual:
+				# page nodes reference the parent file and a page index; nothing is written to disk
+				with open(filename, "rb") as f:
+					page_count = len(PdfReader(f, strict = False).pages)
+
+				for i in range(page_count):
+					rows.append(node_row(generate_page_id(queryrows['nodeID'], i), "File", queryrows['nodeID'], 'SPLIT_INTO', {"name":Path(filename).stem + f"_page_{i}.pdf" , "tiramisuPath": filename,  "fileExtension":'pdf',  'page': i, 'virtual': True}))
 			else:
 				with context.one_to_many(filename) as p:
 
@@ -183,183 +262,179 @@ def split_pdfs(queryrows):
 						response_bytes_stream = io.BytesIO()
 						output.write(response_bytes_stream)
 
-						p = tiramisu_update(context, p, data = response_bytes_stream.getvalue() )
+						p = tiramisu_update(context, p, data = response_bytes_stream.getbuffer())
 
+						# the page is serialized once and the same bytes are hashed and saved
 						new_pdf_path = (Path(p.child) / f"{Path(p.parent).stem}_page_{i}.pdf").as_posix()
 						with open(new_pdf_path, "wb") as outputStream:
-							output.write(outputStream)
-
-						ret1 = neo4j_worker.tasks['add_node_neo4j'].s(nodeID = str(Path(p.child).name), label = "File", parentID = queryrows['nodeID'], relationship =  'SPLIT_INTO', attributes = {"name":Path(filename).stem + f"_page_{i}.pdf" , "tiramisuPath": new_pdf_path,  "fileExtension":'pdf',  'page': i}).apply_async()
+							outputStream.write(response_bytes_stream.getbuffer())
 
-						while not ret1.ready():
-							time.sleep(1)
-
-				with allow_join_result():
-					_ = ret1.get(disable_sync_subtasks = True)
-				return new_pdf_path
+						rows.append(node_row(str(Path(p.child).name), "File", queryrows['nodeID'], 'SPLIT_INTO', {"name":Path(filename).stem + f"_page_{i}.pdf" , "tiramisuPath": new_pdf_path,  "fileExtension":'pdf',  'page': i}))
 	
 
-	except Exception as ex:
-		split_pdfs.update_state(
-		state=states.FAILURE,
-		meta={
-			'exc_type': type(ex).__name__,
-			'exc_message': traceback.format_exc().split('\n')
-		})
-		# raise ex
+	# the traceback is the result of this row: run_batch leaves it out of the units and the input is picked up again next run
+	except Exception:
+		logger.exception(f"{self.name} failed on {queryrows.get('nodeID')}")
 		return traceback.format_exc()
 
+	return rows
 
 
-@shared_task(name ="find_pdf_type_digest" )
-def find_pdf_type(queryrows):
 
+# classifies every page listed for one file
+# returns the [nodeID, attributes] updates to be written by write_metadata
+@shared_task(bind = True, name ="find_pdf_type_digest" )
+def find_pdf_type(self, queryrows):
 
-	import numpy as np 
 	import fitz
-	from neo4j_tasks.main import app as neo4j_worker
 
-	name = Path(queryrows['path']).stem
-
-
-	file = fitz.open(queryrows['path'])
-
-	page0 = file[0]
-	type_page = page_type(page0)
-
-	if type_page == 'Scanned':
-		ret = signature(neo4j_worker.tasks['update_metadata_neo4j'], kwargs = {"nodeID": queryrows['nodeID'], "attributes": {"scanned": True}}).delay()
-
-		while not ret.ready():
-			time.sleep(1)
-
-		with allow_join_result():
-			return ret.get(disable_sync_subtasks = True)
-	elif type_page == 'Searchable text':
-		ret = signature(neo4j_worker.tasks['update_metadata_neo4j'], kwargs = {"nodeID": queryrows['nodeID'], "attributes": {"scanned": True}}).delay()
+	rows = []
+	try:
+		file = fitz.open(queryrows['path'])
 
-		while not ret.ready():
-			time.sleep(1)
+		for entry in queryrows['pages']:
+			type_page = page_type(file[page_index(entry)])
 
-		with allow_join_result():
-			return ret.get(disable_sync_subtasks = True)
-	else:
-		ret = signature(neo4j_worker.tasks['update_metadata_neo4j'], kwargs = {"nodeID": queryrows['nodeID'], "attributes": {"scanned": False}}).delay()
+			# scanned and searchable pages both need OCR
+			rows.append([entry['nodeID'], {"scanned": type_page != 'Digitally created'}])
+		file.close()
 
-		while not ret.ready():
-			time.sleep(1)
+	# the traceback is the result of this row: run_batch leaves it out of the units and the input is picked up again next run
+	except Exception:
+		logger.exception(f"{self.name} failed on {queryrows.get('nodeID')}")
+		return traceback.format_exc()
 
-		with allow_join_result():
-			return ret.get(disable_sync_subtasks = True)
+	return rows
 
 
-@shared_task(name ="find_pdf_type_supervisor_digest")
-def find_pdf_type_supervisor():
+@shared_task(bind = True, name ="find_pdf_type_supervisor_digest")
+def find_pdf_type_supervisor(self, chunk_size = None, target_seconds = None):
 
+	# pages are grouped by the file that holds them so that a PDF with virtual pages is opened once
+	# pages that are already classified are skipped
 	query = """
 	MATCH (n:File) - [:SPLIT_INTO] -> (m: File)
-	WHERE m.fileExtension = "pdf"
-	return m.nodeID as nodeID, m.tiramisuPath as path
+	WHERE m.fileExtension = "pdf" AND m.scanned IS NULL
+	WITH m.tiramisuPath as path, collect(distinct {nodeID: m.nodeID, page: m.page, virtual: coalesce(m.virtual, false)}) as pages
+	return path, pages
 	"""
 	from neo4j_tasks.main import app as neo4j_worker
 
-	ret = (neo4j_worker.tasks['query_neo4j'].s(query,) | (find_pdf_type_chunk.s())).apply_async()
-
-	while not ret.ready():
-		time.sleep(1)
+	return self.replace(neo4j_worker.tasks['query_neo4j'].s(query, claim_result = True) | find_pdf_type_chunk.s(chunk_size = chunk_size, target_seconds = target_seconds))
 
+@shared_task(bind = True, name="find_pdf_type_chunk_digest")
+def find_pdf_type_chunk(self, queryrows, chunk_size = None, target_seconds = None):
+	queryrows = resolve(queryrows)
 
-	with allow_join_result():
-		return ret.get(disable_sync_subtasks = True)
-
-@shared_task(name="find_pdf_type_chunk_digest")
-def find_pdf_type_chunk(queryrows):
-
-	ret = find_pdf_type.chunks(zip(queryrows), 1).apply_async(queue = "digest_worker")
-
-	while not ret.ready():
-		time.sleep(1)
+	if len(queryrows) == 0:
+		return 
+	return self.replace(fan_out(find_pdf_type, queryrows, chunk_size, target_seconds) | write_metadata.s())
 
-	with allow_join_result():
-		return ret.get(disable_sync_subtasks = True)
 
 
+# single pass over every PDF: virtual page nodes, scanned classification, page images and text layers
+# replaces split_pdfs(virtual = True), find_pdf_type and pdf_to_image for documents that are processed for the first time
+@shared_task(bind = True, name = "process_pdf_supervisor_digest")
+def process_pdf_supervisor(self, dpi = 300, chunk_size = None, target_seconds = None):
 
-@shared_task(name = "doc_to_pdf_supervisor_digest")
-def doc_to_pdf_supervisor():
+	# PDFs that already have pages, from this or from split_pdfs, are skipped
 	query = """
-	MATCH (n:Folder) - [:CONTAINS] -> (m: File)
-	WHERE m.fileExtension = "doc"
+MATCH (n:Folder) - [:CONTAINS] -> (m:File)  
+	WHERE m.fileExtension = "pdf" AND m.processPdfDone IS NULL AND NOT (m) - [:SPLIT_INTO] -> ()
 	return m.nodeID as nodeID, m.tiramisuPath as path
+	UNION 
+	match (c:Folder) - [:CONTAINS] -> (d:File) - [:CONVERT_TO] -> (e:File)  
+	where e.fileExtension = "pdf" AND e.processPdfDone IS NULL AND NOT (e) - [:SPLIT_INTO] -> ()
+	return e.nodeID as nodeID, e.tiramisuPath as path  
 	"""
+
 	from neo4j_tasks.main import app as neo4j_worker
 
-	ret = (neo4j_worker.tasks["query_neo4j"].s(query) | ( doc_to_pdf_chunk.s())).apply_async()
+	return self.replace(neo4j_worker.tasks['query_neo4j'].s(query, claim_result = True) | process_pdf_chunk.s(dpi = dpi, chunk_size = chunk_size, target_seconds = target_seconds))
 
-	while not ret.ready():
-		time.sleep(1)
+@shared_task(bind = True, name = "process_pdf_chunk_digest")
+def process_pdf_chunk(self, queryrows, dpi = 300, chunk_size = None, target_seconds = None):
+	queryrows = resolve(queryrows)
 
-	with allow_join_result():
-		return ret.get(disable_sync_subtasks = True)
+	if len(queryrows) == 0:
+		return 
+	return self.replace(fan_out(process_pdf, queryrows, chunk_size, target_seconds, dpi = dpi) | write_nodes.s(stage = "process_pdf"))
 
-@shared_task(name = "doc_to_pdf_chunk_digest")
-def doc_to_pdf_chunk(queryrows):
-	from neo4j_tasks.main import app as neo4j_worker
+# opens the PDF once and, for each page, classifies it, renders it and extracts its text layer if it was digitally created
+# returns the node rows to be written by write_nodes
+@shared_task(bind = True, name = "process_pdf_digest")
+def process_pdf(self, queryrows, dpi = 300):
+
+	import fitz
 
 	actions_module = importlib.import_module('tiramisu.worker') 
 	workspace = actions_module.workspace
 
-	if len(queryrows) == 0:
-		return 
-	for row in queryrows:
-
-		try:
-			filename = row['path']
-			with workspace.createContext() as context:
-				if not Path(filename).is_file():
-					print(f"{filename} was not a file.")
-				else:
-					with context.one_to_one(filename) as p:
+	rows = []
+	try:
+		filename = queryrows['path']
+		with workspace.createContext() as context:
+			if not Path(filename).is_file():
+				logger.warning(f"{filename} was not a file.")
+			else:
+				mat = fitz.Matrix(dpi / 72, dpi / 72)
+				doc = fitz.open(filename)
+				for i, page in enumerate(doc):
+					entry = {"nodeID": generate_page_id(queryrows['nodeID'], i), "page": i, "virtual": True}
+					type_page = page_type(page)
 
-						p.child =  p.parent.stem + '.doc'
+					rows.append(node_row(entry['nodeID'], "File", queryrows['nodeID'], 'SPLIT_INTO', {"name":Path(filename).stem + f"_page_{i}.pdf" , "tiramisuPath": filename,  "fileExtension":'pdf',  'page': i, 'virtual': True, 'scanned': type_page != 'Digitally created'}))
 
-						p = tiramisu_update(context, p)
+					rows.append(save_page_image(context, filename, entry, page.get_pixmap(matrix = mat)))
 
-						subprocess.call(['libreoffice', '--headless', '--convert-to', 'pdf', '--outdir', str(p.child), filename ])
+					if type_page == 'Digitally created':
+						rows.append(save_page_text(context, filename, entry, page.get_text()))
+				doc.close()
 
-						ret1 = neo4j_worker.tasks['add_node_neo4j'].s(nodeID = str(p.child.name), label = "File", parentID = row['nodeID'], relationship =  'CONVERT_TO', attributes = {"name":Path(filename).stem + ".pdf", "tiramisuPath": (p.child / (Path(filename).stem + ".pdf" )).as_posix(), "fileExtension":'pdf'}).apply_async()
+	# the traceback is the result of this row: run_batch leaves it out of the units and the input is picked up again next run
+	except Exception:
+		logger.exception(f"{self.name} failed on {queryrows.get('nodeID')}")
+		return traceback.format_exc()
 
+	return rows
 
-					while not ret1.ready():
-						time.sleep(1)
 
+# chunk_size and target_seconds size the fan-out of this run (see fanout.py)
+@shared_task(bind = True, name = "doc_to_pdf_supervisor_digest")
+def doc_to_pdf_supervisor(self, chunk_size = None, target_seconds = None):
+	# documents that are already converted are skipped
+	query = """
+	MATCH (n:Folder) - [:CONTAINS] -> (m: File)
+	WHERE m.fileExtension = "doc" AND m.docToPdfDone IS NULL AND NOT (m) - [:CONVERT_TO] -> (:File {fileExtension: "pdf"})
+	return m.nodeID as nodeID, m.tiramisuPath as path
+	"""
+	from neo4j_tasks.main import app as neo4j_worker
 
+	return self.replace(neo4j_worker.tasks["query_neo4j"].s(query, claim_result = True) | doc_to_pdf_chunk.s(chunk_size = chunk_size, target_seconds = target_seconds))
 
-		except Exception as ex:
-			print(traceback.format_exc())
-			# raise Ignore()
-			doc_to_pdf.update_state(
-			state=states.FAILURE,
-			meta={
-				'exc_type': type(ex).__name__,
-				'exc_message': traceback.format_exc().split('\n')
-			})
-			# raise ex
-			return traceback.format_exc()
-	with allow_join_result():
-		return ret1.get(disable_sync_subtasks = True)
+# documents are spread over the digest workers and their LibreOffice listeners like the PDF stages
+# a failed document returns its traceback from its run_batch row and is left unmarked for the next run,
+# while the ones converted around it are still written
+@shared_task(bind = True, name = "doc_to_pdf_chunk_digest")
+def doc_to_pdf_chunk(self, queryrows, chunk_size = None, target_seconds = None):
+	queryrows = resolve(queryrows)
 
-@shared_task(name = "doc_to_pdf_digest")
-def doc_to_pdf(queryrows):
-	from neo4j_tasks.main import app as neo4j_worker
+	if len(queryrows) == 0:
+		return 
+	return self.replace(fan_out(doc_to_pdf, queryrows, chunk_size, target_seconds) | write_nodes.s(stage = "doc_to_pdf"))
 
+# converts one .doc and returns the node row of its PDF for write_nodes
+@shared_task(bind = True, name = "doc_to_pdf_digest")
+def doc_to_pdf(self, queryrows):
 	actions_module = importlib.import_module('tiramisu.worker') 
 	workspace = actions_module.workspace
+
+	rows = []
 	try:
 		filename = queryrows['path']
 		with workspace.createContext() as context:
 			if not Path(filename).is_file():
-				print(f"{filename} was not a file.")
+				logger.warning(f"{filename} was not a file.")
 			else:
 				with context.one_to_one(filename) as p:
 
@@ -367,128 +442,66 @@ def doc_to_pdf(queryrows):
 
 					p = tiramisu_update(context, p)
 
-					subprocess.call(['libreoffice', '--headless',  '--convert-to', 'pdf', '--outdir', str(p.child), filename ])
-
-					while not p.child.exists():
-						time.sleep(1)
-					ret1 = neo4j_worker.tasks['add_node_neo4j'].s(nodeID = str(p.child.name), label = "File", parentID = queryrows['nodeID'], relationship =  'CONVERT_TO', attributes = {"name":Path(filename).stem + ".pdf", "tiramisuPath": (p.child / (Path(filename).stem + ".pdf" )).as_posix(), "fileExtension":'pdf'}).apply_async()
-					
-
-				while not ret1.ready():
-					time.sleep(1)
-
-		with allow_join_result():
-			return ret1.get(disable_sync_subtasks = True)
-
-	except Exception as ex:
-		print(traceback.format_exc())
-		# raise Ignore()
-		doc_to_pdf.update_state(
-		state=states.FAILURE,
-		meta={
-			'exc_type': type(ex).__name__,
-			'exc_message': traceback.format_exc().split('\n')
-		})
-		# raise ex
+					convert_to_pdf(filename, p.child)
+
+					rows.append(node_row(str(p.child.name), "File", queryrows['nodeID'], 'CONVERT_TO', {"name":Path(filename).stem + ".pdf", "tiramisuPath": (p.child / (Path(filename).stem + ".pdf" )).as_posix(), "fileExtension":'pdf'}))
+
+	# the traceback is the result of this row: run_batch leaves it out of the units and the input is picked up again next run
+	except Exception:
+		logger.exception(f"{self.name} failed on {queryrows.get('nodeID')}")
 		return traceback.format_exc()
 
+	return rows
 
-@shared_task(name = "docx_to_pdf_supervisor_digest")
-def docx_to_pdf_supervisor():
+
+# chunk_size and target_seconds size the fan-out of this run (see fanout.py)
+@shared_task(bind = True, name = "docx_to_pdf_supervisor_digest")
+def docx_to_pdf_supervisor(self, chunk_size = None, target_seconds = None):
+	# documents that are already converted are skipped
 	query = """
 	MATCH (n:Folder) - [:CONTAINS] -> (m: File)
-	WHERE m.fileExtension = "docx"
+	WHERE m.fileExtension = "docx" AND m.docxToPdfDone IS NULL AND NOT (m) - [:CONVERT_TO] -> (:File {fileExtension: "pdf"})
 	return m.nodeID as nodeID, m.tiramisuPath as path
 	"""
 	from neo4j_tasks.main import app as neo4j_worker
 
-	ret = (neo4j_worker.tasks["query_neo4j"].s(query) | ( docx_to_pdf_chunk.s())).apply_async()
-
-	while not ret.ready():
-		time.sleep(1)
-
+	return self.replace(neo4j_worker.tasks["query_neo4j"].s(query, claim_result = True) | docx_to_pdf_chunk.s(chunk_size = chunk_size, target_seconds = target_seconds))
 
-	with allow_join_result():
-		return ret.get(disable_sync_subtasks = True)
-
-@shared_task(name = "docx_to_pdf_chunk_digest")
-def docx_to_pdf_chunk(queryrows):
-	from neo4j_tasks.main import app as neo4j_worker
-	actions_module = importlib.import_module('tiramisu.worker') 
-	workspace = actions_module.workspace
+# same as doc_to_pdf_chunk
+@shared_task(bind = True, name = "docx_to_pdf_chunk_digest")
+def docx_to_pdf_chunk(self, queryrows, chunk_size = None, target_seconds = None):
+	queryrows = resolve(queryrows)
 
 	if len(queryrows) == 0:
 		return 
-	for row in queryrows:
-
-		
-		try:
-			filename = row['path']
-			with workspace.createContext() as context:
-				if not Path(filename).is_file():
-					print(f"{filename} was not a file.")
-				else:
-					with context.one_to_one(filename) as p:
+	return self.replace(fan_out(docx_to_pdf, queryrows, chunk_size, target_seconds) | write_nodes.s(stage = "docx_to_pdf"))
 
-						p.child =  p.parent.stem + '.docx'
 
-						p = tiramisu_update(context, p)
-
-						subprocess.call(['libreoffice', '--headless', '--convert-to', 'pdf', '--outdir', str(p.child), filename ])
-
-						ret1 = neo4j_worker.tasks['add_node_neo4j'].s(nodeID = str(p.child.name), label = "File", parentID = row['nodeID'], relationship =  'CONVERT_TO', attributes = {"name":Path(filename).stem + ".pdf", "tiramisuPath": (p.child / (Path(filename).stem + ".pdf" )).as_posix(), "fileExtension":'pdf'}).apply_async()
-
-
-		except Exception as ex:
-			print(traceback.format_exc())
-			# raise Ignore()
-			docx_to_pdf.update_state(
-			state=states.FAILURE,
-			meta={
-				'exc_type': type(ex).__name__,
-				'exc_message': traceback.format_exc().split('\n')
-			})
-			# raise ex
-			return traceback.format_exc()
-	with allow_join_result():
-		return ret1.get(disable_sync_subtasks = True)
-
-
-@shared_task(name = "docx_to_pdf_digest")
-def docx_to_pdf(queryrows):
-	from neo4j_tasks.main import app as neo4j_worker
+# converts one .docx and returns the node row of its PDF for write_nodes
+@shared_task(bind = True, name = "docx_to_pdf_digest")
+def docx_to_pdf(self, queryrows):
 	actions_module = importlib.import_module('tiramisu.worker') 
 	workspace = actions_module.workspace
+
+	rows = []
 	try:
 		filename = queryrows['path']
 		with workspace.createContext() as context:
 			if not Path(filename).is_file():
-				print(f"{filename} was not a file.")
+				logger.warning(f"{filename} was not a file.")
 			else:
 				with context.one_to_one(filename) as p:
 
 					p.child =  p.parent.stem + '.docx'
 
 					p = tiramisu_update(context, p)
-					subprocess.call(['libreoffice', '--headless', '--convert-to', 'pdf', '--outdir', str(p.child), filename ])
-
-					ret1 = neo4j_worker.tasks['add_node_neo4j'].s(nodeID = str(p.child.name), label = "File", parentID = queryrows['nodeID'], relationship =  'CONVERT_TO', attributes = {"name":Path(filename).stem + ".pdf", "tiramisuPath": (p.child / (Path(filename).stem + ".pdf" )).as_posix(), "fileExtension":'pdf'}).apply_async()
-
-					while not ret1.ready():
-						time.sleep(1)
-
-		with allow_join_result():
-			return ret1.get(disable_sync_subtasks = True)
-
-	except Exception as ex:
-		print(traceback.format_exc())
-		# raise Ignore()
-		docx_to_pdf.update_state(
-		state=states.FAILURE,
-		meta={
-			'exc_type': type(ex).__name__,
-			'exc_message': traceback.format_exc().split('\n')
-		})
-		# raise ex
+					convert_to_pdf(filename, p.child)
+
+					rows.append(node_row(str(p.child.name), "File", queryrows['nodeID'], 'CONVERT_TO', {"name":Path(filename).stem + ".pdf", "tiramisuPath": (p.child / (Path(filename).stem + ".pdf" )).as_posix(), "fileExtension":'pdf'}))
+
+	# the traceback is the result of this row: run_batch leaves it out of the units and the input is picked up again next run
+	except Exception:
+		logger.exception(f"{self.name} failed on {queryrows.get('nodeID')}")
 		return traceback.format_exc()
 
+	return rows
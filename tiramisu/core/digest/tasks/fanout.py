@@ -0,0 +1,228 @@
+from celery import shared_task, group, current_app
+
+from pathlib import Path
+from tiramisu.worker import find_worker_queue
+from tiramisu.metrics import record_items
+from tiramisu.utils import backend_client
+from tiramisu.claims import claim, resolve
+import logging
+import os
+import time
+
+
+# fan-out of query rows over the digest workers, several rows per message
+# rows are packed by their estimated duration: a cost hint per row (its page count, or else the size of its file)
+# times the rolling average of seconds per cost unit measured for the task, so tiny rows share a message
+# and a huge PDF gets one of its own
+
+# sizing used when neither the call nor configure_fanout_digest says otherwise
+# target_seconds is the estimated work per message, max_rows caps the rows per message,
+# min_batches keeps small jobs spread over several workers
+DEFAULT_CONFIG = {
+	"target_seconds": float(os.environ.get('FANOUT_TARGET_SECONDS', 30)),
+	"max_rows": int(os.environ.get('FANOUT_MAX_ROWS', 1000)),
+	"min_batches": int(os.environ.get('FANOUT_MIN_BATCHES', 8)),
+}
+
+# seconds per cost unit assumed for a task that has not run yet
+DEFAULT_UNIT_SECONDS = 1.0
+
+# weight of the newest batch in the rolling average of seconds per cost unit
+SMOOTHING = 0.2
+
+# redis hashes shared by every digest worker process
+CONFIG_KEY = "tiramisu-fanout-config"
+COST_KEY = "tiramisu-fanout-cost"
+STATS_KEY = "tiramisu-fanout-stats:{task}"
+
+STATS_FIELDS = ["messages", "rows", "queue_seconds", "work_seconds", "overhead_seconds"]
+
+logger = logging.getLogger(__name__)
+
+
+# the redis client of the result backend, or None when running without one (e.g. eager tests)
+def _client():
+	return backend_client()
+
+# stand-ins for the redis hashes when there is no client
+_local = {CONFIG_KEY: {}, COST_KEY: {}}
+
+
+def _hgetall(key):
+	client = _client()
+	if client is None:
+		return dict(_local.setdefault(key, {}))
+	return {field.decode(): float(value) for field, value in client.hgetall(key).items()}
+
+def _hset(key, field, value):
+	client = _client()
+	if client is None:
+		_local.setdefault(key, {})[field] = value
+	else:
+		client.hset(key, field, value)
+
+def _hincrbyfloat(key, field, value):
+	client = _client()
+	if client is None:
+		values = _local.setdefault(key, {})
+		values[field] = values.get(field, 0) + value
+	else:
+		client.hincrbyfloat(key, field, value)
+
+
+def fanout_config():
+	config = dict(DEFAULT_CONFIG)
+	config.update(_hgetall(CONFIG_KEY))
+	config["max_rows"] = int(config["max_rows"])
+	config["min_batches"] = int(config["min_batches"])
+	return config
+
+
+# cost hint of one query row: the pages it lists, or else the size of its file in megabytes
+# the graph does not store file sizes, so the file is looked up on disk
+def row_cost(row):
+	if isinstance(row.get('pages'), list):
+		return max(len(row['pages']), 1)
+	try:
+		return max(Path(row['path']).stat().st_size / (1024 * 1024), 0.1)
+	except (KeyError, TypeError, OSError):
+		return 1.0
+
+
+# packs rows into lists whose estimated seconds stay under the target
+# chunk_size fixes the rows per message instead (chunk_size = 1 is one message per row)
+def plan_batches(rows, costs, unit_seconds, config, chunk_size = None):
+	if chunk_size is not None:
+		return [list(range(i, min(i + chunk_size, len(rows)))) for i in range(0, len(rows), chunk_size)]
+
+	estimates = [cost * unit_seconds for cost in costs]
+	target = config["target_seconds"]
+	if config["min_batches"] > 1:
+		target = min(target, sum(estimates) / config["min_batches"])
+
+	# longest first, so heavy rows start early and the light ones fill in behind them
+	batches = []
+	current, current_seconds = [], 0.0
+	for i in sorted(range(len(rows)), key = lambda i: estimates[i], reverse = True):
+		if current and (current_seconds + estimates[i] > target or len(current) >= config["max_rows"]):
+			batches.append(current)
+			current, current_seconds = [], 0.0
+		current.append(i)
+		current_seconds += estimates[i]
+	if current:
+		batches.append(current)
+	return batches
+
+
+# group running task over queryrows, packed into run_batch messages; join it with a chord callback as before
+# the rows of a large message travel as a claim (see tiramisu.claims), and so do the units it returns
+# chunk_size and target_seconds override the sizing of configure_fanout_digest for this call
+# heavy rows (see find_worker_queue) are packed apart from the rest and sent to the digest_heavy queue
+def fan_out(task, queryrows, chunk_size = None, target_seconds = None, **kwargs):
+	config = fanout_config()
+	if target_seconds is not None:
+		config["target_seconds"] = float(target_seconds)
+
+	costs = [row_cost(row) for row in queryrows]
+	unit_seconds = _hgetall(COST_KEY).get(task.name, DEFAULT_UNIT_SECONDS)
+
+	queues = {}
+	for i, row in enumerate(queryrows):
+		queues.setdefault(find_worker_queue(run_batch.name, [row]), []).append(i)
+
+	dispatched = time.time()
+	messages = []
+	for queue, indices in queues.items():
+		for batch in plan_batches([queryrows[i] for i in indices], [costs[i] for i in indices], unit_seconds, config, chunk_size):
+			batch = [indices[i] for i in batch]
+			messages.append(run_batch.s(task.name, claim([queryrows[i] for i in batch]), [costs[i] for i in batch], kwargs, dispatched).set(queue = queue))
+	return group(messages)
+
+
+# the nodes a query row stands for: the file it names, or every page it lists
+# they are marked done once the output of the row is written (see write_nodes)
+def row_inputs(row):
+	if isinstance(row.get('pages'), list):
+		return [page['nodeID'] for page in row['pages']]
+	return [row['nodeID']] if 'nodeID' in row else []
+
+
+# runs task on every row of one fan-out message and returns one {"done", "rows"} unit per row for write_nodes
+# each row runs under the request of this message, as it did when it was a message of its own;
+# a failed row returns its traceback as before and is left out, so it is picked up again by the next run
+@shared_task(bind = True, name = "run_batch_digest")
+def run_batch(self, task_name, queryrows, costs, kwargs, dispatched):
+	task = current_app.tasks[task_name]
+	queryrows = resolve(queryrows)
+	# the time of this message is reported under the task it runs, so its stages can be told apart in /api/metrics
+	record_items(len(queryrows), task_name)
+
+	start = time.time()
+	work = 0.0
+	units = []
+	for row in queryrows:
+		row_start = time.perf_counter()
+		task.push_request(id = self.request.id)
+		try:
+			result = task.run(row, **kwargs)
+		# a row that raises past the handler of its stage is logged and left out like any other failed row,
+		# so the rows of this message that succeeded are still written
+		except Exception:
+			logger.exception(f"{task_name} failed on {row.get('nodeID')}")
+			result = None
+		finally:
+			task.pop_request()
+		work += time.perf_counter() - row_start
+
+		if isinstance(result, list):
+			units.append({"done": row_inputs(row), "rows": result})
+
+	# messages, rows, time waiting in the queue, time working on rows, and time spent in this message around them
+	stats = STATS_KEY.format(task = task_name)
+	_hincrbyfloat(stats, "messages", 1)
+	_hincrbyfloat(stats, "rows", len(queryrows))
+	_hincrbyfloat(stats, "queue_seconds", max(start - dispatched, 0))
+	_hincrbyfloat(stats, "work_seconds", work)
+	_hincrbyfloat(stats, "overhead_seconds", max(time.time() - start - work, 0))
+
+	if sum(costs) > 0:
+		previous = _hgetall(COST_KEY).get(task_name)
+		measured = work / sum(costs)
+		_hset(COST_KEY, task_name, measured if previous is None else (1 - SMOOTHING) * previous + SMOOTHING * measured)
+
+	return claim(units)
+
+
+# sets the fan-out sizing of every later digest stage; fields left as None keep their current value
+@shared_task(name = "configure_fanout_digest")
+def configure_fanout(target_seconds = None, max_rows = None, min_batches = None):
+	for field, value in [("target_seconds", target_seconds), ("max_rows", max_rows), ("min_batches", min_batches)]:
+		if value is not None:
+			_hset(CONFIG_KEY, field, value)
+
+	return {
+		"status": "completed",
+		"result": fanout_config()
+	}
+
+# per fanned-out task: messages and rows dispatched, and the seconds spent waiting in the broker queue,
+# doing the work, and in per-message overhead; with the current sizing and seconds per cost unit
+@shared_task(name = "fanout_stats_digest")
+def fanout_stats():
+	unit_seconds = _hgetall(COST_KEY)
+
+	tasks = {}
+	for task_name in unit_seconds:
+		stats = _hgetall(STATS_KEY.format(task = task_name))
+		stats = {field: stats.get(field, 0) for field in STATS_FIELDS}
+		busy = stats["work_seconds"] + stats["overhead_seconds"] + stats["queue_seconds"]
+		stats["work_fraction"] = stats["work_seconds"] / busy if busy else 0.0
+		stats["rows_per_message"] = stats["rows"] / stats["messages"] if stats["messages"] else 0.0
+		stats["unit_seconds"] = unit_seconds[task_name]
+		tasks[task_name] = stats
+
+	return {
+		"status": "completed",
+		"config": fanout_config(),
+		"tasks": tasks
+	}
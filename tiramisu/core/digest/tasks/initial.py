@@ -3,15 +3,64 @@ from celery import signature, shared_task
 import importlib
 
 from urllib import request, parse
+from tiramisu.utils import API_URL
 import json 
 
 
 
+# the neo4j actions that load the CSVs written by tiramisu_digest, run in order as a chain
+def load_actions(incremental = False):
+    # every lookup below goes through the nodeID constraints; the load queries are in neo4j_tasks/tasks/templates.py
+    digest_list = [
+    {
+        "action": "create_schema_neo4j",
+        'kwargs': {}
+    },
+
+    {
+        "action": "write_neo4j",
+        'kwargs': {'template': "load_digest_nodes", 'parameters': {'label': "File", 'file': "file:///files.csv"}}
+    },
+
+    {
+        "action": "write_neo4j",
+        'kwargs': {'template': "load_digest_nodes", 'parameters': {'label': "Folder", 'file': "file:///folders.csv"}}
+    },
+
+    {
+        "action": "write_neo4j",
+        'kwargs': {'template': "load_digest_relationships", 'parameters': {'file': "file:///relationships.csv"}}
+
+    }]
+
+    if incremental:
+        # moved files keep their node (and everything derived from it) and are re-attached to their new folder
+        # removed nodes are flagged rather than deleted, since derived documents may still point at them
+        digest_list += [
+        {
+            "action": "write_neo4j",
+            'kwargs': {'template': "load_digest_moved", 'parameters': {'file': "file:///moved.csv"}}
+        },
+
+        {
+            "action": "write_neo4j",
+            'kwargs': {'template': "load_digest_removed", 'parameters': {'file': "file:///removed.csv"}}
+        }]
+
+    return digest_list
+
+
 # the first celery task for any archive
 # detects duplicates, corrects file extensions, and saves every file for future subsequent steps
+# threads sets how many files are hashed and copied in parallel (0 uses every core)
+# incremental only hashes files that are new or changed since the last digest (see .tiramisu/manifest.csv)
+# and loads just that delta: new nodes, moved files and removed nodes
+# resume picks an interrupted digest up after the last chunk it wrote (see .tiramisu/neo4j/import/digest.resume)
+# bulk_import is for the first load of a large archive: the CSVs are written for neo4j-admin import
+# and nothing is loaded here; run the neo4j_import service next (see neo4j_tasks/bulk_import.sh)
 
 @shared_task(name = 'start_digest')
-def digest(blacklist = ['.tiramisu'], hidden = True):
+def digest(blacklist = ['.tiramisu'], hidden = True, threads = 0, incremental = False, resume = False, bulk_import = False):
 
     import tiramisu_digest
 
@@ -22,7 +71,16 @@ def digest(blacklist = ['.tiramisu'], hidden = True):
 
         (context.config.root / '.tiramisu' / 'neo4j' ).mkdir(exist_ok = True)
         (context.config.root / '.tiramisu' / 'neo4j' / 'import').mkdir(exist_ok = True)
-        tiramisu_digest.digest(context.config.root.as_posix(), blacklist, hidden)
+        tiramisu_digest.digest(context.config.root.as_posix(), blacklist, hidden, threads, incremental, resume, bulk_import)
+
+        if bulk_import:
+            # picked up by bulk_import.sh, which refuses to run without it
+            (context.config.root / '.tiramisu' / 'neo4j' / 'import' / 'bulk_import.pending').touch()
+            return {
+            "status": "completed",
+            "result": "bulk_import.pending"
+            }
+
         merge_query = (
         "MATCH (n:File) - [:COMBINED_TO] -> (m: File) " 
         "WITH m.fileHash as hash, COLLECT(m) AS ns "
@@ -31,33 +89,17 @@ def digest(blacklist = ['.tiramisu'], hidden = True):
         "YIELD node " 
         "return node ")
         
-        digest_list = [
-        {
-            "action": "write_neo4j",
-            'kwargs': {'query': "CALL apoc.periodic.iterate( \"LOAD CSV WITH HEADERS FROM 'file:///files.csv' as row with row where linenumber() > 0 return row\", \"with row.NodeType as nodetype, row.Name as name, row.NodeID as nodeID, row.TiramisuPath as tiramisuPath, row.OriginalPath as originalPath, row.FileExtension as fileExtension, row.FileHash as fileHash MERGE (p1: File {name: name, nodeID: nodeID, tiramisuPath: tiramisuPath, originalPath: originalPath, fileExtension: fileExtension, fileHash: fileHash})\",{batchSize:10000, parallel:true})"}
-        },
-
-        {
-            "action": "write_neo4j",
-            'kwargs': {'query': "CALL apoc.periodic.iterate( \"LOAD CSV WITH HEADERS FROM 'file:///folders.csv' as row with row where linenumber() > 0 return row\", \"with row.NodeType as nodetype, row.Name as name, row.NodeID as nodeID, row.TiramisuPath as tiramisuPath, row.OriginalPath as originalPath, row.FileExtension as fileExtension, row.FileHash as fileHash MERGE (p1:Folder {name: name, nodeID: nodeID, tiramisuPath: tiramisuPath, originalPath: originalPath, fileExtension: fileExtension, fileHash: fileHash})\",{batchSize:10000, parallel:true});"}
-        },
-
-        {
-            "action": "write_neo4j",
-            'kwargs': {'query': "CALL apoc.periodic.iterate( \"LOAD CSV WITH HEADERS FROM 'file:///relationships.csv' as row with row where linenumber() > 0 return row\", \"with row.Relationship as relationship, row.Child as child, row.Parent as parent MATCH (p2) WHERE p2.nodeID = parent MATCH (p1) WHERE p1.nodeID = child CALL apoc.create.relationship(p2, relationship, {}, p1) YIELD rel return rel\",{batchSize:10000, parallel:true});"}
-
-        }]
-
-        
         data = json.dumps({ 
-                    "action_list": digest_list
+                    "action_list": load_actions(incremental)
                 }).encode()
-        req = request.Request("http://flask:5000/api/action/chain", data)
+        req = request.Request(f"{API_URL}/api/action/chain", data)
         req.add_header("Content-Type", "application/json")
         res = request.urlopen(req)
         result = json.loads(res.read())
 
+    # the load chain keeps running after this task returns; follow it at /api/chain/<chain_id>
     return {
     "status": "completed",
-    "result": result['task_id']
+    "result": result['task_id'],
+    "chain_id": result['chain_id']
     }
\ No newline at end of file
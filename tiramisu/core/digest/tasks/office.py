@@ -0,0 +1,141 @@
+import os
+import queue
+import shlex
+import socket
+import subprocess
+import time
+from pathlib import Path
+
+from tiramisu.utils import TiramisuException
+
+
+# listeners started by each worker process
+POOL_SIZE = int(os.environ.get('OFFICE_POOL_SIZE', 1))
+# seconds a single document may take before its listener is considered hung
+DOCUMENT_TIMEOUT = int(os.environ.get('OFFICE_TIMEOUT', 300))
+# seconds a task waits for a free listener
+QUEUE_TIMEOUT = int(os.environ.get('OFFICE_QUEUE_TIMEOUT', 600))
+# seconds a listener may take to accept connections after (re)starting
+STARTUP_TIMEOUT = 60
+# first port used by the listeners of worker process 0; every listener takes one port
+BASE_PORT = int(os.environ.get('OFFICE_BASE_PORT', 2002))
+# the unoserver 1.x server and converter both talk uno, so both must run under an interpreter
+# that has the LibreOffice uno bindings (see digest/Dockerfile)
+SERVER_COMMAND = shlex.split(os.environ.get('OFFICE_SERVER_COMMAND', 'unoserver'))
+CONVERT_COMMAND = shlex.split(os.environ.get('OFFICE_CONVERT_COMMAND', 'unoconvert'))
+
+
+# one headless LibreOffice kept alive behind an unoserver listener
+class OfficeListener:
+
+	def __init__(self, port):
+		self.port = port
+		self.process = None
+
+	def running(self):
+		return self.process is not None and self.process.poll() is None
+
+	def start(self):
+		# unoserver gives every listener its own temporary LibreOffice profile; LibreOffice accepts uno on port
+		self.process = subprocess.Popen(SERVER_COMMAND + ['--interface', '127.0.0.1', '--port', str(self.port)], \
+			stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+		# LibreOffice only starts once per listener, so waiting here is paid once and not per document
+		deadline = time.monotonic() + STARTUP_TIMEOUT
+		while time.monotonic() < deadline:
+			if not self.running():
+				raise TiramisuException(f"office listener on port {self.port} exited while starting")
+			try:
+				socket.create_connection(('127.0.0.1', self.port), timeout = 1).close()
+				return
+			except OSError:
+				time.sleep(0.5)
+		self.stop()
+		raise TiramisuException(f"office listener on port {self.port} did not start within {STARTUP_TIMEOUT} seconds")
+
+	def stop(self):
+		if self.process is None:
+			return
+		self.process.terminate()
+		try:
+			self.process.wait(10)
+		except subprocess.TimeoutExpired:
+			self.process.kill()
+			self.process.wait()
+		self.process = None
+
+	def restart(self):
+		self.stop()
+		self.start()
+
+	def convert(self, inpath, outpath, convert_to, timeout):
+		if not self.running():
+			self.start()
+		subprocess.run(CONVERT_COMMAND + ['--host', '127.0.0.1', '--port', str(self.port), '--convert-to', convert_to, str(inpath), str(outpath)], \
+			timeout = timeout, check = True, stdout = subprocess.DEVNULL)
+
+
+# bounded set of listeners; a conversion waits for a free listener and returns once the output file is written
+class OfficePool:
+
+	def __init__(self, size, base_port):
+		self.listeners = queue.Queue(maxsize = size)
+		self.all = []
+		for i in range(size):
+			listener = OfficeListener(port = base_port + i)
+			self.all.append(listener)
+			self.listeners.put(listener)
+
+	def convert(self, inpath, outpath, convert_to = 'pdf', timeout = DOCUMENT_TIMEOUT, wait = QUEUE_TIMEOUT):
+		try:
+			listener = self.listeners.get(timeout = wait)
+		except queue.Empty:
+			raise TiramisuException(f"no office listener became free within {wait} seconds for {inpath}")
+
+		try:
+			listener.convert(inpath, outpath, convert_to, timeout)
+		except subprocess.TimeoutExpired:
+			# a hung LibreOffice would block every later document on this listener
+			listener.restart()
+			raise TiramisuException(f"converting {inpath} took longer than {timeout} seconds; its office listener was restarted")
+		except subprocess.CalledProcessError:
+			if not listener.running():
+				listener.restart()
+			raise TiramisuException(f"converting {inpath} to {convert_to} failed")
+		finally:
+			self.listeners.put(listener)
+
+		if not Path(outpath).is_file():
+			raise TiramisuException(f"converting {inpath} to {convert_to} did not write {outpath}")
+		return outpath
+
+	def close(self):
+		for listener in self.all:
+			listener.stop()
+
+
+# pool shared by every task of the current worker process
+_pool = None
+
+# creates the per-process pool; listeners start on their first conversion
+# called from the worker_process_init hook and lazily by convert_to_pdf
+def open_pool():
+	global _pool
+	if _pool is None:
+		from billiard.process import current_process
+
+		# every prefork child gets its own port range
+		index = getattr(current_process(), 'index', None) or 0
+		_pool = OfficePool(POOL_SIZE, BASE_PORT + POOL_SIZE * index)
+	return _pool
+
+# stops the listeners of this process; called from the worker_process_shutdown hook
+def close_pool():
+	global _pool
+	if _pool is not None:
+		_pool.close()
+		_pool = None
+
+# converts an office document into outdir/<stem>.pdf
+def convert_to_pdf(filename, outdir):
+	return open_pool().convert(filename, Path(outdir) / (Path(filename).stem + '.pdf'))
@@ -32,6 +32,15 @@ const dataList = [
     kwargs: null,
     chain: false,
   },
+  {
+    action: "Re-digest",
+    namespace: Namespace.all,
+    key: "start_digest",
+    description:
+      "Digest only what was added, changed, moved or removed since the last digest.",
+    kwargs: {"incremental": true},
+    chain: false,
+  },
   {
     action: "Convert MS to PDFs",
     namespace: Namespace.ms_word,
@@ -77,13 +86,24 @@ const dataList = [
     kwargs: null,
     chain: true,
   },
+  {
+    action: "Process PDFs in one pass",
+    namespace: Namespace.pdfs,
+    key: [
+      {"action": "process_pdf_supervisor_digest"}, 
+      ],
+    description:
+    "Create page nodes, determine if each page is scanned, convert pages to images, and extract the text of born-digital pages",
+    kwargs: null,
+    chain: true,
+  },
   {
     action: "Visualize a specific PDF or image",
     namespace: Namespace.pdfs,
     key: "show_me_in_labelstudio",
     description: "Pull up a specific file from Tiramisu using LabelStudio.",
     kwargs: {
-      "query":  "match (d:File) where d.nodeID = \"{nodeID}\" return d.nodeID as nodeID, d.tiramisuPath as file, d.fileExtension as extension, d.originalPath as originalPath",
+      "template": "file_by_node_id",
       "title": "visualize {nodeID}",
         },
     chain: false,
@@ -1,8 +1,12 @@
 from tiramisu.internal import ClassHolder
+import tiramisu.queues
+import tiramisu.metrics
 import celery
 from celery.app.registry import TaskRegistry
+from celery.signals import worker_process_init, worker_process_shutdown
 
-from labelstudio.tasks.utils import show_me_in_labelstudio
+from neo4j_tasks.tasks.graphApp import open_driver, close_driver
+from labelstudio.tasks.utils import URL, pw, show_me_in_labelstudio
 
 
 
@@ -16,6 +20,16 @@ app.conf.task_routes = {
 } # update worker queue
 
 
+# one pooled neo4j driver per worker process
+@worker_process_init.connect
+def init_neo4j_driver(**kwargs):
+    open_driver(URL, 'neo4j', pw)
+
+@worker_process_shutdown.connect
+def shutdown_neo4j_driver(**kwargs):
+    close_driver()
+
+
 # start worker
 if __name__ == '__main__':
     app.worker_main()
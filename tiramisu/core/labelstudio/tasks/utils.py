@@ -3,8 +3,11 @@ from celery import signature, shared_task
 from urllib import request, parse
 import json 
 from neo4j_tasks.tasks.graphApp import graphApp
+from neo4j_tasks.tasks.templates import render
 import os 
 import ast 
+from tiramisu.claims import resolve
+from tiramisu.utils import TiramisuException
 
 
 URL = "bolt://neo4j:7687"
@@ -34,11 +37,14 @@ def delete_all_labelstudio(api):
 # Upload PDF/images to LabelStudio to view
 # Can change interface here using LabelStudio labeling config
 # jsonl is a list of dictionaries containing necessary fields (pdf, image, image1, etc)
+# either the list itself, a claim of it (see tiramisu.claims), or its python literal as before
 @shared_task(name="upload_to_labelstudio")
 def upload_to_labelstudio(jsonl, title, api, configuration):
 	from label_studio_sdk import Client 
 
-	jsonl = ast.literal_eval(jsonl)
+	jsonl = resolve(jsonl)
+	if isinstance(jsonl, str):
+		jsonl = ast.literal_eval(jsonl)
 
 	if configuration == 'pdf':
 			config = """
@@ -206,20 +212,28 @@ def upload_to_labelstudio(jsonl, title, api, configuration):
 	"status": "completed"
 	}
 
-# Write a Neo4J query to visualize in LabelStudio
-# query must return tabular data containing the necessary fields (pdf, image, image1, etc) from Neo4J
+# Runs a query template (see neo4j_tasks/tasks/templates.py) to visualize in LabelStudio
+# the template must return tabular data containing the necessary fields (pdf, image, image1, etc) from Neo4J
+# nodeID is passed as the $nodeID parameter; a free-form query may be given instead of a template for debugging
+# query keeps its old place as the first argument, but is no longer formatted: a query written with the old
+# "{nodeID}" placeholder is rejected rather than run literally, which would match nothing
 @shared_task(name =  "show_me_in_labelstudio")
-def show_me_in_labelstudio(query, nodeID, title, api, configuration = "image"):
+def show_me_in_labelstudio(query = None, nodeID = None, title = None, api = None, configuration = "image", template = "file_by_node_id"):
 	from label_studio_sdk import Client
 
+	if query is not None and "{nodeID}" in query:
+		raise TiramisuException("show_me_in_labelstudio no longer formats {nodeID} into query; use $nodeID in the query, or pass template= (e.g. template=\"file_by_node_id\") instead.")
 
 	app = graphApp(URL, 'neo4j', pw)
 
-	query = query.format(nodeID = nodeID)
+	if query is None:
+		query, parameters = render(template, {"nodeID": nodeID})
+	else:
+		parameters = {"nodeID": nodeID}
 
 	title = title.format(nodeID = nodeID)
 
-	result = app.query(query)
+	result = app.query(query, parameters = parameters)
 	
 	if result is None or len(result) == 0:
 		return {"status": "completed"}
@@ -0,0 +1,94 @@
+import argparse
+import json
+import time
+
+from neo4j_tasks.tasks.graphApp import graphApp, match_node
+from neo4j_tasks.tasks.update import URL, pw
+
+
+# measures how long loading folder-file relationships takes as the graph grows
+# "before" uses the original unlabeled lookups on a database without schema,
+# "after" uses the label-qualified lookups on a database bootstrapped with create_schema
+# runs against a scratch database (enterprise only) so the archive graph is never touched
+# usage, inside the neo4j_worker container:
+#   python -m neo4j_tasks.benchmark_schema --sizes 1000 10000 100000 --output /tiramisu/.tiramisu/benchmark_schema.json
+
+BATCH_SIZE = 10000
+
+# one folder per FILES_PER_FOLDER files, like a box of scans
+FILES_PER_FOLDER = 50
+
+UNLABELED = (
+	"UNWIND $rows AS row "
+	"MATCH (p2) WHERE p2.nodeID = row.parent "
+	"MATCH (p1) WHERE p1.nodeID = row.child "
+	"CALL apoc.create.relationship(p2, 'CONTAINS', {}, p1) YIELD rel "
+	"RETURN count(rel) AS count"
+	)
+
+LABELED = (
+	"UNWIND $rows AS row "
+	+ match_node('p2', 'row.parent', ['row']) + match_node('p1', 'row.child', ['p2']) +
+	"CALL apoc.create.relationship(p2, 'CONTAINS', {}, p1) YIELD rel "
+	"RETURN count(rel) AS count"
+	)
+
+
+def reset(session):
+	session.run("CALL apoc.periodic.iterate('MATCH (n) RETURN n', 'DETACH DELETE n', {batchSize: 10000})").consume()
+	# drops every index and constraint
+	session.run("CALL apoc.schema.assert({}, {})").consume()
+
+
+def populate(session, size):
+	folders = max(size // FILES_PER_FOLDER, 1)
+	session.run("UNWIND range(0, $folders - 1) AS i CREATE (:Folder {nodeID: 'folder+++' + toString(i)})", folders = folders).consume()
+	for start in range(0, size, BATCH_SIZE):
+		session.run("UNWIND range($start, $end - 1) AS i CREATE (:File {nodeID: 'file+++' + toString(i), fileHash: toString(i)})", \
+			start = start, end = min(start + BATCH_SIZE, size)).consume()
+	return [{"parent": f"folder+++{i % folders}", "child": f"file+++{i}"} for i in range(size)]
+
+
+def load(session, query, rows):
+	start = time.perf_counter()
+	for i in range(0, len(rows), BATCH_SIZE):
+		session.run(query, rows = rows[i:i + BATCH_SIZE]).consume()
+	return time.perf_counter() - start
+
+
+def main():
+	parser = argparse.ArgumentParser(description = "relationship load time versus node count, before and after the schema bootstrap")
+	parser.add_argument('--sizes', type = int, nargs = '+', default = [1000, 5000, 20000])
+	parser.add_argument('--database', default = 'benchmark')
+	parser.add_argument('--output', default = None)
+	args = parser.parse_args()
+
+	app = graphApp(URL, 'neo4j', pw)
+	with app.driver.session(database = 'system') as session:
+		session.run(f"CREATE DATABASE {args.database} IF NOT EXISTS WAIT").consume()
+
+	results = []
+	for size in args.sizes:
+		with app.driver.session(database = args.database) as session:
+			reset(session)
+			rows = populate(session, size)
+			before = load(session, UNLABELED, rows)
+
+			reset(session)
+			app.create_schema(args.database)
+			rows = populate(session, size)
+			after = load(session, LABELED, rows)
+
+		results.append({"nodes": size, "before_seconds": round(before, 3), "after_seconds": round(after, 3)})
+		print(f"{size:>10} nodes  before {before:10.3f}s  after {after:10.3f}s")
+
+	with app.driver.session(database = 'system') as session:
+		session.run(f"DROP DATABASE {args.database} IF EXISTS").consume()
+
+	if args.output is not None:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent = 2)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,71 @@
+import argparse
+import json
+import time
+
+from neo4j_tasks.tasks.graphApp import graphApp
+from neo4j_tasks.tasks.templates import render
+from neo4j_tasks.tasks.update import URL, pw
+
+
+# measures repeated lookups of distinct files, with the nodeID spliced into the query text (a new plan for every
+# nodeID) against the file_by_node_id template (one plan, the nodeID passed as a parameter)
+# runs against a scratch database (enterprise only) so the archive graph is never touched
+# usage, inside the neo4j_worker container:
+#   python -m neo4j_tasks.benchmark_templates --lookups 1000 --output /tiramisu/.tiramisu/benchmark_templates.json
+
+LITERAL = (
+	"MATCH (d:File) WHERE d.nodeID = \"{nodeID}\" "
+	"RETURN d.nodeID AS nodeID, d.tiramisuPath AS file, d.fileExtension AS extension, d.originalPath AS originalPath"
+	)
+
+
+def populate(session, size):
+	session.run("CALL apoc.periodic.iterate('MATCH (n) RETURN n', 'DETACH DELETE n', {batchSize: 10000})").consume()
+	session.run("UNWIND range(0, $size - 1) AS i CREATE (:File {nodeID: 'file+++' + toString(i), tiramisuPath: '/tiramisu/' + toString(i)})", size = size).consume()
+
+
+def lookups(session, queries):
+	start = time.perf_counter()
+	for query, parameters in queries:
+		session.run(query, parameters).consume()
+	return time.perf_counter() - start
+
+
+def main():
+	parser = argparse.ArgumentParser(description = "lookup latency with literal query text versus a parameterized template")
+	parser.add_argument('--lookups', type = int, default = 1000)
+	parser.add_argument('--database', default = 'benchmark')
+	parser.add_argument('--output', default = None)
+	args = parser.parse_args()
+
+	app = graphApp(URL, 'neo4j', pw)
+	with app.driver.session(database = 'system') as session:
+		session.run(f"CREATE DATABASE {args.database} IF NOT EXISTS WAIT").consume()
+
+	app.create_schema(args.database)
+	nodeIDs = [f"file+++{i}" for i in range(args.lookups)]
+
+	with app.driver.session(database = args.database) as session:
+		populate(session, args.lookups)
+		literal = lookups(session, [(LITERAL.format(nodeID = nodeID), None) for nodeID in nodeIDs])
+		template = lookups(session, [render("file_by_node_id", {"nodeID": nodeID}) for nodeID in nodeIDs])
+
+	with app.driver.session(database = 'system') as session:
+		session.run(f"DROP DATABASE {args.database} IF EXISTS").consume()
+
+	results = {
+		"lookups": args.lookups,
+		"literal_seconds": round(literal, 3),
+		"template_seconds": round(template, 3),
+		"literal_ms_per_lookup": round(1000 * literal / args.lookups, 3),
+		"template_ms_per_lookup": round(1000 * template / args.lookups, 3),
+	}
+	print(json.dumps(results, indent = 2))
+
+	if args.output is not None:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent = 2)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,39 @@
+#!/bin/bash
+# offline first-time load of a digest written by start_digest with bulk_import = True
+# runs in the neo4j_import service (see docker-compose) while the neo4j server is stopped:
+#   docker compose stop neo4j
+#   docker compose --profile bulk_import run --rm neo4j_import
+#   docker compose start neo4j
+# neo4j-admin import only writes into a database that does not exist yet; set
+# BULK_IMPORT_OVERWRITE=true to delete the existing (empty) default database first
+set -e
+
+IMPORT=/import
+DATABASE=${BULK_IMPORT_DATABASE:-neo4j}
+
+if [ ! -f "$IMPORT/bulk_import.pending" ]; then
+	echo "nothing to import: run start_digest with bulk_import first"
+	exit 0
+fi
+
+OPTIONS=(
+	--nodes=File="$IMPORT/files.csv"
+	--nodes=Folder="$IMPORT/folders.csv"
+	--relationships="$IMPORT/relationships.csv"
+	--skip-duplicate-nodes=true
+	--skip-bad-relationships=true
+	--report-file="$IMPORT/bulk_import.report"
+)
+
+if neo4j-admin database --help > /dev/null 2>&1; then
+	# neo4j 5 (the aarch64 image)
+	neo4j-admin database import full "${OPTIONS[@]}" --overwrite-destination="${BULK_IMPORT_OVERWRITE:-false}" "$DATABASE"
+else
+	if [ "$BULK_IMPORT_OVERWRITE" = "true" ]; then
+		rm -rf "/data/databases/$DATABASE" "/data/transactions/$DATABASE"
+	fi
+	neo4j-admin import --database="$DATABASE" "${OPTIONS[@]}"
+fi
+
+rm "$IMPORT/bulk_import.pending"
+echo "imported; once neo4j is up, run create_schema_neo4j to add the nodeID constraints"
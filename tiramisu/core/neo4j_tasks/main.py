@@ -1,7 +1,11 @@
 from tiramisu.internal import ClassHolder
+import tiramisu.queues
+import tiramisu.metrics
 import celery
+from celery.signals import worker_process_init, worker_process_shutdown
 
-from neo4j_tasks.tasks.update import add_node_neo4j, write_neo4j, update_metadata_neo4j, query_neo4j, load_csv_neo4j
+from neo4j_tasks.tasks.graphApp import open_driver, close_driver
+from neo4j_tasks.tasks.update import URL, pw, create_schema_neo4j, add_node_neo4j, add_nodes_batch_neo4j, write_neo4j, update_metadata_neo4j, update_metadata_batch_neo4j, query_neo4j, query_cache_stats_neo4j, snapshot_neo4j, load_csv_neo4j
 
 app = celery.Celery()
 
@@ -13,6 +17,16 @@ app.conf.task_routes = {
 } # update worker queue
 
 
+# one pooled neo4j driver per worker process
+@worker_process_init.connect
+def init_neo4j_driver(**kwargs):
+    open_driver(URL, 'neo4j', pw)
+
+@worker_process_shutdown.connect
+def shutdown_neo4j_driver(**kwargs):
+    close_driver()
+
+
 # start worker
 if __name__ == '__main__':
     app.worker_main()
@@ -0,0 +1,131 @@
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from tiramisu.utils import backend_client
+
+# counter shared by every worker process through redis, bumped after every write to the graph
+# a cached result is keyed by the generation it was read at, so a write makes every older entry unreachable
+GENERATION_KEY = "tiramisu-graph-generation"
+
+# hits and misses of every worker process, summed in redis
+STATS_KEY = "tiramisu-query-cache-stats"
+
+# upper bound on the serialized size of the results held by the cache of one worker process
+CACHE_BYTES = int(os.environ.get('NEO4J_QUERY_CACHE_BYTES', 256 * 1024 * 1024))
+
+# results with more rows are not cached; checked before serializing, so a large result is not copied just to be dropped
+CACHE_ROWS = int(os.environ.get('NEO4J_QUERY_CACHE_ROWS', 10000))
+
+# string literals of a cypher query, whose whitespace is part of the query
+LITERAL = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)""")
+
+
+# collapses whitespace outside string literals, so the same query indented differently shares an entry
+def normalize_query(query):
+	parts = LITERAL.split(query.strip())
+	return "".join(part if i % 2 else re.sub(r"\s+", " ", part) for i, part in enumerate(parts))
+
+
+# the redis client of the result backend, or None when running without one (e.g. eager tests)
+def _client():
+	return backend_client()
+
+_local_generation = 0
+
+def current_generation():
+	client = _client()
+	if client is None:
+		return _local_generation
+	return int(client.get(GENERATION_KEY) or 0)
+
+def bump_generation():
+	global _local_generation
+	client = _client()
+	if client is None:
+		_local_generation += 1
+		return _local_generation
+	return client.incr(GENERATION_KEY)
+
+
+# size-bounded LRU of read query results for one worker process
+# results are held as their json text, so every hit hands out a fresh copy and the size is exact
+# entries of older generations are never read again and age out through the LRU order
+class QueryCache:
+
+	def __init__(self, max_bytes = CACHE_BYTES, max_rows = CACHE_ROWS):
+		self.max_bytes = max_bytes
+		self.max_rows = max_rows
+		self.entries = OrderedDict()
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.Lock()
+
+	@staticmethod
+	def key(query, parameters, database, generation):
+		return (generation, database, normalize_query(query), json.dumps(parameters, sort_keys = True, default = str))
+
+	def get(self, key):
+		with self.lock:
+			text = self.entries.get(key)
+			if text is None:
+				self.misses += 1
+			else:
+				self.entries.move_to_end(key)
+				self.hits += 1
+		self.count("misses" if text is None else "hits")
+
+		return None if text is None else json.loads(text)
+
+	def put(self, key, result):
+		if isinstance(result, list) and len(result) > self.max_rows:
+			return
+		text = json.dumps(result, default = str)
+		if len(text) > self.max_bytes:
+			return
+
+		with self.lock:
+			if key in self.entries:
+				self.bytes -= len(self.entries.pop(key))
+			self.entries[key] = text
+			self.bytes += len(text)
+
+			while self.bytes > self.max_bytes:
+				_, evicted = self.entries.popitem(last = False)
+				self.bytes -= len(evicted)
+				self.evictions += 1
+
+	def count(self, field):
+		client = _client()
+		if client is not None:
+			client.hincrby(STATS_KEY, field, 1)
+
+	def stats(self):
+		client = _client()
+		total = {key.decode(): int(value) for key, value in client.hgetall(STATS_KEY).items()} if client is not None else {}
+		hits, misses = total.get("hits", self.hits), total.get("misses", self.misses)
+
+		return {
+			"generation": current_generation(),
+			"hits": hits,
+			"misses": misses,
+			"hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+			"process": {
+				"pid": os.getpid(),
+				"hits": self.hits,
+				"misses": self.misses,
+				"evictions": self.evictions,
+				"entries": len(self.entries),
+				"bytes": self.bytes,
+				"max_bytes": self.max_bytes,
+				"max_rows": self.max_rows
+			}
+		}
+
+
+# cache of the current worker process
+query_cache = QueryCache()
@@ -1,22 +1,183 @@
+import json
 import logging
+import os
 import sys
+from itertools import islice
 
 from neo4j import GraphDatabase
 from neo4j.exceptions import ServiceUnavailable
 
+# maximum number of pooled Bolt connections held by the driver of one worker process
+POOL_SIZE = int(os.environ.get('NEO4J_POOL_SIZE', 100))
+
+# driver shared by every task of the current worker process
+_driver = None
+
+# labels whose nodeID is unique; nodes are only ever looked up by nodeID under one of these labels
+NODE_LABELS = ['File', 'Folder', 'Document']
+
+# constraints and indexes every archive database needs; safe to run again on a bootstrapped database
+# a uniqueness constraint cannot be created while duplicate nodeIDs exist under its label
+SCHEMA = [
+	"CREATE CONSTRAINT file_node_id IF NOT EXISTS ON (n:File) ASSERT n.nodeID IS UNIQUE",
+	"CREATE CONSTRAINT folder_node_id IF NOT EXISTS ON (n:Folder) ASSERT n.nodeID IS UNIQUE",
+	"CREATE CONSTRAINT document_node_id IF NOT EXISTS ON (n:Document) ASSERT n.nodeID IS UNIQUE",
+	"CREATE INDEX file_hash IF NOT EXISTS FOR (n:File) ON (n.fileHash)",
+]
+
+# relationship types exported by snapshot, between nodes of NODE_LABELS
+SNAPSHOT_TYPES = ['CONTAINS', 'SPLIT_INTO', 'CONVERT_TO', 'PART_OF']
+
+# properties kept as their own snapshot columns; any other property goes into the json "properties" column
+SNAPSHOT_PROPERTIES = ['nodeID', 'name', 'originalPath', 'tiramisuPath', 'fileExtension', 'fileHash', 'page', 'virtual', 'scanned', 'removed']
+
+# cypher that binds variable to the node whose nodeID is key, whatever its label
+# one index seek per label, where an unlabeled {nodeID: ...} match scans every node in the graph
+# carry lists the variables that must survive the WITH; rows without a matching node are dropped
+def match_node(variable, key, carry = ()):
+	candidates = [f"{variable}_{label.lower()}" for label in NODE_LABELS]
+	query = "".join(f"OPTIONAL MATCH ({candidate}:{label} {{nodeID: {key}}}) " for candidate, label in zip(candidates, NODE_LABELS))
+	coalesced = "coalesce(" + ", ".join(candidates) + ") AS " + variable
+	query += "WITH " + ", ".join([*carry, coalesced]) + " "
+	query += f"WHERE {variable} IS NOT NULL "
+	return query
+
+# arrow table for one page of query records; schema is the one fixed by the first page
+# a column that is null throughout the first page becomes a string column, and values that do not
+# fit a string column (or a column of mixed types in the first page) are stored as text
+def page_table(page, schema = None):
+	import pyarrow as pa
+
+	def as_text(names):
+		for row in page:
+			for name in names:
+				value = row.get(name)
+				if value is not None and not isinstance(value, str):
+					row[name] = json.dumps(value, default = str)
+
+	if schema is None:
+		try:
+			table = pa.Table.from_pylist(page)
+		except (pa.ArrowInvalid, pa.ArrowTypeError):
+			mixed = [name for name in page[0] if len({type(row.get(name)) for row in page if row.get(name) is not None}) > 1]
+			as_text(mixed)
+			table = pa.Table.from_pylist(page)
+		return table.cast(pa.schema([pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field for field in table.schema]))
+
+	try:
+		return pa.Table.from_pylist(page, schema = schema)
+	except (pa.ArrowInvalid, pa.ArrowTypeError):
+		as_text([field.name for field in schema if pa.types.is_string(field.type)])
+		return pa.Table.from_pylist(page, schema = schema)
+
+# arrow schemas of the snapshot tables; id, source and target are the integer surrogate keys of the snapshot
+def snapshot_schemas():
+	import pyarrow as pa
+
+	nodes = pa.schema([
+		pa.field('id', pa.int64()),
+		pa.field('nodeID', pa.string()),
+		pa.field('name', pa.string()),
+		pa.field('originalPath', pa.string()),
+		pa.field('tiramisuPath', pa.string()),
+		pa.field('fileExtension', pa.string()),
+		pa.field('fileHash', pa.string()),
+		pa.field('page', pa.int32()),
+		pa.field('virtual', pa.bool_()),
+		pa.field('scanned', pa.bool_()),
+		pa.field('removed', pa.bool_()),
+		pa.field('properties', pa.string()),
+	])
+	edges = pa.schema([
+		pa.field('source', pa.int64()),
+		pa.field('target', pa.int64()),
+	])
+	return nodes, edges
+
+# one snapshot row from the properties of a node
+def snapshot_row(surrogate, properties):
+	row = {name: properties.pop(name, None) for name in SNAPSHOT_PROPERTIES}
+	row['id'] = surrogate
+
+	# pages are stored as text on CONVERT_TO children and as integers on SPLIT_INTO children
+	try:
+		row['page'] = None if row['page'] is None else int(row['page'])
+	except (TypeError, ValueError):
+		properties['page'] = row['page']
+		row['page'] = None
+	for name in ['nodeID', 'name', 'originalPath', 'tiramisuPath', 'fileExtension', 'fileHash']:
+		if row[name] is not None and not isinstance(row[name], str):
+			row[name] = str(row[name])
+	for name in ['virtual', 'scanned', 'removed']:
+		if row[name] is not None and not isinstance(row[name], bool):
+			properties[name] = row[name]
+			row[name] = None
+
+	row['properties'] = json.dumps(properties, default = str) if properties else None
+	return row
+
+# writes rows into parquet files of at most file_rows rows in folder, one row group per page
+class PartitionWriter:
+
+	def __init__(self, folder, schema, file_rows):
+		self.folder = folder
+		self.schema = schema
+		self.file_rows = file_rows
+		self.writer = None
+		self.part = 0
+		self.written = 0
+		self.rows = 0
+
+	def write(self, page):
+		import pyarrow as pa
+		import pyarrow.parquet as pq
+
+		while page:
+			if self.writer is None:
+				os.makedirs(self.folder, exist_ok = True)
+				self.writer = pq.ParquetWriter(os.path.join(self.folder, f"part-{self.part:05d}.parquet"), self.schema)
+			head, page = page[:self.file_rows - self.written], page[self.file_rows - self.written:]
+			self.writer.write_table(pa.Table.from_pylist(head, schema = self.schema))
+			self.written += len(head)
+			self.rows += len(head)
+			if self.written == self.file_rows:
+				self.close()
+
+	def close(self):
+		if self.writer is not None:
+			self.writer.close()
+			self.writer = None
+			self.part += 1
+			self.written = 0
+
+# opens the per-process driver; called from the worker_process_init hook and lazily by graphApp
+def open_driver(uri, user, password):
+	global _driver
+	if _driver is None:
+		_driver = GraphDatabase.driver(uri, auth=(user, password), max_connection_pool_size = POOL_SIZE)
+	return _driver
+
+# closes the per-process driver; called from the worker_process_shutdown hook
+def close_driver():
+	global _driver
+	if _driver is not None:
+		_driver.close()
+		_driver = None
+
 # this class interfaces flask server with the neo4j database
 # class functions can be added to include more scenario-specific cypher queries
 # each cypher query requires a static class method and a parent function under self.driver.session() context 
 class graphApp:
 
 	def __init__(self, uri, user, password):
-		self.driver = GraphDatabase.driver(uri, auth=(user, password))
+		# reuse the pooled driver of this process instead of a new connection per task
+		self.driver = open_driver(uri, user, password)
 
 		self.database_name = 'neo4j'
 
 	def close(self):
-		# Don't forget to close the driver connection when you are finished with it
-		self.driver.close()
+		# the shared driver is closed once per process by close_driver
+		pass
 
 	@staticmethod
 	def enable_log(level, output_stream):
@@ -25,6 +186,17 @@ class graphApp:
 		logging.getLogger("neo4j").addHandler(handler)
 		logging.getLogger("neo4j").setLevel(level)
 
+	# creates the constraints and indexes in SCHEMA, one schema transaction each
+	def create_schema(self, database = None):
+		if database is None:
+			database = self.database_name
+
+		with self.driver.session(database = database) as session:
+			for statement in SCHEMA:
+				session.run(statement).consume()
+
+			return [record.data() for record in session.run("SHOW INDEXES")]
+
 	# adds a generic node relationship to the neo4j database
 	# this class method is a subset of query_write, but with more structured attributes and fields
 	def generic_action(self, nodeID, label, parentID, relationship, attributes, database = None):
@@ -44,6 +216,28 @@ class graphApp:
 
 				return result
 
+	# adds many generic node relationships in a single transaction
+	# rows is a list of [nodeID, label, parentID, relationship, attributes]
+	# markers, a list of [nodeID, attributes], are set in the same transaction, so they never outlive a failed write
+	def generic_action_batch(self, rows, database = None, markers = None):
+
+		rows = [{"nodeID": nodeID, "label": label, "parentID": parentID, "relationship": relationship.upper(), "attributes": attributes} \
+			for nodeID, label, parentID, relationship, attributes in rows]
+		markers = [{"nodeID": nodeID, "attributes": attributes} for nodeID, attributes in (markers or [])]
+
+		if database is None:
+			with self.driver.session() as session:
+				result = session.write_transaction(
+					self._generic_action_batch, rows, markers)
+
+				return result
+		else:
+			with self.driver.session(database = database) as session:
+				result = session.write_transaction(
+					self._generic_action_batch, rows, markers)
+
+				return result
+
 	def update_metadata(self, nodeID, attributes, database = None):
 
 
@@ -59,31 +253,72 @@ class graphApp:
 					self._update_metadata,  nodeID, attributes)
 
 				return result
+	# updates the metadata of many nodes in a single transaction
+	# rows is a list of [nodeID, attributes]
+	def update_metadata_batch(self, rows, database = None):
+
+		rows = [{"nodeID": nodeID, "attributes": attributes} for nodeID, attributes in rows]
+
+		if database is None:
+			with self.driver.session() as session:
+				result = session.write_transaction(
+					self._update_metadata_batch, rows)
+
+				return result
+		else:
+			with self.driver.session(database = database) as session:
+				result = session.write_transaction(
+					self._update_metadata_batch, rows)
+
+				return result
+
 	# writes any cypher transaction for the neo4j database
-	def query_write(self, query, database = None):
+	# values belong in parameters (see templates.py), so the query text and its plan stay the same across calls
+	def query_write(self, query, database = None, parameters = None):
 		if database is None:
 
 			with self.driver.session() as session:
-				result = session.run(query)
+				result = session.run(query, parameters)
 				record = result.single()
 				print(record)
 				return record
 		else:
 			with self.driver.session(database = database) as session:
-				result = session.run(query)
+				result = session.run(query, parameters)
 				record = result.single()
 				return record
 	# asks the neo4j database to return any query
-	def query(self, query, database = None):
+	def query(self, query, database = None, parameters = None):
 		if database is None:
 			with self.driver.session() as session:
-				result = session.read_transaction(self._query, query)
+				result = session.read_transaction(self._query, query, parameters)
 		else:
 			with self.driver.session(database = database) as session:
-				result = session.read_transaction(self._query, query)
+				result = session.read_transaction(self._query, query, parameters)
+		return result
+
+	# streams the records of a read query into a parquet file at path, one row group per page_size records
+	# the driver fetches page_size records at a time and only the current page is held in memory
+	def query_to_parquet(self, query, path, page_size = 10000, database = None, parameters = None):
+		if database is None:
+			with self.driver.session(fetch_size = page_size) as session:
+				result = session.read_transaction(self._query_to_parquet, query, path, page_size, parameters)
+		else:
+			with self.driver.session(database = database, fetch_size = page_size) as session:
+				result = session.read_transaction(self._query_to_parquet, query, path, page_size, parameters)
 		return result
 	
 	
+	# exports the nodes of NODE_LABELS and the relationships of SNAPSHOT_TYPES between them into parquet tables under path
+	# nodes/label=<label>/part-*.parquet and edges/type=<type>/part-*.parquet, read in one transaction so both match
+	def snapshot(self, path, page_size = 100000, file_rows = 1000000, database = None):
+		if database is None:
+			database = self.database_name
+
+		with self.driver.session(database = database, fetch_size = page_size) as session:
+			result = session.read_transaction(self._snapshot, path, page_size, file_rows)
+		return result
+
 	def load_csv(self, query, database_name):
 		with self.driver.session(database = database_name) as session:
 			result = session.read_transaction(self._load_csv, query)
@@ -91,27 +326,13 @@ class graphApp:
 		return result
 
 		
+	# label is checked against the whitelist of the add_node template instead of being spliced in as given
 	@staticmethod
 	def _generic_action(tx, nodeID, label, parentID, relationship, attributes):
-		relationship = relationship.upper()
-		query = (
-			"MERGE (p1 {nodeID: $nodeID}) "
-			)
+		from neo4j_tasks.tasks.templates import render
 
-		if not attributes is None:
-			query += (
-				f"SET p1:{label} "
-				"SET p1 += $attributes "
-				)
-
-		query += (
-			"WITH p1 "
-			"MATCH (p2) " 
-			"WHERE p2.nodeID = $parentID "
-			"CALL apoc.create.relationship(p2, $relationship, NULL, p1) YIELD rel "
-			"RETURN p2, p1"
-			)
-		print(query)
+		relationship = relationship.upper()
+		query, _ = render("add_node", {"label": label})
 		result = tx.run(query, nodeID = nodeID, parentID = parentID, relationship = relationship, attributes = attributes)
 		try:
 			return [row for row in result]
@@ -121,19 +342,37 @@ class graphApp:
 				query=query, exception=exception))
 			raise
 
+	# labels and relationship types cannot be parameters, so apoc applies them per row
+	# relationships are merged, so writing the output of a stage again does not duplicate them
 	@staticmethod
-	def _update_metadata(tx, nodeID, attributes):
+	def _generic_action_batch(tx, rows, markers = None):
+		from neo4j_tasks.tasks.templates import render
+
 		query = (
-			"MATCH (p1 {nodeID: $nodeID}) "
+			"UNWIND $rows AS row "
+			"CALL apoc.merge.node([row.label], {nodeID: row.nodeID}, coalesce(row.attributes, {}), coalesce(row.attributes, {})) YIELD node "
+			"WITH node AS p1, row "
+			+ match_node('p2', 'row.parentID', ['p1', 'row']) +
+			"CALL apoc.merge.relationship(p2, row.relationship, {}, {}, p1, {}) YIELD rel "
+			"RETURN count(rel) AS count"
 			)
+		try:
+			count = tx.run(query, rows = rows).single()["count"] if rows else 0
+			if markers:
+				query, _ = render("update_metadata_batch")
+				tx.run(query, rows = markers).consume()
+			return count
+		# Capture any errors along with the query and data for traceability
+		except ServiceUnavailable as exception:
+			logging.error("{query} raised an error: \n {exception}".format(
+				query=query, exception=exception))
+			raise
 
-		query += (
-			"SET p1 += $attributes "
-			)
+	@staticmethod
+	def _update_metadata(tx, nodeID, attributes):
+		from neo4j_tasks.tasks.templates import render
 
-		query += (
-			"RETURN p1"
-			)
+		query, _ = render("update_metadata")
 		result = tx.run(query, nodeID = nodeID, attributes = attributes)
 		try:
 			return [row for row in result]
@@ -143,6 +382,20 @@ class graphApp:
 				query=query, exception=exception))
 			raise
 
+	@staticmethod
+	def _update_metadata_batch(tx, rows):
+		from neo4j_tasks.tasks.templates import render
+
+		query, _ = render("update_metadata_batch")
+		result = tx.run(query, rows = rows)
+		try:
+			return result.single()["count"]
+		# Capture any errors along with the query and data for traceability
+		except ServiceUnavailable as exception:
+			logging.error("{query} raised an error: \n {exception}".format(
+				query=query, exception=exception))
+			raise
+
 	@staticmethod
 	def _query_write(tx, query):
 		try:
@@ -153,10 +406,10 @@ class graphApp:
 			raise
 
 	@staticmethod
-	def _query(tx, query):
+	def _query(tx, query, parameters = None):
 		try:
 			results = []
-			result = tx.run(query)
+			result = tx.run(query, parameters)
 			for i in result:
 				results.append(i.data())
 
@@ -166,6 +419,87 @@ class graphApp:
 				query=query, exception=exception))
 			raise
 
+	# a retried transaction starts the file over, since ParquetWriter truncates path
+	@staticmethod
+	def _query_to_parquet(tx, query, path, page_size, parameters = None):
+		import pyarrow as pa
+		import pyarrow.parquet as pq
+
+		writer = None
+		rows = 0
+		try:
+			# Result.fetch only exists from driver 5.x; with 4.4 a page is sliced off the record iterator,
+			# which pulls fetch_size (see query_to_parquet) records from the server at a time
+			records = iter(tx.run(query, parameters))
+			while True:
+				page = [record.data() for record in islice(records, page_size)]
+				if not page:
+					break
+				if writer is None:
+					table = page_table(page)
+					writer = pq.ParquetWriter(path, table.schema)
+				else:
+					table = page_table(page, writer.schema)
+				writer.write_table(table)
+				rows += len(page)
+
+			if writer is None:
+				pq.write_table(pa.table({}), path)
+			return rows
+		except ServiceUnavailable as exception:
+			logging.error("{query} raised an error: \n {exception}".format(
+				query=query, exception=exception))
+			raise
+		finally:
+			if writer is not None:
+				writer.close()
+
+	# surrogate keys are handed out in export order; neo4j ids only map nodes to them within this transaction
+	@staticmethod
+	def _snapshot(tx, path, page_size, file_rows):
+		node_schema, edge_schema = snapshot_schemas()
+		surrogates = {}
+		counts = {"nodes": {}, "edges": {}}
+
+		try:
+			for label in NODE_LABELS:
+				writer = PartitionWriter(os.path.join(path, 'nodes', f"label={label}"), node_schema, file_rows)
+				# pages are sliced off the record iterator, as in _query_to_parquet
+				result = iter(tx.run(f"MATCH (n:{label}) RETURN id(n) AS internal, properties(n) AS properties"))
+				while True:
+					records = list(islice(result, page_size))
+					if not records:
+						break
+					page = []
+					for record in records:
+						# a node under more than one label is exported under the first
+						if record['internal'] in surrogates:
+							continue
+						surrogates[record['internal']] = len(surrogates)
+						page.append(snapshot_row(surrogates[record['internal']], dict(record['properties'])))
+					writer.write(page)
+				writer.close()
+				counts["nodes"][label] = writer.rows
+
+			for relationship in SNAPSHOT_TYPES:
+				writer = PartitionWriter(os.path.join(path, 'edges', f"type={relationship}"), edge_schema, file_rows)
+				result = iter(tx.run(f"MATCH (a)-[:{relationship}]->(b) RETURN id(a) AS source, id(b) AS target"))
+				while True:
+					records = list(islice(result, page_size))
+					if not records:
+						break
+					# edges to nodes outside NODE_LABELS have no surrogate and are left out
+					writer.write([{"source": surrogates[record['source']], "target": surrogates[record['target']]} for record in records \
+						if record['source'] in surrogates and record['target'] in surrogates])
+				writer.close()
+				counts["edges"][relationship] = writer.rows
+
+			return counts
+		except ServiceUnavailable as exception:
+			logging.error("snapshot of {path} raised an error: \n {exception}".format(
+				path=path, exception=exception))
+			raise
+
 	@staticmethod
 	def _load_csv(tx, query):
 		try:
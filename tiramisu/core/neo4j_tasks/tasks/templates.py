@@ -0,0 +1,123 @@
+import re
+
+from neo4j_tasks.tasks.graphApp import NODE_LABELS, match_node
+from tiramisu.utils import TiramisuException
+
+# named cypher queries, called by name from query_neo4j, write_neo4j and the labelstudio tasks
+# values are always $parameters, so neo4j plans each template once and reuses the plan for any value
+# labels cannot be parameters; <<label>> is filled in from NODE_LABELS, giving one plan per label at most
+# statements inside apoc.periodic.iterate get their values through its params config
+
+# every placeholder and the values it accepts
+WHITELIST = {
+	"label": NODE_LABELS,
+}
+
+PLACEHOLDER = re.compile(r"<<(\w+)>>")
+
+TEMPLATES = {
+	# the file to visualize in show_me_in_labelstudio
+	"file_by_node_id": (
+		"MATCH (d:File {nodeID: $nodeID}) "
+		"RETURN d.nodeID AS nodeID, d.tiramisuPath AS file, d.fileExtension AS extension, d.originalPath AS originalPath"
+		),
+
+	# see graphApp.generic_action
+	"add_node": (
+		"MERGE (p1:<<label>> {nodeID: $nodeID}) "
+		"SET p1 += coalesce($attributes, {}) "
+		"WITH p1 "
+		+ match_node('p2', '$parentID', ['p1']) +
+		"CALL apoc.merge.relationship(p2, $relationship, {}, {}, p1, {}) YIELD rel "
+		"RETURN p2, p1"
+		),
+
+	# see graphApp.update_metadata
+	"update_metadata": (
+		match_node('p1', '$nodeID') +
+		"SET p1 += $attributes "
+		"RETURN p1"
+		),
+
+	# see graphApp.update_metadata_batch; $rows is a list of {nodeID, attributes}
+	"update_metadata_batch": (
+		"UNWIND $rows AS row "
+		+ match_node('p1', 'row.nodeID', ['row']) +
+		"SET p1 += row.attributes "
+		"RETURN count(p1) AS count"
+		),
+
+	# files.csv or folders.csv written by start_digest
+	"load_digest_nodes": (
+		"CALL apoc.periodic.iterate("
+		"\"LOAD CSV WITH HEADERS FROM $file AS row RETURN row\", "
+		"\"MERGE (p1:<<label>> {nodeID: row.NodeID}) "
+		"SET p1 += {name: row.Name, tiramisuPath: row.TiramisuPath, originalPath: row.OriginalPath, fileExtension: row.FileExtension, fileHash: row.FileHash}\", "
+		"{batchSize: 10000, parallel: true, params: {file: $file}})"
+		),
+
+	# relationships.csv written by start_digest; parents are always folders
+	"load_digest_relationships": (
+		"CALL apoc.periodic.iterate("
+		"\"LOAD CSV WITH HEADERS FROM $file AS row RETURN row\", "
+		"\"MATCH (p2:Folder {nodeID: row.Parent}) "
+		"OPTIONAL MATCH (f:File {nodeID: row.Child}) OPTIONAL MATCH (d:Folder {nodeID: row.Child}) "
+		"WITH row, p2, coalesce(f, d) AS p1 WHERE p1 IS NOT NULL "
+		"CALL apoc.create.relationship(p2, row.Relationship, {}, p1) YIELD rel RETURN rel\", "
+		"{batchSize: 10000, parallel: true, params: {file: $file}})"
+		),
+
+	# moved.csv of an incremental digest: the node is kept and re-attached to its new folder
+	"load_digest_moved": (
+		"CALL apoc.periodic.iterate("
+		"\"LOAD CSV WITH HEADERS FROM $file AS row RETURN row\", "
+		"\"MATCH (p1:File {nodeID: row.NodeID}) SET p1.originalPath = row.OriginalPath "
+		"WITH p1, row OPTIONAL MATCH (:Folder)-[r:CONTAINS]->(p1) DELETE r "
+		"WITH DISTINCT p1, row MATCH (p2:Folder {nodeID: row.Parent}) MERGE (p2)-[:CONTAINS]->(p1)\", "
+		"{batchSize: 10000, parallel: false, params: {file: $file}})"
+		),
+
+	# removed.csv of an incremental digest: flagged rather than deleted, since derived documents may still point at them
+	"load_digest_removed": (
+		"CALL apoc.periodic.iterate("
+		"\"LOAD CSV WITH HEADERS FROM $file AS row RETURN row\", "
+		"\"OPTIONAL MATCH (f:File {nodeID: row.NodeID}) OPTIONAL MATCH (d:Folder {nodeID: row.NodeID}) "
+		"WITH coalesce(f, d) AS p1 WHERE p1 IS NOT NULL SET p1.removed = true "
+		"WITH p1 OPTIONAL MATCH (:Folder)-[r:CONTAINS]->(p1) DELETE r\", "
+		"{batchSize: 10000, parallel: false, params: {file: $file}})"
+		),
+
+	# File nodes merged on the properties in $columns, a list of [property, csv column] pairs (see load_csv_neo4j)
+	"load_csv_nodes": (
+		"CALL apoc.periodic.iterate("
+		"\"LOAD CSV WITH HEADERS FROM $file AS row RETURN row\", "
+		"\"CALL apoc.merge.node(['File'], apoc.map.fromPairs([column IN $columns | [column[0], row[column[1]]]])) YIELD node RETURN node\", "
+		"{batchSize: 10000, parallel: true, params: {file: $file, columns: $columns}})"
+		),
+
+	# Relationship, Child and Parent columns, between nodes of any label (see load_csv_neo4j)
+	"load_csv_relationships": (
+		"CALL apoc.periodic.iterate("
+		"\"LOAD CSV WITH HEADERS FROM $file AS row RETURN row\", "
+		"\"WITH row.Relationship AS relationship, row.Child AS child, row.Parent AS parent "
+		+ match_node('p2', 'parent', ['relationship', 'child']) + match_node('p1', 'child', ['relationship', 'p2']) +
+		"CALL apoc.create.relationship(p2, relationship, {}, p1) YIELD rel RETURN rel\", "
+		"{batchSize: 10000, parallel: true, params: {file: $file}})"
+		),
+}
+
+
+# the cypher text of template name and the parameters to run it with
+# placeholders are taken out of parameters and checked against WHITELIST
+def render(name, parameters = None):
+	if name not in TEMPLATES:
+		raise TiramisuException(f"{name} is not a registered query template.")
+
+	parameters = dict(parameters or {})
+	values = {}
+	for placeholder in set(PLACEHOLDER.findall(TEMPLATES[name])):
+		values[placeholder] = parameters.pop(placeholder, None)
+		if values[placeholder] not in WHITELIST[placeholder]:
+			raise TiramisuException(f"{values[placeholder]} is not a valid {placeholder} for {name}; expected one of {WHITELIST[placeholder]}.")
+
+	return PLACEHOLDER.sub(lambda match: values[match.group(1)], TEMPLATES[name]), parameters
@@ -1,17 +1,42 @@
 from celery import signature, shared_task
 
 from neo4j_tasks.tasks.graphApp import graphApp
+from neo4j_tasks.tasks.cache import query_cache, bump_generation, current_generation
+from neo4j_tasks.tasks.templates import render
+from tiramisu.metrics import record_items
+from tiramisu.utils import API_URL
+from tiramisu.claims import claim, resolve
 from urllib import request, parse
+import importlib
 import json 
 import os
+import time
+import uuid
 
-URL = "bolt://neo4j:7687"
+# NEO4J_URL points the tasks at another server, e.g. the throwaway one of digest/benchmark.py
+URL = os.environ.get('NEO4J_URL', "bolt://neo4j:7687")
 # password can be changed in docker (see core/docker-compose.yaml line 20)
 pw = os.environ['NEO4J_PASSWORD']
 
 
 
 
+# creates the nodeID constraints and the fileHash index (see SCHEMA in graphApp)
+# runs before the first digest load; without them every lookup by nodeID scans the whole graph
+@shared_task(name = "create_schema_neo4j")
+def create_schema_neo4j(database = None):
+	app = graphApp(URL, "neo4j", pw)
+
+	result = app.create_schema(database)
+	# runs after a bulk import, which replaced the graph behind the back of the query cache
+	bump_generation()
+
+	return {
+		"status": "completed",
+		"result": result
+	}
+
+
 @shared_task(name =  "add_node_neo4j")
 def add_node_neo4j(nodeID, label, parentID, relationship, attributes = None):
 
@@ -19,24 +44,49 @@ def add_node_neo4j(nodeID, label, parentID, relationship, attributes = None):
 
 	result = app.generic_action(nodeID = nodeID, label = label, parentID = parentID, \
 	relationship = relationship, attributes = attributes )
-
+	bump_generation()
 
 	return {
 	"status": "completed"
 	}
 
 
-# prone to sql injection
-# avoid using
-# included just for debugging purposes
+# adds many nodes with one UNWIND transaction
+# rows is a list of [nodeID, label, parentID, relationship, attributes]
+# markers, a list of [nodeID, attributes], are updated in the same transaction (see write_nodes_digest)
+@shared_task(name = "add_nodes_batch_neo4j")
+def add_nodes_batch_neo4j(rows, database = None, markers = None):
+	rows, markers = resolve(rows), resolve(markers)
+
+	app = graphApp(URL, 'neo4j', pw)
+	record_items(len(rows))
+
+	if database is None:
+		result = app.generic_action_batch(rows, markers = markers)
+	else:
+		result = app.generic_action_batch(rows, database, markers)
+	bump_generation()
+
+	return {
+	"status": "completed",
+	"result": result
+	}
+
+
+# a free-form query is prone to sql injection
+# avoid using it other than for debugging; call a template of templates.py by name with its parameters instead
 @shared_task(name = "write_neo4j")
-def write_neo4j(query, database = None):
+def write_neo4j(query = None, database = None, template = None, parameters = None):
 	app = graphApp(URL, "neo4j", pw)
 
+	if template is not None:
+		query, parameters = render(template, parameters)
+
 	if database is None:
-		result = app.query_write(query)
+		result = app.query_write(query, parameters = parameters)
 	else:
-		result = app.query_write(query, database)
+		result = app.query_write(query, database, parameters)
+	bump_generation()
 
 	return {
 		"status": "completed"
@@ -50,58 +100,135 @@ def update_metadata_neo4j(nodeID, attributes, database = None):
 		result = app.update_metadata(nodeID = nodeID, attributes = attributes)
 	else:
 		result = app.update_metadata(nodeID = nodeID, attributes = attributes, database = database)
+	bump_generation()
 
 	return {
 		"status": "completed"
 	}
 
 
+# updates the metadata of many nodes with one UNWIND transaction
+# rows is a list of [nodeID, attributes]
+@shared_task(name = "update_metadata_batch_neo4j")
+def update_metadata_batch_neo4j(rows, database = None):
+	rows = resolve(rows)
+	app = graphApp(URL, "neo4j", pw)
+	record_items(len(rows))
+
+	if database is None:
+		result = app.update_metadata_batch(rows)
+	else:
+		result = app.update_metadata_batch(rows, database)
+	bump_generation()
+
+	return {
+		"status": "completed",
+		"result": result
+	}
+
+
 # only gets read permission 
+# template runs a query of templates.py by name, with its values in parameters
+# results are cached per worker process until the next write task (see cache.py); cache = False always asks neo4j
+# artifact streams the records page_size at a time into .tiramisu/queries/<artifact>.parquet and returns
+# only its handle, for results too large to travel through the result backend; fetch it from /api/artifact/<artifact>
+# claim_result returns a large result as a claim instead (see tiramisu.claims), for chains that hand it to a worker task
 @shared_task(name = "query_neo4j")
-def query_neo4j(query, database = 'neo4j'):
+def query_neo4j(query = None, database = 'neo4j', artifact = False, page_size = 10000, cache = True, template = None, parameters = None, claim_result = False):
 	app = graphApp(URL, "neo4j", pw)
 
+	if template is not None:
+		query, parameters = render(template, parameters)
+
+	if artifact:
+		return query_to_artifact(app, query, database, page_size, parameters)
+
+	if cache:
+		# read before the query runs, so a write landing meanwhile leaves this result under the older generation
+		key = query_cache.key(query, parameters, database, current_generation())
+		result = query_cache.get(key)
+		if result is not None:
+			return claim(result) if claim_result else result
+
 	if database is None:  
-		result = app.query(query)
+		result = app.query(query, parameters = parameters)
 	else:
-		result = app.query(query, database)
+		result = app.query(query, database, parameters)
+
+	if cache:
+		query_cache.put(key, result)
 	
-	return result
+	return claim(result) if claim_result else result
 
-@shared_task(name = "load_csv_neo4j")
-def load_csv_neo4j(node_csv, relationship_csv, attribute_name):
+# hit and miss counts of the query cache, summed over every worker process, and the state of the process that ran it
+@shared_task(name = "query_cache_stats_neo4j")
+def query_cache_stats_neo4j():
+	return query_cache.stats()
+
+# not inside workspace.createContext(), which would swallow a failed query and hand out a missing artifact
+def query_to_artifact(app, query, database, page_size, parameters = None):
+	workspace = importlib.import_module('tiramisu.worker').workspace
+
+	folder = workspace.config.root / '.tiramisu' / 'queries'
+	folder.mkdir(parents = True, exist_ok = True)
+
+	artifact = uuid.uuid4().hex
+	path = folder / f"{artifact}.parquet"
+	# renamed once complete, so a half-written artifact is never served
+	partial = folder / f"{artifact}.parquet.partial"
+
+	rows = app.query_to_parquet(query, partial.as_posix(), page_size, database, parameters)
+	partial.rename(path)
+
+	return {
+		"status": "completed",
+		"artifact": artifact,
+		"rows": rows
+	}
+
+# materializes the archive graph into parquet tables under .tiramisu/snapshots/<snapshot>, for analyses that do not need
+# a running graph (see read_snapshot in src/utils_tiramisu.py); LATEST in the snapshots folder names the newest one
+@shared_task(name = "snapshot_neo4j")
+def snapshot_neo4j(database = 'neo4j', page_size = 100000, file_rows = 1000000):
 	app = graphApp(URL, "neo4j", pw)
+	workspace = importlib.import_module('tiramisu.worker').workspace
 
-	query = (f"CALL apoc.periodic.iterate( \"LOAD CSV WITH HEADERS FROM 'file:///{node_csv}.csv'")
-	
-	query += (" as row with row where linenumber() > 0 return row\",\"with ")
+	folder = workspace.config.root / '.tiramisu' / 'snapshots'
+	snapshot = time.strftime("%Y%m%d-%H%M%S")
+	path = folder / snapshot
+	# renamed once complete, so a reader never opens a half-written snapshot
+	partial = folder / f"{snapshot}.partial"
+	partial.mkdir(parents = True)
 
-	for i in attribute_name:
-		renamed = i.capitalize()
-		query += (f"row.{renamed} as {i}, ")
-	
-	query += ("MERGE (p1: File {")
-	
-	for i in attribute_name:
-		query += (f"{i}: {i}, ")
+	generation = current_generation()
+	counts = app.snapshot(partial.as_posix(), page_size, file_rows, database)
 
-	query += ("})\",{batchSize:10000, parallel:true})")
+	with open(partial / 'manifest.json', 'w') as f:
+		json.dump({"snapshot": snapshot, "database": database, "generation": generation, "counts": counts}, f, indent = 2)
+	partial.rename(path)
+	(folder / 'LATEST').write_text(snapshot)
 
-	relationship_query = (f"CALL apoc.periodic.iterate( \"LOAD CSV WITH HEADERS FROM 'file:///{relationship_csv}.csv'" )
-	
-	relationship_query += ("as row with row where linenumber() > 0 return row\", \"with row.Relationship as relationship, row.Child as child, row.Parent as parent MATCH (p2) WHERE p2.nodeID = parent MATCH (p1) WHERE p1.nodeID = child CALL apoc.create.relationship(p2, relationship, {}, p1) YIELD rel return rel\",{batchSize:10000, parallel:true});")
+	return {
+		"status": "completed",
+		"snapshot": snapshot,
+		"counts": counts
+	}
 
+# loads <node_csv>.csv as File nodes merged on attribute_name (read from the capitalized columns)
+# and <relationship_csv>.csv as relationships, through the load_csv_* templates
+@shared_task(name = "load_csv_neo4j")
+def load_csv_neo4j(node_csv, relationship_csv, attribute_name):
 	data = json.dumps({ 
 				"action_list": [
-					{"action": "write",
-				"kwargs": {"query": query}
+					{"action": "write_neo4j",
+				"kwargs": {"template": "load_csv_nodes", "parameters": {"file": f"file:///{node_csv}.csv", "columns": [[i, i.capitalize()] for i in attribute_name]}}
 				},
 				{ 
-					"action": "write",
-					"kwargs": {"query": relationship_query}
+					"action": "write_neo4j",
+					"kwargs": {"template": "load_csv_relationships", "parameters": {"file": f"file:///{relationship_csv}.csv"}}
 				}] 
 			}).encode()
-	req = request.Request("http://flask:5000/api/action/chain", data)
+	req = request.Request(f"{API_URL}/api/action/chain", data)
 	req.add_header("Content-Type", "application/json")
 	res = request.urlopen(req)
 	result = json.loads(res.read())
@@ -2,15 +2,20 @@ use crc32fast;
 use infer;
 use jwalk::WalkDirGeneric;
 use maplit;
+use pyo3::exceptions::PyRuntimeError;
 use pyo3::prelude::*;
+use rayon::prelude::*;
 use sha256::try_digest;
 use std::env;
 use std::ffi::OsStr;
 use std::fs;
 use std::io;
+use std::os::unix::fs::MetadataExt;
 use std::path::{Path, PathBuf};
 use std::str;
-use std::collections::HashSet;
+use std::sync::mpsc;
+use std::thread;
+use std::collections::{HashMap, HashSet};
 
 /// Available error types in Tiramisu digestion phase
 ///
@@ -50,11 +55,45 @@ struct RelationshipRecord {
     child: String,
 }
 
-// Struct to contain all relationships and objects
-struct Dataset {
-    folders: Vec<TiramisuRecord>,
-    files: Vec<TiramisuRecord>,
-    relationships: Vec<RelationshipRecord>,
+/// Filesystem facts used to decide whether a file changed since the last digest
+///
+/// mtime is kept as "seconds.nanoseconds" so it round-trips through the manifest unchanged
+#[derive(Clone, PartialEq)]
+struct FileStat {
+    size: u64,
+    mtime: String,
+    inode: u64,
+}
+
+/// One row of .tiramisu/manifest.csv, keyed by original_path
+///
+/// file_hash holds the depth for folders, as it does in folders.csv
+#[derive(Clone)]
+struct ManifestEntry {
+    original_path: String,
+    node_type: String,
+    stat: FileStat,
+    file_hash: String,
+    node_id: String,
+}
+
+// Struct to contain a file that kept its content but changed location
+struct MovedRecord {
+    node_id: String,
+    original_path: String,
+    parent: String,
+}
+
+/// Outcome of digesting one walked entry
+///
+/// Moved carries the manifest entry of the vanished file with the same hash, and the record
+/// the file would get as a new node in case another path already claimed that node
+enum Digested {
+    File(TiramisuRecord, RelationshipRecord, ManifestEntry),
+    Folder(TiramisuRecord, RelationshipRecord, ManifestEntry),
+    Moved(ManifestEntry, TiramisuRecord, RelationshipRecord, ManifestEntry),
+    Unchanged(ManifestEntry),
+    Skipped,
 }
 
 /// Throw Tiramisu errors during parallel walking of filesystem
@@ -141,20 +180,598 @@ fn change_file_name(path: impl AsRef<Path>, name: &str, new_extension: &str) ->
     result
 }
 
+/// Read size, mtime and inode without touching the file contents
+fn file_stat(path: &PathBuf) -> FileStat {
+    match fs::metadata(path) {
+        Ok(metadata) => FileStat {
+            size: metadata.size(),
+            mtime: format!("{}.{:09}", metadata.mtime(), metadata.mtime_nsec()),
+            inode: metadata.ino(),
+        },
+        // an unreadable stat never matches the manifest, so the file is hashed again
+        Err(_) => FileStat {
+            size: 0,
+            mtime: String::new(),
+            inode: 0,
+        },
+    }
+}
+
+/// Load the manifest written by the previous digest, keyed by original path
+///
+/// a missing or unreadable manifest means everything is digested from scratch
+fn read_manifest(path: &PathBuf) -> HashMap<String, ManifestEntry> {
+    let mut manifest = HashMap::new();
+    let mut reader = match csv::Reader::from_path(path) {
+        Ok(reader) => reader,
+        Err(_) => return manifest,
+    };
+    for result in reader.records() {
+        let row = match result {
+            Ok(row) => row,
+            Err(error) => {
+                println!("{} error in manifest row", error);
+                continue;
+            }
+        };
+        let field = |i: usize| row.get(i).unwrap_or("").to_string();
+        let entry = ManifestEntry {
+            original_path: field(0),
+            node_type: field(1),
+            stat: FileStat {
+                size: field(2).parse().unwrap_or(0),
+                mtime: field(3),
+                inode: field(4).parse().unwrap_or(0),
+            },
+            file_hash: field(5),
+            node_id: field(6),
+        };
+        manifest.insert(entry.original_path.clone(), entry);
+    }
+    manifest
+}
+
+/// Entries hashed per chunk before the chunk is handed to the CSV writers
+const DIGEST_CHUNK: usize = 1024;
+
+/// Chunks that may wait for the writers before hashing pauses, which bounds the rows held
+/// between hashing and writing (the walked paths and the manifest are still held whole, see digest)
+const CHANNEL_BOUND: usize = 4;
+
+const NODE_HEADERS: [&str; 7] = [
+    "Name",
+    "NodeID",
+    "TiramisuPath",
+    "OriginalPath",
+    "FileExtension",
+    "NodeType",
+    "FileHash",
+];
+
+/// Same columns as NODE_HEADERS in the header format of neo4j-admin import
+///
+/// nodeID becomes the import ID (and stays a property); the label comes from the --nodes option
+const BULK_NODE_HEADERS: [&str; 7] = [
+    "name",
+    "nodeID:ID",
+    "tiramisuPath",
+    "originalPath",
+    "fileExtension",
+    "nodeType:IGNORE",
+    "fileHash",
+];
+
+const RELATIONSHIP_HEADERS: [&str; 3] = ["Relationship", "Parent", "Child"];
+
+const BULK_RELATIONSHIP_HEADERS: [&str; 3] = [":TYPE", ":START_ID", ":END_ID"];
+
+const MANIFEST_HEADERS: [&str; 7] = [
+    "OriginalPath",
+    "NodeType",
+    "Size",
+    "Mtime",
+    "Inode",
+    "FileHash",
+    "NodeID",
+];
+
+/// Last walked entry whose rows are on disk, and the length of every output at that point
+///
+/// kept in .tiramisu/neo4j/import/digest.resume and removed once a digest completes
+struct ResumeMarker {
+    incremental: bool,
+    bulk_import: bool,
+    last_path: String,
+    lengths: Vec<u64>,
+}
+
+fn read_resume_marker(path: &PathBuf) -> Option<ResumeMarker> {
+    let mut reader = csv::Reader::from_path(path).ok()?;
+    let row = reader.records().next()?.ok()?;
+    let lengths: Option<Vec<u64>> = (3..8)
+        .map(|i| row.get(i).and_then(|length| length.parse().ok()))
+        .collect();
+    Some(ResumeMarker {
+        incremental: row.get(0)? == "true",
+        bulk_import: row.get(1)? == "true",
+        last_path: row.get(2)?.to_string(),
+        lengths: lengths?,
+    })
+}
+
+/// Replace the resume marker; written next to it first so a crash never leaves half a marker
+fn write_resume_marker(path: &PathBuf, marker: &ResumeMarker) -> io::Result<()> {
+    let temporary = path.with_extension("resume.tmp");
+    let mut wtr = csv::Writer::from_path(&temporary)?;
+    wtr.write_record(&[
+        "Incremental",
+        "BulkImport",
+        "LastPath",
+        "Files",
+        "Folders",
+        "Relationships",
+        "Moved",
+        "Manifest",
+    ])?;
+    let mut row = vec![
+        marker.incremental.to_string(),
+        marker.bulk_import.to_string(),
+        marker.last_path.clone(),
+    ];
+    row.extend(marker.lengths.iter().map(|length| length.to_string()));
+    wtr.write_record(&row)?;
+    wtr.flush()?;
+    fs::rename(&temporary, path)
+}
+
+/// Open one streamed output
+///
+/// on resume the file is cut back to the length in the marker, dropping rows written
+/// after the last completed chunk, and appended to without a second header
+fn open_csv(path: &PathBuf, headers: &[&str], resume_from: Option<u64>) -> io::Result<csv::Writer<fs::File>> {
+    match resume_from {
+        Some(length) => {
+            let file = fs::OpenOptions::new().append(true).open(path)?;
+            file.set_len(length)?;
+            Ok(csv::Writer::from_writer(file))
+        }
+        None => {
+            let mut wtr = csv::Writer::from_path(path)?;
+            wtr.write_record(headers)?;
+            Ok(wtr)
+        }
+    }
+}
+
+/// CSV outputs of one digest, fed while the walk is still being hashed
+///
+/// manifest rows go to manifest.csv.tmp, which replaces manifest.csv once the digest completes
+/// bulk_import writes the node and relationship headers for neo4j-admin import instead of LOAD CSV
+struct DigestWriters {
+    paths: [PathBuf; 5],
+    files: csv::Writer<fs::File>,
+    folders: csv::Writer<fs::File>,
+    relationships: csv::Writer<fs::File>,
+    moved: csv::Writer<fs::File>,
+    manifest: csv::Writer<fs::File>,
+}
+
+impl DigestWriters {
+    fn open(
+        import_path: &PathBuf,
+        manifest_path: &PathBuf,
+        bulk_import: bool,
+        resume_from: Option<&ResumeMarker>,
+    ) -> io::Result<DigestWriters> {
+        let (node_headers, relationship_headers) = if bulk_import {
+            (BULK_NODE_HEADERS, BULK_RELATIONSHIP_HEADERS)
+        } else {
+            (NODE_HEADERS, RELATIONSHIP_HEADERS)
+        };
+        let paths = [
+            import_path.join("files.csv"),
+            import_path.join("folders.csv"),
+            import_path.join("relationships.csv"),
+            import_path.join("moved.csv"),
+            manifest_path.with_extension("csv.tmp"),
+        ];
+        let length = |i: usize| resume_from.map(|marker| marker.lengths[i]);
+        Ok(DigestWriters {
+            files: open_csv(&paths[0], &node_headers, length(0))?,
+            folders: open_csv(&paths[1], &node_headers, length(1))?,
+            relationships: open_csv(&paths[2], &relationship_headers, length(2))?,
+            moved: open_csv(&paths[3], &["NodeID", "OriginalPath", "Parent"], length(3))?,
+            manifest: open_csv(&paths[4], &MANIFEST_HEADERS, length(4))?,
+            paths: paths,
+        })
+    }
+
+    /// Flush every output and return their lengths for the resume marker
+    fn flush(&mut self) -> io::Result<Vec<u64>> {
+        self.files.flush()?;
+        self.folders.flush()?;
+        self.relationships.flush()?;
+        self.moved.flush()?;
+        self.manifest.flush()?;
+        self.paths
+            .iter()
+            .map(|path| fs::metadata(path).map(|metadata| metadata.len()))
+            .collect()
+    }
+}
+
+fn serialize_record(wtr: &mut csv::Writer<fs::File>, row: TiramisuRecord) -> csv::Result<()> {
+    wtr.serialize((
+        row.name,
+        row.node_id,
+        row.tiramisu_path,
+        row.original_path,
+        row.file_extension,
+        row.node_type,
+        row.file_hash,
+    ))
+}
+
+fn serialize_relationship(wtr: &mut csv::Writer<fs::File>, row: RelationshipRecord) -> csv::Result<()> {
+    wtr.serialize((row.relationship, row.parent, row.child))
+}
+
+fn serialize_manifest_entry(wtr: &mut csv::Writer<fs::File>, entry: &ManifestEntry) -> csv::Result<()> {
+    wtr.serialize((
+        &entry.original_path,
+        &entry.node_type,
+        entry.stat.size,
+        &entry.stat.mtime,
+        entry.stat.inode,
+        &entry.file_hash,
+        &entry.node_id,
+    ))
+}
+
+/// Write the rows of one digested entry
+///
+/// index is the entry's position in the walk; the first entry is the root itself,
+/// whose parent is outside the archive
+/// kept collects the nodes of the previous manifest that survive, and decides which
+/// of several new copies of a vanished file takes over its node
+fn write_digested(
+    writers: &mut DigestWriters,
+    index: usize,
+    item: Digested,
+    known: &HashSet<&String>,
+    kept: &mut HashSet<String>,
+) -> io::Result<()> {
+    let entry = match item {
+        Digested::File(record, relationship_record, entry) => {
+            serialize_record(&mut writers.files, record)?;
+            serialize_relationship(&mut writers.relationships, relationship_record)?;
+            entry
+        }
+        Digested::Folder(record, relationship_record, entry) => {
+            serialize_record(&mut writers.folders, record)?;
+            if index > 0 {
+                serialize_relationship(&mut writers.relationships, relationship_record)?;
+            }
+            entry
+        }
+        Digested::Moved(moved_from, record, relationship_record, entry) => {
+            if !kept.contains(&moved_from.node_id) {
+                writers.moved.serialize((
+                    &moved_from.node_id,
+                    &record.original_path,
+                    &relationship_record.parent,
+                ))?;
+                ManifestEntry {
+                    node_id: moved_from.node_id,
+                    ..entry
+                }
+            } else {
+                // a second copy of the moved content becomes a node of its own
+                store_file(Path::new(&record.original_path), &PathBuf::from(&record.tiramisu_path));
+                serialize_record(&mut writers.files, record)?;
+                serialize_relationship(&mut writers.relationships, relationship_record)?;
+                entry
+            }
+        }
+        Digested::Unchanged(entry) => entry,
+        Digested::Skipped => return Ok(()),
+    };
+    serialize_manifest_entry(&mut writers.manifest, &entry)?;
+    if known.contains(&entry.node_id) {
+        kept.insert(entry.node_id);
+    }
+    Ok(())
+}
+
+/// Copy a digested file into its nodeID folder in tiramisu versions and lock it
+fn store_file(valid_path: &Path, full_tiramisu_path: &PathBuf) {
+    // make nodeID folder in tiramisu versions
+    let node_folder = full_tiramisu_path.parent().unwrap();
+    if !node_folder.exists() {
+        match fs::create_dir(node_folder) {
+            Ok(_) => println!("{} digested", valid_path.to_str().unwrap()),
+            Err(e) => println!("{} error in making {}", e, node_folder.to_str().unwrap()),
+        }
+    }
+
+    // copy file to tiramisu versions with new nodeID
+    let _ = fs::copy(valid_path, full_tiramisu_path);
+
+    // lock files in read_only
+    set_readonly(full_tiramisu_path.clone());
+}
+
+/// Hash, sniff, copy and record a single walked entry
+///
+/// runs on the rayon pool, so it only touches its own file and its own nodeID folder
+/// entries whose size, mtime and inode match the manifest are not read at all
+/// a new file whose hash belongs to a vanished manifest entry is reported as Moved and not copied
+fn digest_entry(
+    valid_path: &PathBuf,
+    core_path: &PathBuf,
+    tiramisu_path: &PathBuf,
+    map: &HashMap<&str, &str>,
+    manifest: &HashMap<String, ManifestEntry>,
+    vanished: &HashMap<String, ManifestEntry>,
+) -> Digested {
+    let original_path = valid_path.as_path().to_string_lossy().into_owned();
+    let valid_extension = valid_path
+        .extension()
+        .unwrap_or(OsStr::new(""))
+        .to_str()
+        .unwrap();
+    let valid_filename = valid_path
+        .file_name()
+        .unwrap_or(OsStr::new(""))
+        .to_str()
+        .unwrap();
+    let correct_extension: String;
+    let mut newpath: PathBuf;
+    let relationship: String;
+
+    let exceptions: HashSet<_> = ["pptx", "ppt", "xls", "doc", "xlsx", "docx"].iter().cloned().collect();
+
+    // check the magic number signature to ensure that it's supported
+    if valid_path.is_file() && valid_filename != "" && (infer::is_supported(valid_extension) || exceptions.contains(valid_extension))
+    {
+        // untouched since the last digest, so neither hashed nor copied again
+        let stat = file_stat(valid_path);
+        let previous = manifest.get(&original_path);
+        if let Some(previous) = previous {
+            if previous.stat == stat {
+                return Digested::Unchanged(previous.clone());
+            }
+        }
+
+        let final_result;
+        let result =
+            infer::get_from_path(valid_path.as_path()).expect("file read successfully");
+
+        if let None = result {
+            println!("skipping {}", valid_filename);
+        } else {
+            final_result = result.expect("");
+            if map.contains_key(final_result.mime_type()) {
+                let matched = match map.get(final_result.mime_type()) {
+                    Some(s) => s,
+                    None => "",
+                };
+
+                // if the detected extension is not what it was named, either rename with the correct extension
+                // or leave it as is (docx, pptx, and xlsx will fall here)
+                if matched != valid_extension {
+                    
+                    // correct extension
+                    correct_extension =
+                        map.get(final_result.mime_type()).unwrap().to_string();
+                    newpath = PathBuf::from(valid_filename);
+                    newpath = change_file_name(newpath, valid_filename, &correct_extension);
+                } else {
+                    correct_extension = valid_extension.to_string();
+                    newpath = PathBuf::from(valid_filename);
+                }
+            } else {
+                println!("{} is not part of the valid set of extensions. Not checking for correction. ", final_result.mime_type());
+                correct_extension = valid_extension.to_string();
+                newpath = PathBuf::from(valid_filename);
+            }
+            let mut owned_string = newpath.into_os_string().into_string().unwrap();
+            // strip whitespace from filepath
+            remove_whitespace(&mut owned_string);
+
+            // assign nodeID for file
+            let hash = hash_file(&valid_path);
+
+            // only the timestamps changed
+            if let Some(previous) = previous {
+                if previous.file_hash == hash {
+                    return Digested::Unchanged(ManifestEntry {
+                        stat: stat,
+                        ..previous.clone()
+                    });
+                }
+            }
+
+            let node_id = assign_node_id(
+                &hash,
+                &valid_path
+                    .strip_prefix(core_path.parent().expect(""))
+                    .unwrap()
+                    .to_path_buf(),
+            );
+
+            let full_tiramisu_path = tiramisu_path.join(&node_id).join(&owned_string);
+
+            // get the nodeID of the parent folder
+            let mut parent_path = valid_path
+                .parent()
+                .unwrap()
+                .strip_prefix(core_path.parent().expect(""))
+                .unwrap()
+                .to_path_buf()
+                .into_os_string()
+                .into_string()
+                .unwrap();
+            remove_whitespace(&mut parent_path);
+            let parent_depth =
+                calculate_depth(&PathBuf::from(valid_path.parent().unwrap())).to_string();
+            let parent_node_id =
+                assign_folder_id(&parent_depth, &PathBuf::from(parent_path));
+
+            // all relationships are "CONTAINS" for folder-file
+            // deprecated, but leaving here for debugging purposes
+            relationship = String::from("CONTAINS");
+            
+            // save into dataset records
+            let temp_record = TiramisuRecord {
+                name: String::from(
+                    PathBuf::from(&owned_string)
+                        .file_name()
+                        .unwrap()
+                        .to_str()
+                        .unwrap(),
+                ),
+                node_id: node_id.clone(),
+                tiramisu_path: full_tiramisu_path.to_string_lossy().into_owned(),
+                original_path: original_path.clone(),
+                file_extension: correct_extension.to_string(),
+                node_type: String::from("File"),
+                file_hash: hash.clone(),
+                // parent_node_id: parent_node_id,
+                // relationship: relationship,
+            };
+
+            let relationship_record = RelationshipRecord {
+                relationship: relationship,
+                parent: parent_node_id,
+                child: node_id.clone(),
+            };
+
+            let entry = ManifestEntry {
+                original_path: original_path,
+                node_type: String::from("File"),
+                stat: stat,
+                file_hash: hash.clone(),
+                node_id: node_id,
+            };
+
+            // same content as a file that is gone: keep its node and its copy
+            if let Some(moved_from) = vanished.get(&hash) {
+                return Digested::Moved(moved_from.clone(), temp_record, relationship_record, entry);
+            }
+
+            store_file(valid_path.as_path(), &full_tiramisu_path);
+
+            return Digested::File(temp_record, relationship_record, entry);
+        }
+        
+        // if corrected, and combined_to relationships
+    } else if valid_path.is_dir() && valid_filename != "" {
+        // folder nodeIDs only depend on the path, so a known folder is already in the graph
+        if let Some(previous) = manifest.get(&original_path) {
+            return Digested::Unchanged(previous.clone());
+        }
+
+        let mut parent_path = valid_path
+            .parent()
+            .unwrap()
+            .strip_prefix(core_path.parent().expect(""))
+            .unwrap()
+            .to_path_buf()
+            .into_os_string()
+            .into_string()
+            .unwrap();
+        remove_whitespace(&mut parent_path);
+        let parent_depth =
+            calculate_depth(&PathBuf::from(valid_path.parent().unwrap())).to_string();
+        let parent_node_id = assign_folder_id(&parent_depth, &PathBuf::from(&parent_path));
+
+        let mut node_path = valid_path
+            .strip_prefix(core_path.parent().expect(""))
+            .unwrap()
+            .to_path_buf()
+            .into_os_string()
+            .into_string()
+            .unwrap();
+        remove_whitespace(&mut node_path);
+        let node_depth = calculate_depth(&valid_path).to_string();
+        let node_id = assign_folder_id(&node_depth, &PathBuf::from(&node_path));
+        // strip whitespace from folder name
+        // assign nodeID for folder based on depth and name
+        // save into dataset records
+        relationship = String::from("CONTAINS");
+
+        let temp_record = TiramisuRecord {
+            name: String::from(
+                PathBuf::from(&node_path)
+                    .file_name()
+                    .unwrap()
+                    .to_str()
+                    .unwrap(),
+            ),
+            node_id: node_id.clone(),
+            tiramisu_path: node_path,
+            original_path: original_path.clone(),
+            file_extension: String::from("folder"),
+            node_type: String::from("Folder"),
+            file_hash: node_depth.clone(),
+            // parent_node_id: parent_node_id,
+            // relationship: relationship,
+        };
+
+        let relationship_record = RelationshipRecord {
+            relationship: relationship,
+            parent: parent_node_id,
+            child: node_id.clone(),
+        };
+
+        let entry = ManifestEntry {
+            original_path: original_path,
+            node_type: String::from("Folder"),
+            stat: file_stat(valid_path),
+            file_hash: node_depth,
+            node_id: node_id,
+        };
+
+        return Digested::Folder(temp_record, relationship_record, entry);
+    }
+    Digested::Skipped
+}
+
 /// Main digest function to walk through all of the folders and create Tiramisu objects
 /// 
 /// keep track of all files and relationships to be exported to a graph database
 /// tiramisu files with renamed unique IDs are copied to /tiramisu/.tiramisu/____tiramisu_versions
+/// threads sets the size of the hashing and copying pool (0 uses one thread per core)
+/// incremental reuses .tiramisu/manifest.csv so only new or changed files are hashed and copied;
+/// files.csv, folders.csv and relationships.csv then hold only the new nodes, and
+/// removed.csv and moved.csv describe the rest of the delta (both are empty on a full digest)
+/// rows are streamed to disk chunk by chunk; resume continues an interrupted digest from
+/// .tiramisu/neo4j/import/digest.resume instead of starting over
+/// only the row buffers are bounded: the walked paths, the set used to find vanished files and
+/// the previous manifest are held in memory, so peak memory still grows with the number of entries
+/// bulk_import writes files.csv, folders.csv and relationships.csv for neo4j-admin import, which
+/// only loads into an empty database, so it cannot be combined with incremental
 #[pyfunction]
-fn digest(core_path_string: String, blacklist: Vec<String>, hidden: bool) -> PyResult<bool> {
+#[args(threads = "0", incremental = "false", resume = "false", bulk_import = "false")]
+fn digest(
+    py: Python,
+    core_path_string: String,
+    blacklist: Vec<String>,
+    hidden: bool,
+    threads: usize,
+    incremental: bool,
+    resume: bool,
+    bulk_import: bool,
+) -> PyResult<bool> {
     println!("{:?}", env::current_dir().unwrap());
 
-    let mut csv_frame: Dataset = Dataset {
-        files: Vec::new(),
-        folders: Vec::new(),
-        relationships: Vec::new(),
-    };
-    
+    if incremental && bulk_import {
+        return Err(PyRuntimeError::new_err(
+            "a bulk import needs an empty database, so it cannot be incremental",
+        ));
+    }
+
     let core_path = PathBuf::from(core_path_string);
     
     let tiramisu_path = core_path
@@ -225,6 +842,7 @@ fn digest(core_path_string: String, blacklist: Vec<String>, hidden: bool) -> PyR
     // We skip hidden files
     let walk_dir = WalkDirGeneric::<(usize, bool)>::new(core_path.clone())
         .skip_hidden(hidden)
+        .sort(true)
         .process_read_dir(move |_depth, _path, _read_dir_state, children| {
             children.iter_mut().for_each(|dir_entry_result| {
                 if let Ok(dir_entry) = dir_entry_result {
@@ -266,342 +884,160 @@ fn digest(core_path_string: String, blacklist: Vec<String>, hidden: bool) -> PyR
             });
         });
 
-    let root = walk_dir.root();
-    
-    let mut root_string = String::from(root.to_str().unwrap());
-
-    remove_whitespace(&mut root_string);
+    // jwalk only parallelizes directory reading and yields entries in sorted order
+    // the whole walk is collected (one PathBuf per entry) since resume looks up its position in it
+    // and vanished files can only be told apart once every path is known
+    let entries: Vec<PathBuf> = walk_dir
+        .into_iter()
+        .filter_map(|entry| entry.ok())
+        .map(|valid| valid.path())
+        .collect();
 
-    // assign nodeID for file
-    let root_hash = hash_file(&PathBuf::from(root));
-
-    let root_node_id = assign_node_id(
-        &root_hash,
-        &root
-            .strip_prefix(core_path.parent().expect(""))
-            .unwrap()
-            .to_path_buf(),
-    );
+    let import_path = core_path.join(".tiramisu").join("neo4j").join("import");
+    let marker_path = import_path.join("digest.resume");
+    let manifest_path = core_path.join(".tiramisu").join("manifest.csv");
+    let manifest = if incremental {
+        read_manifest(&manifest_path)
+    } else {
+        HashMap::new()
+    };
 
-    
-    let root_record = TiramisuRecord {
-        name: String::from(PathBuf::from(root).file_name().unwrap().to_str().unwrap()),
-        node_id: root_node_id,
-        tiramisu_path: root_string,
-        original_path: root.to_string_lossy().into_owned(),
-        file_extension: String::from("folder"),
-        node_type: String::from("Folder"),
-        file_hash: String::from("ROOT"),
+    // continue after the last entry whose rows reached disk, or start over
+    let marker = if resume {
+        read_resume_marker(&marker_path)
+    } else {
+        None
+    };
+    let start = match &marker {
+        Some(marker) if marker.incremental != incremental || marker.bulk_import != bulk_import => {
+            return Err(PyRuntimeError::new_err(
+                "the interrupted digest used a different incremental or bulk_import setting",
+            ))
+        }
+        Some(marker) => match entries
+            .iter()
+            .position(|valid_path| valid_path.to_string_lossy() == marker.last_path.as_str())
+        {
+            Some(position) => position + 1,
+            None => {
+                return Err(PyRuntimeError::new_err(format!(
+                    "cannot resume, {} is no longer in the archive",
+                    marker.last_path
+                )))
+            }
+        },
+        None => 0,
     };
+    if start > 0 {
+        println!("resuming after {} of {} entries", start, entries.len());
+    }
 
-    csv_frame.folders.push(root_record);
-    
-    for entry in walk_dir {
-        if let Ok(valid) = entry {
-            // println!("{:?}", valid.path());
-            let valid_path = valid.path();
-            let valid_extension = valid_path
-                .extension()
-                .unwrap_or(OsStr::new(""))
-                .to_str()
-                .unwrap();
-            let valid_filename = valid_path
-                .file_name()
-                .unwrap_or(OsStr::new(""))
-                .to_str()
-                .unwrap();
-            let correct_extension: String;
-            let mut newpath: PathBuf;
-            let relationship: String;
+    let mut writers = DigestWriters::open(&import_path, &manifest_path, bulk_import, marker.as_ref())?;
 
-            let exceptions: HashSet<_> = ["pptx", "ppt", "xls", "doc", "xlsx", "docx"].iter().cloned().collect();
+    // files from the manifest that are no longer at their path, by hash, so a new path with
+    // the same content is recognised as a move before it is copied
+    let walked: HashSet<String> = entries
+        .iter()
+        .map(|valid_path| valid_path.to_string_lossy().into_owned())
+        .collect();
+    let vanished: HashMap<String, ManifestEntry> = manifest
+        .values()
+        .filter(|entry| entry.node_type == "File" && !walked.contains(&entry.original_path))
+        .map(|entry| (entry.file_hash.clone(), entry.clone()))
+        .collect();
 
-            // check the magic number signature to ensure that it's supported
-            if valid_path.is_file() && valid_filename != "" && (infer::is_supported(valid_extension) || exceptions.contains(valid_extension))
-            {
-                let final_result;
-                let result =
-                    infer::get_from_path(valid_path.as_path()).expect("file read successfully");
+    // nodes of the previous manifest that were carried over, including those already written
+    // by the interrupted run; whatever is left at the end was removed
+    let known: HashSet<&String> = manifest.values().map(|entry| &entry.node_id).collect();
+    let mut kept: HashSet<String> = HashSet::new();
+    if marker.is_some() {
+        kept.extend(
+            read_manifest(&writers.paths[4])
+                .into_values()
+                .map(|entry| entry.node_id)
+                .filter(|node_id| known.contains(node_id)),
+        );
+    }
 
-                if let None = result {
-                    println!("skipping {}", valid_filename);
-                } else {
-                    final_result = result.expect("");
-                    if map.contains_key(final_result.mime_type()) {
-                        let matched = match map.get(final_result.mime_type()) {
-                            Some(s) => s,
-                            None => "",
-                        };
-
-                        // if the detected extension is not what it was named, either rename with the correct extension
-                        // or leave it as is (docx, pptx, and xlsx will fall here)
-                        if matched != valid_extension {
-                            
-                            // correct extension
-                            correct_extension =
-                                map.get(final_result.mime_type()).unwrap().to_string();
-                            newpath = PathBuf::from(valid_filename);
-                            newpath = change_file_name(newpath, valid_filename, &correct_extension);
-                        } else {
-                            correct_extension = valid_extension.to_string();
-                            newpath = PathBuf::from(valid_filename);
-                        }
-                    } else {
-                        println!("{} is not part of the valid set of extensions. Not checking for correction. ", final_result.mime_type());
-                        correct_extension = valid_extension.to_string();
-                        newpath = PathBuf::from(valid_filename);
-                    }
-                    let mut owned_string = newpath.into_os_string().into_string().unwrap();
-                    // strip whitespace from filepath
-                    remove_whitespace(&mut owned_string);
-
-                    // assign nodeID for file
-                    let hash = hash_file(&valid_path);
-
-                    let node_id = assign_node_id(
-                        &hash,
-                        &valid_path
-                            .strip_prefix(core_path.parent().expect(""))
-                            .unwrap()
-                            .to_path_buf(),
-                    );
-
-                    // make nodeID folder in tiramisu versions
-                    if !tiramisu_path.join(&node_id).exists() {
-                        match fs::create_dir(tiramisu_path.join(&node_id)) {
-                            Ok(_) => println!("{} digested", valid_path.to_str().unwrap()),
-                            Err(e) => println!("{} error in making {}", e, node_id),
+    // hashing, type sniffing and copying are spread over a work-stealing pool, one chunk at a time
+    // finished chunks queue up for the writers in walk order; a full queue pauses hashing
+    let pool = match rayon::ThreadPoolBuilder::new().num_threads(threads).build() {
+        Ok(pool) => pool,
+        Err(error) => return Err(PyRuntimeError::new_err(error.to_string())),
+    };
+    let (sender, receiver) = mpsc::sync_channel::<Vec<(usize, Digested)>>(CHANNEL_BOUND);
+    let (entries, map, manifest, vanished) = (&entries, &map, &manifest, &vanished);
+    let (core_path, tiramisu_path, pool) = (&core_path, &tiramisu_path, &pool);
+    let written: io::Result<()> = py.allow_threads(|| {
+        thread::scope(|scope| {
+            scope.spawn(move || {
+                pool.install(move || {
+                    for (n, chunk) in entries[start..].chunks(DIGEST_CHUNK).enumerate() {
+                        let first = start + n * DIGEST_CHUNK;
+                        let digested: Vec<(usize, Digested)> = chunk
+                            .par_iter()
+                            .enumerate()
+                            .map(|(j, valid_path)| {
+                                let item = digest_entry(
+                                    valid_path, core_path, tiramisu_path, map, manifest, vanished,
+                                );
+                                (first + j, item)
+                            })
+                            .collect();
+                        // the writers stopped on an error
+                        if sender.send(digested).is_err() {
+                            break;
                         }
                     }
+                })
+            });
 
-                    let full_tiramisu_path = tiramisu_path.join(&node_id).join(&owned_string);
-                    // copy file to tiramisu versions with new nodeID
-                    let _ = fs::copy(&valid_path, &full_tiramisu_path);
-
-                    // lock files in read_only
-
-                    set_readonly(tiramisu_path.join(&node_id).join(&owned_string));
-
-                    // get the nodeID of the parent folder
-                    let mut parent_path = valid_path
-                        .parent()
-                        .unwrap()
-                        .strip_prefix(core_path.parent().expect(""))
-                        .unwrap()
-                        .to_path_buf()
-                        .into_os_string()
-                        .into_string()
-                        .unwrap();
-                    remove_whitespace(&mut parent_path);
-                    let parent_depth =
-                        calculate_depth(&PathBuf::from(valid_path.parent().unwrap())).to_string();
-                    let parent_node_id =
-                        assign_folder_id(&parent_depth, &PathBuf::from(parent_path));
-
-                    // all relationships are "CONTAINS" for folder-file
-                    // deprecated, but leaving here for debugging purposes
-                    relationship = String::from("CONTAINS");
-                    
-                    // save into dataset records
-                    let temp_record = TiramisuRecord {
-                        name: String::from(
-                            PathBuf::from(&owned_string)
-                                .file_name()
-                                .unwrap()
-                                .to_str()
-                                .unwrap(),
-                        ),
-                        node_id: node_id.clone(),
-                        tiramisu_path: full_tiramisu_path.to_string_lossy().into_owned(),
-                        original_path: valid_path.as_path().to_string_lossy().into_owned(),
-                        file_extension: correct_extension.to_string(),
-                        node_type: String::from("File"),
-                        file_hash: hash,
-                        // parent_node_id: parent_node_id,
-                        // relationship: relationship,
-                    };
-
-                    let relationship_record = RelationshipRecord {
-                        relationship: relationship,
-                        parent: parent_node_id,
-                        child: node_id,
-                    };
-
-                    csv_frame.files.push(temp_record);
-                    csv_frame.relationships.push(relationship_record);
-                }
-                
-                // if corrected, and combined_to relationships
-            } else if valid_path.is_dir() && valid_filename != "" {
-                let mut parent_path = valid_path
-                    .parent()
-                    .unwrap()
-                    .strip_prefix(core_path.parent().expect(""))
-                    .unwrap()
-                    .to_path_buf()
-                    .into_os_string()
-                    .into_string()
-                    .unwrap();
-                remove_whitespace(&mut parent_path);
-                let parent_depth =
-                    calculate_depth(&PathBuf::from(valid_path.parent().unwrap())).to_string();
-                let parent_node_id = assign_folder_id(&parent_depth, &PathBuf::from(&parent_path));
-
-                let mut node_path = valid_path
-                    .strip_prefix(core_path.parent().expect(""))
-                    .unwrap()
-                    .to_path_buf()
-                    .into_os_string()
-                    .into_string()
-                    .unwrap();
-                remove_whitespace(&mut node_path);
-                let node_depth = calculate_depth(&valid_path).to_string();
-                let node_id = assign_folder_id(&node_depth, &PathBuf::from(&node_path));
-                // strip whitespace from folder name
-                // assign nodeID for folder based on depth and name
-                // save into dataset records
-                relationship = String::from("CONTAINS");
-
-                let temp_record = TiramisuRecord {
-                    name: String::from(
-                        PathBuf::from(&node_path)
-                            .file_name()
-                            .unwrap()
-                            .to_str()
-                            .unwrap(),
-                    ),
-                    node_id: node_id.clone(),
-                    tiramisu_path: node_path,
-                    original_path: valid_path.as_path().to_string_lossy().into_owned(),
-                    file_extension: String::from("folder"),
-                    node_type: String::from("Folder"),
-                    file_hash: node_depth,
-                    // parent_node_id: parent_node_id,
-                    // relationship: relationship,
-                };
-
-                let relationship_record = RelationshipRecord {
-                    relationship: relationship,
-                    parent: parent_node_id,
-                    child: node_id,
+            // dropping the receiver on an error also stops the hashing thread
+            for batch in receiver {
+                let last = match batch.last() {
+                    Some((i, _)) => *i,
+                    None => continue,
                 };
-
-                csv_frame.folders.push(temp_record);
-                csv_frame.relationships.push(relationship_record);
+                for (i, item) in batch {
+                    write_digested(&mut writers, i, item, &known, &mut kept)?;
+                }
+                let lengths = writers.flush()?;
+                write_resume_marker(
+                    &marker_path,
+                    &ResumeMarker {
+                        incremental: incremental,
+                        bulk_import: bulk_import,
+                        last_path: entries[last].to_string_lossy().into_owned(),
+                        lengths: lengths,
+                    },
+                )?;
             }
-        }
-    }
-
-    // take advantage of Neo4J's bulk data import
-    let mut wtr = csv::Writer::from_path(
-        core_path
-            .join(".tiramisu")
-            .join("neo4j")
-            .join("import")
-            .join("files.csv"),
-    )
-    .unwrap();
-    let mut folders = csv::Writer::from_path(
-        core_path
-            .join(".tiramisu")
-            .join("neo4j")
-            .join("import")
-            .join("folders.csv"),
-    )
-    .unwrap();
-    let mut relationships = csv::Writer::from_path(
-        core_path
-            .join(".tiramisu")
-            .join("neo4j")
-            .join("import")
-            .join("relationships.csv"),
-    )
-    .unwrap();
-
-    match wtr.write_record(&[
-        "Name",
-        "NodeID",
-        "TiramisuPath",
-        "OriginalPath",
-        "FileExtension",
-        "NodeType",
-        "FileHash",
-
-    ]) {
-        Ok(_) => println!("Saved to CSV"),
-        Err(error) => println!("{}", error),
-    };
-    for (_, row) in csv_frame.files.into_iter().enumerate() {
-            match wtr.serialize((
-                row.name,
-                row.node_id,
-                row.tiramisu_path,
-                row.original_path,
-                row.file_extension,
-                row.node_type,
-                row.file_hash,
-
-            )) {
-                Ok(_) => (),
-                Err(error) => println!("{} error in row", error),
-            };
-    }
-    wtr.flush()?;
+            Ok(())
+        })
+    });
+    written?;
+    writers.flush()?;
+    let manifest_temporary = writers.paths[4].clone();
+    drop(writers);
 
-    match folders.write_record(&[
-        "Name",
-        "NodeID",
-        "TiramisuPath",
-        "OriginalPath",
-        "FileExtension",
-        "NodeType",
-        "FileHash",
-    ]) {
+    // everything in the old manifest whose node is not carried over: deleted paths,
+    // and the previous version of files whose content changed
+    let mut removed_nodes = csv::Writer::from_path(import_path.join("removed.csv")).unwrap();
+    match removed_nodes.write_record(&["NodeID", "NodeType", "OriginalPath"]) {
         Ok(_) => println!("Saved to CSV"),
         Err(error) => println!("{}", error),
     };
-    for (i, row) in csv_frame.folders.into_iter().enumerate() {
-        if i > 0 {
-            match folders.serialize((
-                row.name,
-                row.node_id,
-                row.tiramisu_path,
-                row.original_path,
-                row.file_extension,
-                row.node_type,
-                row.file_hash,
-
-            )) {
-                Ok(_) => (),
-                Err(error) => println!("{} error in row", error),
-            };
-        }
+    for row in manifest.values().filter(|entry| !kept.contains(&entry.node_id)) {
+        match removed_nodes.serialize((&row.node_id, &row.node_type, &row.original_path)) {
+            Ok(_) => (),
+            Err(error) => println!("{} error in row", error),
+        };
     }
-    folders.flush()?;
-
-    match relationships.write_record(&[
-        "Relationship",
-        "Parent",
-        "Child",
+    removed_nodes.flush()?;
 
-    ]) {
-        Ok(_) => println!("Saved to CSV"),
-        Err(error) => println!("{}", error),
-    };
-    for (i, row) in csv_frame.relationships.into_iter().enumerate() {
-        if i > 0 {
-            match relationships.serialize((
-                row.relationship,
-                row.parent,
-                row.child,
-
-            )) {
-                Ok(_) => (),
-                Err(error) => println!("{} error in row", error),
-            };
-        }
-    }
-    relationships.flush()?;
+    // only replaced once the delta is on disk, so a failed run is simply repeated
+    fs::rename(&manifest_temporary, &manifest_path)?;
+    let _ = fs::remove_file(&marker_path);
     Ok(true)
 }
 
@@ -0,0 +1,94 @@
+import importlib
+import os
+import re
+import time
+import uuid
+
+from tiramisu.utils import TiramisuException
+
+# claim check for large task arguments and results: the value is written once to .tiramisu/claims as msgpack
+# and only a small reference travels through redis, in the message and in the result backend
+# the task that reads the value resolves the reference; a task that only passes it on never loads it
+# every worker mounts the archive at the same path, so any of them can resolve a reference
+
+# values whose msgpack encoding has at least this many bytes are claimed
+CLAIM_BYTES = int(os.environ.get('TIRAMISU_CLAIM_BYTES', 256 * 1024))
+
+# seconds a claim is kept, as long as celery keeps task results (result_expires)
+CLAIM_EXPIRES = 24 * 60 * 60
+
+# a reference is {CLAIM_KEY: <claim id>}
+CLAIM_KEY = "tiramisu_claim"
+
+# kwargs of API actions that are claimed when large; the tasks taking them resolve them
+CLAIM_KWARGS = ["jsonl", "rows"]
+
+_last_expired = 0.0
+
+
+def claims_folder():
+	workspace = importlib.import_module('tiramisu.worker').workspace
+	return workspace.config.root / '.tiramisu' / 'claims'
+
+def is_claim(value):
+	return isinstance(value, dict) and len(value) == 1 and CLAIM_KEY in value
+
+# removes claims past CLAIM_EXPIRES, at most once an hour per process
+def expire(folder):
+	global _last_expired
+	if time.time() - _last_expired < 60 * 60:
+		return
+	_last_expired = time.time()
+
+	cutoff = time.time() - CLAIM_EXPIRES
+	for path in folder.iterdir():
+		try:
+			if path.stat().st_mtime < cutoff:
+				path.unlink()
+		except FileNotFoundError:
+			pass
+
+
+# value itself when it is small, or else the reference of its claim
+# values that msgpack has no type for are stored as their str, as the query cache does
+def claim(value, threshold = CLAIM_BYTES):
+	import msgpack
+
+	data = msgpack.packb(value, use_bin_type = True, default = str)
+	if len(data) < threshold:
+		return value
+
+	folder = claims_folder()
+	folder.mkdir(parents = True, exist_ok = True)
+	expire(folder)
+
+	claim_id = uuid.uuid4().hex
+	partial = folder / f"{claim_id}.partial"
+	with open(partial, "wb") as f:
+		f.write(data)
+	# renamed once complete, so a reference never points at half a file
+	partial.rename(folder / f"{claim_id}.msgpack")
+
+	return {CLAIM_KEY: claim_id}
+
+# the value behind a reference; any other value is returned as it is
+def resolve(value):
+	if not is_claim(value):
+		return value
+
+	import msgpack
+
+	# claim ids are uuid hex, which also keeps the path inside the claims folder
+	claim_id = value[CLAIM_KEY]
+	if not isinstance(claim_id, str) or re.fullmatch(r"[0-9a-f]{32}", claim_id) is None:
+		raise TiramisuException(f"{claim_id} is not a valid claim.")
+
+	path = claims_folder() / f"{claim_id}.msgpack"
+	if not path.is_file():
+		raise TiramisuException(f"{claim_id} is not a known claim; it may have expired.")
+	with open(path, "rb") as f:
+		return msgpack.unpackb(f.read(), raw = False, strict_map_key = False)
+
+# kwargs of an API action with the large values of CLAIM_KWARGS claimed
+def claim_kwargs(kwargs):
+	return {key: claim(value) if key in CLAIM_KWARGS else value for key, value in kwargs.items()}
@@ -1,8 +1,9 @@
-from flask import Flask, request
-from celery.result import AsyncResult
+from flask import Flask, request, send_file
+from tiramisu.metrics import exposition
 
 import importlib
 import os
+import re
 
 # defined in docker-compose.yaml
 task_executor_module = importlib.import_module(os.environ.get("TIRAMISU_TASK_EXECUTOR"))
@@ -24,24 +25,83 @@ def action_run_post_con():
     return {"task_id": task_id}
 
 # submit list of tasks to be run in a chain
+# returns straight away with the chain_id and the task_id of every step; follow it at /api/chain/<chain_id>
 @app.route("/api/action/chain", methods=["POST"])
 def action_run_post_chain():
     action_list = request.json["action_list"]
-    task_id = task_executor.chain(action_list)
-    return {"task_id": task_id}
+    return task_executor.chain(action_list)
+
+# per-step progress of a chain submitted to /api/action/chain
+@app.route("/api/chain/<chain_id>", methods=["GET"])
+def chain_status(chain_id):
+    result = task_executor.chain_status(chain_id)
+    if result is None:
+        return {"status": "failed", "error": f"{chain_id} is not a known chain."}, 404
+
+    return result
+
+def status_payload(task_result):
+    result = task_result.result
+    # a failed task holds its exception, which is not json serializable
+    if isinstance(result, BaseException):
+        result = repr(result)
+
+    return {
+        "task_id": task_result.id,
+        "task_status": task_result.status,
+        "task_result": result
+    }
 
 # submit requests to view status to this endpoint
+# ?wait=<seconds> holds the request until the task finished (or the seconds passed) instead of answering straight away
 # this is not recommended, please use localhost:8000/flower for status
 @app.route("/api/status/<task_id>", methods=["GET"])
 def status(task_id):
-    task_result = AsyncResult(task_id)
-    result = {
-        "task_id": task_id,
-        "task_status": task_result.status,
-        "task_result": task_result.result
+    wait = request.args.get("wait", type=float)
+    if wait:
+        task_executor.wait([task_id], wait)
+
+    return status_payload(task_executor.task_status(task_id))
+
+# status of many tasks in one request, {"task_ids": [...], "wait": <seconds>}
+# with wait, returns as soon as all of them finished, or after wait seconds (at most 30) with "done" false
+@app.route("/api/status", methods=["POST"])
+def status_batch():
+    task_ids = request.json["task_ids"]
+    wait = float(request.json.get("wait", 0))
+    if wait:
+        results = task_executor.wait(task_ids, wait)
+    else:
+        results = [task_executor.task_status(task_id) for task_id in task_ids]
+
+    return {
+        "done": all(result.ready() for result in results),
+        "tasks": [status_payload(result) for result in results]
     }
 
-    return result
+# downloads the parquet file written by query_neo4j with artifact = True
+@app.route("/api/artifact/<artifact_id>", methods=["GET"])
+def artifact(artifact_id):
+    path = workspace.config.root / '.tiramisu' / 'queries' / f"{artifact_id}.parquet"
+    # artifact ids are uuid hex, which also keeps the path inside the queries folder
+    if re.fullmatch(r"[0-9a-f]{32}", artifact_id) is None or not path.is_file():
+        return {"status": "failed", "error": f"{artifact_id} is not a known artifact."}, 404
+
+    return send_file(path, mimetype="application/vnd.apache.parquet", as_attachment=True, download_name=path.name)
+
+# depth of every worker queue and the time its tasks waited before a worker started them
+# for sizing the replicas and concurrency of the workers in docker-compose_*.yaml
+@app.route("/api/queues", methods=["GET"])
+def queues():
+    return {
+        "status": "succeeded",
+        "queues": task_executor.queue_stats()
+    }
+
+# wall time, cpu time, peak memory, disk i/o and items processed per task name, for prometheus to scrape
+@app.route("/api/metrics", methods=["GET"])
+def metrics():
+    return exposition(task_executor.task_metrics()), 200, {"Content-Type": "text/plain; version=0.0.4"}
 
 # returns the active task list
 # should use localhost:8000/flower for active task list
@@ -39,9 +39,21 @@ class TaskExecutor:
 	def task_status(self, task_id: str) -> Tuple[Any, Any]:
 		return ("", "")
 
+	def chain_status(self, chain_id: str) -> Optional[Dict[str, Any]]:
+		return None
+
+	def wait(self, task_ids: List[str], timeout: float) -> List[Any]:
+		return []
+
 	def active_task_list(self) -> List[Any]:
 		return []
 
+	def queue_stats(self) -> List[Dict[str, Any]]:
+		return []
+
+	def task_metrics(self) -> Dict[str, Any]:
+		return {}
+
 @dataclass
 class Config:
 	root: Path
@@ -0,0 +1,254 @@
+from celery import states
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from tiramisu.internal import TaskExecutor
+from tiramisu.worker import workspace, find_worker_queue, chain_summary, MAX_WAIT
+from tiramisu import metrics
+import copy
+import importlib
+import multiprocessing as mp
+import os
+import threading
+import time
+import uuid
+
+# runs the tasks of the celery workers on a pool of local processes, with no broker, result backend or docker stack
+# for small archives, CI benchmarks and profiling on a laptop:
+#   TIRAMISU_TASK_EXECUTOR=tiramisu.local TIRAMISU_API_URL=http://localhost:5000 gunicorn -w 1 --threads 8 -b 0.0.0.0:5000 tiramisu.wsgi:app
+# every action runs through task.apply in a pool process, and the tasks it replaces itself with or fans out to
+# run inline there (celery's eager mode), so one action keeps one process busy until its whole pipeline is done
+# task states and results live in the flask process, so flask has to run as a single process
+
+# pool processes; a task that waits on other actions (e.g. check_status) needs at least two
+PROCESSES = int(os.environ.get('TIRAMISU_LOCAL_PROCESSES', os.cpu_count() or 2))
+
+# when set, every action writes a cProfile of its run to <TIRAMISU_PROFILE_DIR>/<action>-<task_id>.prof
+PROFILE_DIR = os.environ.get('TIRAMISU_PROFILE_DIR')
+
+# seconds a finished task is reported before it is forgotten, as celery's result_expires
+RESULT_EXPIRES = 24 * 60 * 60
+
+# worker mains whose tasks the pool runs; one that cannot be imported (dependencies not installed,
+# or e.g. NEO4J_PASSWORD unset for neo4j_tasks) is left out and only its tasks are unavailable
+WORKER_MAINS = ["digest.main", "neo4j_tasks.main", "labelstudio.main"]
+
+
+# runs once in every pool process, before any task
+def init_process():
+	# read by the celery apps of the worker mains as they are imported
+	os.environ["CELERY_BROKER_URL"] = "memory://"
+	os.environ["CELERY_RESULT_BACKEND"] = "cache+memory://"
+
+	from celery import current_app
+	apps = [current_app]
+	for name in WORKER_MAINS:
+		try:
+			apps.append(importlib.import_module(name).app)
+		except Exception as ex:
+			print(f"{name} is not available, its tasks are skipped: {type(ex).__name__}: {ex}")
+
+	for app in apps:
+		app.conf.task_always_eager = True
+		app.conf.task_eager_propagates = True
+
+
+# runs action in a pool process and returns its result, with the metric sums of the tasks it ran (see tiramisu.metrics)
+# an exception is re-raised in the flask process and carries the sums along
+def run_action(task_id, action, kwargs):
+	try:
+		return apply_action(task_id, action, kwargs), metrics.drain_local()
+	except Exception as ex:
+		ex.tiramisu_metrics = metrics.drain_local()
+		raise
+
+def apply_action(task_id, action, kwargs):
+	from celery import current_app
+
+	task = current_app.tasks[action]
+	if PROFILE_DIR is None:
+		return task.apply(kwargs = kwargs, task_id = task_id).get()
+
+	import cProfile
+	profile = cProfile.Profile()
+	try:
+		return profile.runcall(lambda: task.apply(kwargs = kwargs, task_id = task_id).get())
+	finally:
+		Path(PROFILE_DIR).mkdir(parents = True, exist_ok = True)
+		profile.dump_stats(Path(PROFILE_DIR) / f"{action}-{task_id}.prof")
+
+
+# the parts of a celery AsyncResult that flask reports
+class LocalResult:
+
+	def __init__(self, task_id, status = states.PENDING, result = None):
+		self.id = task_id
+		self.status = status
+		self.result = result
+
+	def ready(self):
+		return self.status in states.READY_STATES
+
+
+class LocalTaskExecutor(TaskExecutor):
+
+	def __init__(self, processes = PROCESSES):
+		self.processes = processes
+		self.pool = None
+		# task_id -> {"action", "kwargs", "status", "result", "future", "finished"}
+		self.tasks = {}
+		# chain_id -> [task_id of every step]
+		self.chains = {}
+		# notified whenever a task finishes
+		self.changed = threading.Condition()
+		# metric sums of every action run so far, merged from the pool processes
+		self.metrics = {}
+
+	# started on the first action, so importing this module (as the pool processes do) costs nothing
+	def get_pool(self):
+		if self.pool is None:
+			# spawned rather than forked, since flask serves requests on several threads
+			self.pool = ProcessPoolExecutor(self.processes, mp_context = mp.get_context("spawn"), initializer = init_process)
+		return self.pool
+
+	def add_task(self, action, kwargs):
+		self.forget_expired()
+		task_id = str(uuid.uuid4())
+		self.tasks[task_id] = {"action": action, "kwargs": kwargs, "status": states.PENDING, "result": None, "future": None, "finished": None}
+		return task_id
+
+	# then are the tasks of the chain after this one, each submitted once the one before it succeeded
+	def submit(self, task_id, then = []):
+		record = self.tasks[task_id]
+		if record["status"] == states.REVOKED:
+			return
+		record["future"] = self.get_pool().submit(run_action, task_id, record["action"], record["kwargs"])
+		record["future"].add_done_callback(lambda future: self.finished(task_id, future, then))
+
+	def finished(self, task_id, future, then):
+		record = self.tasks[task_id]
+		sums = {}
+		if future.cancelled():
+			record["status"] = states.REVOKED
+		elif future.exception() is not None:
+			record["status"], record["result"] = states.FAILURE, future.exception()
+			sums = getattr(future.exception(), "tiramisu_metrics", {})
+			# a pool process died (e.g. killed for memory); the next action starts a new pool
+			if isinstance(future.exception(), BrokenProcessPool):
+				self.pool = None
+		else:
+			record["status"] = states.SUCCESS
+			record["result"], sums = future.result()
+		record["finished"] = time.monotonic()
+
+		with self.changed:
+			metrics.merge(self.metrics, sums)
+			self.changed.notify_all()
+
+		# submitted from a thread of its own rather than the pool's result thread that runs this callback
+		if record["status"] == states.SUCCESS and len(then) > 0:
+			threading.Thread(target = self.submit, args = (then[0], then[1:]), daemon = True).start()
+
+	def forget_expired(self):
+		now = time.monotonic()
+		for task_id in [task_id for task_id, record in self.tasks.items() if record["finished"] is not None and now - record["finished"] > RESULT_EXPIRES]:
+			self.tasks.pop(task_id, None)
+		for chain_id in [chain_id for chain_id, steps in self.chains.items() if not any(task_id in self.tasks for task_id in steps)]:
+			self.chains.pop(chain_id)
+
+	def status_of(self, record):
+		if record["status"] in states.READY_STATES:
+			return record["status"]
+		if record["future"] is not None and record["future"].running():
+			return states.STARTED
+		return states.PENDING
+
+	def concurrent(self, action_list, opened_tasks = []):
+
+		ids = []
+		for task in action_list:
+			action_kwargs = task.get("kwargs", {})
+			action = task.get("action")
+
+			if find_worker_queue(action) is None:
+				return {"status": "failed", "error": f"{action} is not a registered task."}
+			ids.append(self.add_task(action, action_kwargs))
+			self.submit(ids[-1])
+
+		return ids
+
+	# same contract as the celery chain: returns straight away, and a step only starts once the one before it succeeded
+	def chain(self, action_list):
+
+		for i in action_list:
+			if find_worker_queue(i.get("action")) is None:
+				return {"status": "failed", "error": f"{i.get('action')} is not a registered task."}
+
+		task_ids = [self.add_task(i.get("action"), i.get("kwargs", {})) for i in action_list]
+		chain_id = str(uuid.uuid4())
+		self.chains[chain_id] = task_ids
+		if len(task_ids) > 0:
+			self.submit(task_ids[0], task_ids[1:])
+
+		return {"chain_id": chain_id, "task_id": task_ids}
+
+	def chain_status(self, chain_id):
+		if chain_id not in self.chains:
+			return None
+
+		steps = []
+		for task_id in self.chains[chain_id]:
+			record = self.tasks.get(task_id)
+			steps.append({"action": None if record is None else record["action"], "task_id": task_id, "task_status": states.PENDING if record is None else self.status_of(record)})
+		return chain_summary({"chain_id": chain_id, "steps": steps})
+
+	# unknown task ids are PENDING, as with celery
+	def task_status(self, task_id):
+		record = self.tasks.get(task_id)
+		if record is None:
+			return LocalResult(task_id)
+		return LocalResult(task_id, self.status_of(record), record["result"])
+
+	def wait(self, task_ids, timeout = MAX_WAIT):
+		deadline = time.monotonic() + min(max(float(timeout), 0), MAX_WAIT)
+		with self.changed:
+			while not all(self.task_status(task_id).ready() for task_id in task_ids) and time.monotonic() < deadline:
+				self.changed.wait(deadline - time.monotonic())
+
+		return [self.task_status(task_id) for task_id in task_ids]
+
+	# tasks that have not started yet are dropped; a running task cannot be stopped and runs to its end
+	def cancel_task(self, task_id):
+		record = self.tasks.get(task_id)
+		if record is None or record["status"] in states.READY_STATES:
+			return
+		if record["future"] is None:
+			record["status"] = states.REVOKED
+			record["finished"] = time.monotonic()
+		else:
+			record["future"].cancel()
+
+	# in the shape of celery's inspect(), with the pool as its only worker
+	def active_task_list(self):
+		listed = {states.STARTED: [], states.PENDING: []}
+		for task_id, record in list(self.tasks.items()):
+			status = self.status_of(record)
+			if status in listed and record["future"] is not None:
+				listed[status].append({"id": task_id, "name": record["action"], "kwargs": record["kwargs"]})
+
+		return {'active': {'local': listed[states.STARTED]}, 'scheduled': {'local': []}, 'queued': {'local': listed[states.PENDING]}}
+
+	# time, memory, i/o and items of the tasks the pool ran, including the ones an action ran inline
+	# peak memory is that of the pool process, which is reused across actions
+	def task_metrics(self):
+		with self.changed:
+			return metrics.task_metrics(copy.deepcopy(self.metrics))
+
+	def queue_stats(self):
+		queued = sum(1 for record in list(self.tasks.values()) if record["future"] is not None and self.status_of(record) == states.PENDING)
+		return [{"queue": "local", "depth": queued, "processes": self.processes}]
+
+
+# flask loads this module as its executor when TIRAMISU_TASK_EXECUTOR=tiramisu.local
+task_executor = LocalTaskExecutor()
+workspace.task_executor = task_executor
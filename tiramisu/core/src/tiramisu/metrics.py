@@ -0,0 +1,194 @@
+from celery import current_task, states
+from tiramisu.utils import backend_client
+from celery.signals import task_prerun, task_postrun
+import resource
+import time
+
+# wall time, cpu time, peak memory, disk i/o and items processed of every task, per task name, summed in redis
+# and read back as prometheus histograms by /api/metrics
+# importing this module connects the handlers, so every worker main imports it
+# without redis (tiramisu.local) the sums are kept in the process instead, and handed over with drain_local
+#
+# cpu time is the worker process plus the subprocesses it waited for; documents converted by the long-lived
+# LibreOffice listeners (see office.py) show up as wall time that is not covered by cpu time
+# peak memory is the high-water mark of the worker process, so it only grows until --max-tasks-per-child recycles it
+
+METRICS_KEY = "tiramisu-task-metrics:{task}"
+TASKS_KEY = "tiramisu-task-metrics"
+
+SECONDS_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]
+BYTES_BUCKETS = [10 ** exponent for exponent in range(3, 11)]
+RSS_BUCKETS = [2 ** exponent * 1024 * 1024 for exponent in range(6, 14)]
+
+# name, help text and buckets of every histogram
+HISTOGRAMS = [
+	("wall_seconds", "Wall time of a task.", SECONDS_BUCKETS),
+	("cpu_seconds", "User and system cpu time of a task.", SECONDS_BUCKETS),
+	("peak_rss_bytes", "Peak resident memory of the worker process when a task finished.", RSS_BUCKETS),
+	("read_bytes", "Bytes read from storage during a task.", BYTES_BUCKETS),
+	("write_bytes", "Bytes written to storage during a task.", BYTES_BUCKETS),
+]
+
+# name and help text of every counter
+COUNTERS = [
+	("tasks", "Tasks finished."),
+	("failures", "Tasks that raised."),
+	("items", "Items processed by tasks, as reported by record_items (or else the length of a list result)."),
+]
+
+# measurements of the tasks running in this process, by task id
+_running = {}
+
+# stand-in for the redis hashes when there is no client: task name -> field -> sum
+_local = {}
+
+
+def _client():
+	return backend_client()
+
+# adds increments to the fields of the hash of task
+def _increment(task, increments):
+	client = _client()
+	if client is None:
+		values = _local.setdefault(task, {})
+		for field, value in increments.items():
+			values[field] = values.get(field, 0.0) + value
+		return
+
+	key = METRICS_KEY.format(task = task)
+	with client.pipeline() as pipe:
+		pipe.sadd(TASKS_KEY, task)
+		for field, value in increments.items():
+			pipe.hincrbyfloat(key, field, value)
+		pipe.execute()
+
+# the sums kept in this process since the last call, which are cleared
+def drain_local():
+	values = dict(_local)
+	_local.clear()
+	return values
+
+# adds sums drained from another process into values
+def merge(values, drained):
+	for task, fields in drained.items():
+		target = values.setdefault(task, {})
+		for field, value in fields.items():
+			target[field] = target.get(field, 0.0) + value
+	return values
+
+def _cpu_seconds():
+	usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+	return sum(u.ru_utime + u.ru_stime for u in usage)
+
+# kilobytes on linux
+def _peak_rss_bytes():
+	return max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)) * 1024
+
+# storage i/o of this process and the children it reaped; zero where /proc is not available
+def _io_bytes():
+	try:
+		with open("/proc/self/io") as f:
+			fields = dict(line.split(": ") for line in f.read().splitlines())
+		return int(fields["read_bytes"]), int(fields["write_bytes"])
+	except (OSError, KeyError, ValueError):
+		return 0, 0
+
+
+# sets the number of items the running task processed (rows, pages, documents, ...)
+# task_name files the measurements of the running task under another name, e.g. run_batch_digest under the task it ran
+def record_items(count, task_name = None):
+	task = current_task
+	if task is None or task.request.id not in _running:
+		return
+	_running[task.request.id]["items"] = count
+	if task_name is not None:
+		_running[task.request.id]["name"] = task_name
+
+
+@task_prerun.connect
+def start_measuring(task_id = None, task = None, **kwargs):
+	read, written = _io_bytes()
+	_running[task_id] = {
+		"name": task.name,
+		"items": None,
+		"wall": time.perf_counter(),
+		"cpu": _cpu_seconds(),
+		"read": read,
+		"write": written,
+	}
+
+
+# failures are counted from the state postrun reports, since celery sends no task_failure for eagerly applied tasks;
+# with task_eager_propagates the exception escapes before a state is set, so postrun reports None
+@task_postrun.connect
+def record_measurements(task_id = None, retval = None, state = None, **kwargs):
+	start = _running.pop(task_id, None)
+	if start is None:
+		return
+
+	read, written = _io_bytes()
+	values = {
+		"wall_seconds": time.perf_counter() - start["wall"],
+		"cpu_seconds": _cpu_seconds() - start["cpu"],
+		"peak_rss_bytes": _peak_rss_bytes(),
+		"read_bytes": max(read - start["read"], 0),
+		"write_bytes": max(written - start["write"], 0),
+	}
+	items = start["items"]
+	if items is None:
+		items = len(retval) if isinstance(retval, list) else 1
+
+	increments = {"tasks": 1, "items": items, "failures": 1 if state in (states.FAILURE, None) else 0}
+	# buckets are stored per interval and summed into cumulative prometheus buckets when read
+	for name, _, buckets in HISTOGRAMS:
+		le = next((str(bound) for bound in buckets if values[name] <= bound), "+Inf")
+		increments[f"{name}:{le}"] = 1
+		increments[f"{name}:sum"] = values[name]
+	_increment(start["name"], increments)
+
+
+# histograms and counters of every task name seen so far
+# sums are read from redis, or else from this process; tiramisu.local passes the sums it collected from its pool
+def task_metrics(sums = None):
+	if sums is None:
+		client = _client()
+		if client is None:
+			sums = _local
+		else:
+			sums = {task.decode(): {field.decode(): float(value) for field, value in client.hgetall(METRICS_KEY.format(task = task.decode())).items()} \
+				for task in client.smembers(TASKS_KEY)}
+
+	metrics = {}
+	for name in sorted(sums):
+		values = sums[name]
+
+		metrics[name] = {counter: values.get(counter, 0.0) for counter, _ in COUNTERS}
+		for histogram, _, buckets in HISTOGRAMS:
+			cumulative, total = [], 0.0
+			for le in [str(bound) for bound in buckets] + ["+Inf"]:
+				total += values.get(f"{histogram}:{le}", 0.0)
+				cumulative.append((le, total))
+			metrics[name][histogram] = {"buckets": cumulative, "sum": values.get(f"{histogram}:sum", 0.0), "count": total}
+	return metrics
+
+
+# task_metrics in the prometheus text exposition format
+def exposition(metrics):
+	def label(value):
+		return value.replace("\\", "\\\\").replace("\"", "\\\"")
+
+	lines = []
+	for counter, text in COUNTERS:
+		lines += [f"# HELP tiramisu_task_{counter}_total {text}", f"# TYPE tiramisu_task_{counter}_total counter"]
+		for name, values in metrics.items():
+			lines.append(f"tiramisu_task_{counter}_total{{task=\"{label(name)}\"}} {values[counter]}")
+
+	for histogram, text, _ in HISTOGRAMS:
+		lines += [f"# HELP tiramisu_task_{histogram} {text}", f"# TYPE tiramisu_task_{histogram} histogram"]
+		for name, values in metrics.items():
+			for le, count in values[histogram]["buckets"]:
+				lines.append(f"tiramisu_task_{histogram}_bucket{{task=\"{label(name)}\",le=\"{le}\"}} {count}")
+			lines.append(f"tiramisu_task_{histogram}_sum{{task=\"{label(name)}\"}} {values[histogram]['sum']}")
+			lines.append(f"tiramisu_task_{histogram}_count{{task=\"{label(name)}\"}} {values[histogram]['count']}")
+
+	return "\n".join(lines) + "\n"
@@ -0,0 +1,45 @@
+from tiramisu.utils import backend_client
+from celery.signals import before_task_publish, task_prerun
+import time
+
+# how long tasks wait in their queue before a worker starts them, per queue, summed in redis
+# every message is stamped when it is published; the worker that picks it up records the difference
+# importing this module connects the handlers, so every worker main and the flask executor import it
+
+PUBLISHED_HEADER = "tiramisu_published"
+WAIT_KEY = "tiramisu-queue-wait:{queue}"
+
+
+@before_task_publish.connect
+def stamp_published(headers = None, **kwargs):
+	if headers is not None:
+		headers[PUBLISHED_HEADER] = time.time()
+
+
+@task_prerun.connect
+def record_wait(task = None, **kwargs):
+	client = backend_client()
+	published = getattr(task.request, PUBLISHED_HEADER, None)
+	queue = (task.request.delivery_info or {}).get('routing_key')
+	if client is None or published is None or queue is None:
+		return
+
+	wait = max(time.time() - float(published), 0)
+	with client.pipeline() as pipe:
+		pipe.hincrbyfloat(WAIT_KEY.format(queue = queue), "tasks", 1)
+		pipe.hincrbyfloat(WAIT_KEY.format(queue = queue), "wait_seconds", wait)
+		pipe.hset(WAIT_KEY.format(queue = queue), "last_wait_seconds", wait)
+		pipe.execute()
+
+
+# tasks started from queue so far, their mean wait and the wait of the latest one
+def wait_stats(queue):
+	client = backend_client()
+	values = {} if client is None else {field.decode(): float(value) for field, value in client.hgetall(WAIT_KEY.format(queue = queue)).items()}
+	tasks = int(values.get("tasks", 0))
+
+	return {
+		"tasks": tasks,
+		"mean_wait_seconds": values.get("wait_seconds", 0.0) / tasks if tasks else 0.0,
+		"last_wait_seconds": values.get("last_wait_seconds", 0.0)
+	}
@@ -12,17 +12,31 @@ import time
 import json
 from urllib import request, parse
 
+# the flask API that tasks submit follow-up actions to; the flask service of docker-compose unless set
+API_URL = os.environ.get('TIRAMISU_API_URL', 'http://flask:5000')
+
+# the redis client of the result backend, or None with any other backend
+# (the in-memory backend of tiramisu.local and digest/benchmark.py has a client too, but not a redis one)
+def backend_client():
+	from celery import current_app
+	from celery.backends.redis import RedisBackend
+
+	backend = current_app.backend
+	return backend.client if isinstance(backend, RedisBackend) else None
+
+# blocks until every task finished, with one long-polled batch request per 30 seconds instead of one poll per task per second
+# returns whether all of them succeeded
 def check_status(list_of_ids):
-	for task_id in list_of_ids:
-		status = 'PENDING'
-		while status != 'SUCCESS':
-			time.sleep(1)
-			url = f"http://flask:5000/api/status/{task_id}"
-			res = request.urlopen(url)
-			# res.add_header("Content-Type", "application/json")
-			status = json.loads(res.read())['task_status']
+	data = json.dumps({"task_ids": list(list_of_ids), "wait": 30}).encode()
+
+	done = False
+	while not done:
+		req = request.Request(f"{API_URL}/api/status", data)
+		req.add_header("Content-Type", "application/json")
+		res = json.loads(request.urlopen(req).read())
+		done = res['done']
 	
-	return True
+	return all(task['task_status'] == 'SUCCESS' for task in res['tasks'])
 
 
 class TiramisuException(Exception):
@@ -37,22 +51,98 @@ class TiramisuException(Exception):
 
 
 
+# size of the chunks read by crc32_file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
 def crc32(data):
 	data = bytes(data, 'UTF-8')
 
 	return hex(zlib.crc32(data) & 0xffffffff)  # crc32 returns a signed value, &-ing it will match py3k
 
 
+# the content half of an ID is the crc32 of str(content), the repr of its bytes, as generate_id computed it when
+# it read whole files into memory; it is computed here chunk by chunk so the node IDs and version folders of
+# archives digested before stay the same
+# repr escapes every byte on its own, so only the quote depends on the whole content: it is " when the content has
+# a ' and no ", and ' otherwise (with \' escaped); both variants are hashed and the right one is picked at the end
+class _ReprCrc32:
+
+	def __init__(self):
+		self.single = zlib.crc32(b"b'")
+		self.double = zlib.crc32(b'b"')
+		self.has_single = False
+		self.has_double = False
+
+	def update(self, chunk):
+		chunk = bytes(chunk)
+		self.has_single = self.has_single or b"'" in chunk
+		self.has_double = self.has_double or b'"' in chunk
+
+		text = repr(chunk)
+		body = text[2:-1]
+		self.single = zlib.crc32((body if text[1] == "'" else body.replace("'", "\\'")).encode(), self.single)
+		# only used when the content has no ", in which case the body never differs from repr in either quote
+		self.double = zlib.crc32(body.encode(), self.double)
+
+	def hexdigest(self):
+		if self.has_single and not self.has_double:
+			return hex(zlib.crc32(b'"', self.double) & 0xffffffff)
+		return hex(zlib.crc32(b"'", self.single) & 0xffffffff)
+
+
+# hashes a file in fixed-size chunks read into one reusable buffer, so memory stays constant
+def crc32_file(path, chunk_size = HASH_CHUNK_SIZE):
+	checksum = _ReprCrc32()
+	buffer = bytearray(chunk_size)
+	view = memoryview(buffer)
+
+	with open(path, "rb", buffering = 0) as f:
+		while True:
+			size = f.readinto(buffer)
+			if not size:
+				break
+			checksum.update(view[:size])
+
+	return checksum.hexdigest()
+
+
+# hashes in-memory content one chunk at a time
+# data is a str, bytes or any buffer-protocol object (e.g. Pixmap.samples_mv), or a list/tuple of those
+# a str is hashed as its text and a buffer as the repr of its bytes, as crc32(str(data)) did
+def crc32_buffer(data, chunk_size = HASH_CHUNK_SIZE):
+	if isinstance(data, (list, tuple)):
+		# the parts are hashed in order, through the hash of each
+		return crc32("".join(crc32_buffer(part, chunk_size) for part in data))
+	if isinstance(data, str):
+		return crc32(data)
+
+	view = memoryview(data).cast('B')
+	checksum = _ReprCrc32()
+	for i in range(0, len(view), chunk_size):
+		checksum.update(view[i:i + chunk_size])
+	return checksum.hexdigest()
+
+
+# node IDs are "<content hash>+++<path hash>": the crc32 of the content (see crc32_file) and of the path, in hex
+# (the Rust digest writes the same two halves as decimal numbers), so the same content at two paths gets two nodes
 def generate_id(path, data = None):
 
 	if data is None:
-		with open(path, "rb") as f:
-			hexs = crc32(str(f.read()))
+		hexs = crc32_file(path)
 	else:
-		hexs = crc32(str(data))
+		hexs = crc32_buffer(data)
 
 	return  hexs + "+++" + crc32(path.as_posix())
 
+# virtual pages have no file of their own, so their ID is "<crc32 of parentID#page_index>+++<path half of parentID>"
+# both halves come from the parent: pages of two documents only share an ID if the path halves of their parents
+# collide and so do the crc32 of their parent IDs, instead of on a single 32-bit collision of the first half
+def generate_page_id(parentID, index):
+	path_half = parentID.rsplit("+++", 1)[1] if "+++" in parentID else crc32(parentID)
+
+	return crc32(f"{parentID}#page_{index}") + "+++" + path_half
+
 
 
 def tiramisu_update(context, container, data = None):
@@ -70,7 +160,8 @@ def tiramisu_update(context, container, data = None):
 			pass
 		else:
 
-			(context.config.root / ".tiramisu"/ '___tiramisu_versions' / node_id).mkdir()
+			# the folder is named after the content hash, so one left by an interrupted run already holds this output
+			(context.config.root / ".tiramisu"/ '___tiramisu_versions' / node_id).mkdir(exist_ok = True)
 		
 		# child should always be the new folder with nodeID in tiramisu_versions
 		container.child = context.config.root / ".tiramisu"/ '___tiramisu_versions' / node_id
@@ -1,12 +1,18 @@
-from celery import Celery, current_task, states, chain, signature
+from celery import Celery, current_app, current_task, states, chain, signature
+from celery.exceptions import TimeoutError
 from celery.result import AsyncResult
 from tiramisu.internal import Workspace, TaskExecutor
+from tiramisu.queues import wait_stats
+from tiramisu.metrics import task_metrics
+from tiramisu.utils import backend_client
+from tiramisu.claims import claim_kwargs
 from typing import Any, List, Dict, Tuple
 import os
 from celery.result import allow_join_result
 import json
 import time 
 import importlib
+import uuid
 
 
 import sys 
@@ -15,7 +21,38 @@ sys.path.append('')
 
 
 
-def find_worker_queue(task_name):
+# queue of the digest tasks whose rows pass the heavy thresholds below; served by digest_heavy_worker
+HEAVY_QUEUE = "digest_heavy"
+
+# every queue a worker consumes from, reported by /api/queues
+QUEUES = ["digest_worker", HEAVY_QUEUE, "neo4j_worker", "labelstudio_worker", "ml_worker"]
+
+# a query row is heavy when it lists at least HEAVY_PAGES pages, its file has at least HEAVY_MEGABYTES,
+# or its file has one of HEAVY_EXTENSIONS (comma separated, e.g. "tif,tiff")
+HEAVY_PAGES = int(os.environ.get('DIGEST_HEAVY_PAGES', 500))
+HEAVY_MEGABYTES = float(os.environ.get('DIGEST_HEAVY_MEGABYTES', 200))
+HEAVY_EXTENSIONS = [i.strip().lower() for i in os.environ.get('DIGEST_HEAVY_EXTENSIONS', '').split(',') if i.strip()]
+
+
+def is_heavy(row):
+	if not isinstance(row, dict):
+		return False
+	if isinstance(row.get('pages'), list) and len(row['pages']) >= HEAVY_PAGES:
+		return True
+
+	path = row.get('path')
+	if not isinstance(path, str):
+		return False
+	if os.path.splitext(path)[1].lstrip('.').lower() in HEAVY_EXTENSIONS:
+		return True
+	try:
+		return os.path.getsize(path) >= HEAVY_MEGABYTES * 1024 * 1024
+	except OSError:
+		return False
+
+
+# rows are the query rows a digest task is given, if any; a digest task with a heavy row goes to HEAVY_QUEUE
+def find_worker_queue(task_name, rows = None):
 
 	if task_name.split("_")[-1]  == "ml":
 		return "ml_worker"
@@ -24,13 +61,49 @@ def find_worker_queue(task_name):
 	elif task_name.split("_")[-1] == "labelstudio":
 		return "labelstudio_worker"
 	elif task_name.split("_")[-1] == "digest":
+		if rows is not None and any(is_heavy(row) for row in rows):
+			return HEAVY_QUEUE
 		return "digest_worker"
 	else:
 		return None
 
+# query rows handed to a task through the API, as find_worker_queue takes them
+def action_rows(kwargs):
+	rows = kwargs.get("queryrows")
+	if isinstance(rows, dict):
+		return [rows]
+	return rows if isinstance(rows, list) else None
+
 
 workspace = Workspace(os.environ.get("TIRAMISU_CONFIG_FILENAME"))
 
+# chains are recorded in the result backend so their steps can be reported while they run
+# the record expires with the task results (result_expires)
+CHAIN_KEY = "tiramisu-chain-{chain_id}"
+
+# longest a status request may be held open, below the 60 second proxy_read_timeout of nginx
+MAX_WAIT = 30
+
+
+# adds the overall status and progress of a chain record whose steps have their task_status
+def chain_summary(record):
+	statuses = [step["task_status"] for step in record["steps"]]
+
+	# steps after a failed one are never started and stay PENDING
+	if states.FAILURE in statuses or states.REVOKED in statuses:
+		chain_status = states.FAILURE if states.FAILURE in statuses else states.REVOKED
+	elif all(status == states.SUCCESS for status in statuses):
+		chain_status = states.SUCCESS
+	elif all(status == states.PENDING for status in statuses):
+		chain_status = states.PENDING
+	else:
+		chain_status = states.STARTED
+
+	record["chain_status"] = chain_status
+	record["completed"] = statuses.count(states.SUCCESS)
+	record["total"] = len(statuses)
+	return record
+
 
 class CeleryTaskExecutor(TaskExecutor):
 	def concurrent(self, action_list: List[Dict[str, Any]], opened_tasks = []):
@@ -46,13 +119,14 @@ class CeleryTaskExecutor(TaskExecutor):
 			# from digest.main import app as digest_worker
 			# print(digest_worker.tasks)
 
-			worker = find_worker_queue(action)
+			worker = find_worker_queue(action, action_rows(action_kwargs))
 			
 
 			if worker is None:
 				return {"status": "failed", "error": f"{action} is not a registered task."}
 			else:
-				ids.append(signature(action, kwargs = action_kwargs, queue = worker).delay().id)
+				# large payloads (e.g. the jsonl of upload_to_labelstudio) travel as claims, see tiramisu.claims
+				ids.append(signature(action, kwargs = claim_kwargs(action_kwargs), queue = worker).delay().id)
 		
 		return ids
 		
@@ -65,33 +139,108 @@ class CeleryTaskExecutor(TaskExecutor):
 
 		return result
 
-	def chain(self, chain):
+	# blocks until every task in task_ids reached a ready state (SUCCESS, FAILURE or REVOKED) or timeout seconds passed
+	# the redis result backend publishes each state on the key of the task, so this listens on those
+	# channels and returns as soon as the last task finishes, with no polling interval
+	def wait(self, task_ids, timeout = MAX_WAIT):
+		timeout = min(max(float(timeout), 0), MAX_WAIT)
+		results = [AsyncResult(task_id) for task_id in task_ids]
+		pending = {current_app.backend.get_key_for_task(result.id): result for result in results}
+
+		# backends without publish (e.g. rpc) are left to celery to wait on
+		if backend_client() is None:
+			deadline = time.monotonic() + timeout
+			for result in pending.values():
+				try:
+					result.get(timeout = max(deadline - time.monotonic(), 0), propagate = False, disable_sync_subtasks = False)
+				except TimeoutError:
+					break
+			return results
+
+		# one pubsub connection per request, since flask serves requests on several threads
+		pubsub = current_app.backend.client.pubsub(ignore_subscribe_messages = True)
+		try:
+			if pending:
+				pubsub.subscribe(*pending)
+			# subscribed before checking, so a task finishing in between is not missed
+			pending = {key: result for key, result in pending.items() if not result.ready()}
+
+			deadline = time.monotonic() + timeout
+			while pending and time.monotonic() < deadline:
+				message = pubsub.get_message(timeout = deadline - time.monotonic())
+				if message is None:
+					continue
+				if current_app.backend.decode_result(message["data"])["status"] in states.READY_STATES:
+					pending.pop(message["channel"], None)
+		finally:
+			pubsub.close()
+
+		return results
+
+	# dispatches the actions as one celery chain and returns without waiting for it
+	# every step is immutable, so it ignores the result of the step before it,
+	# and only starts once that step succeeded
+	def chain(self, action_list):
 
 		print("The following task chain is: \n")
-		for i in chain:
+		for i in action_list:
 			print(f"Task:{i}")
-		task_ids = []
-		for i in chain:
-			print(f"Current task:{i}")
 
+		signatures = []
+		for i in action_list:
 			action_kwargs = i.get("kwargs", {})
 			action = i.get("action")
 
-			worker = find_worker_queue(action)
+			worker = find_worker_queue(action, action_rows(action_kwargs))
 			if worker is None:
 				return {"status": "failed", "error": f"{action} is not a registered task."}
-			else:
-				res = signature(action, kwargs = action_kwargs, immutable = True, queue = worker).delay()
-				task_ids.append(res.id)
-				print(f"{action} is the task that is waiting at the moment")
-				while not res.ready():
-					time.sleep(1)
-				with allow_join_result():
-					_ = res.get(disable_sync_subtasks = True)
-				print(f"{action} has now finished.")
-			 # will block until finished
-
-		return task_ids
+			signatures.append(signature(action, kwargs = claim_kwargs(action_kwargs), immutable = True, queue = worker))
+
+		result = chain(*signatures).apply_async()
+
+		# apply_async returns the last step; its parents are the steps before it
+		task_ids = []
+		while result is not None:
+			task_ids.insert(0, result.id)
+			result = result.parent
+
+		chain_id = str(uuid.uuid4())
+		steps = [{"action": i.get("action"), "task_id": task_id} for i, task_id in zip(action_list, task_ids)]
+		current_app.backend.set(CHAIN_KEY.format(chain_id = chain_id), json.dumps({"chain_id": chain_id, "steps": steps}))
+
+		return {"chain_id": chain_id, "task_id": task_ids}
+
+	# per-step progress of a chain started by chain(), or None for an unknown (or expired) chain
+	def chain_status(self, chain_id):
+		record = current_app.backend.get(CHAIN_KEY.format(chain_id = chain_id))
+		if record is None:
+			return None
+		record = json.loads(record)
+
+		for step in record["steps"]:
+			step["task_status"] = AsyncResult(step["task_id"]).status
+		return chain_summary(record)
+
+	# messages waiting in every queue of QUEUES, and how long the tasks started from it waited
+	def queue_stats(self):
+		from kombu.exceptions import ChannelError
+
+		stats = []
+		with current_app.connection_for_read() as connection:
+			channel = connection.default_channel
+			for queue in QUEUES:
+				try:
+					depth = channel.queue_declare(queue, passive = True).message_count
+				# the redis transport drops a queue's key once it is empty
+				except ChannelError:
+					depth = 0
+				stats.append({"queue": queue, "depth": depth, **wait_stats(queue)})
+
+		return stats
+
+	# time, memory, i/o and items of the tasks finished so far, per task name (see tiramisu.metrics)
+	def task_metrics(self):
+		return task_metrics()
 
 	def active_task_list(self):
 		mod = celery.control.inspect()